@@ -0,0 +1,174 @@
+"""
+本地模拟的SoilGrids WCS服务
+
+按WCS 1.0.0 GetCoverage请求返回合成的INT16 GeoTIFF，像元值由坐标确定(同一位置每次返回相同的值)，
+可配置响应延迟、抖动和错误率，用于在不访问SoilGrids的情况下压测服务。
+
+用法:
+    python benchmarks/fake_wcs.py [--port 8081] [--latency 0.05] [--jitter 0.02] [--error-rate 0.01]
+
+服务启动后把SOILGRIDS_WCS_URL设置为 http://127.0.0.1:{port}/?map=/map/{service_id}.map
+"""
+import argparse
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+
+# 各属性合成值的基准(g/kg)，粘土、砂粒、粉粒之和约为1000
+BASE_VALUES = {
+    "clay": 250,
+    "sand": 350,
+    "silt": 400,
+}
+DEFAULT_BASE_VALUE = 100
+
+
+def synthetic_coverage(coverage_id, west, south, east, north, width, height):
+    """
+    生成合成栅格
+
+    像元值在基准值附近随经纬度平滑变化，粘土与砂粒反向变化，保证三者之和接近1000
+    """
+    service_id = coverage_id.split("_", 1)[0]
+    base = BASE_VALUES.get(service_id, DEFAULT_BASE_VALUE)
+    xs = west + (np.arange(width) + 0.5) * (east - west) / width
+    ys = north - (np.arange(height) + 0.5) * (north - south) / height
+    x, y = np.meshgrid(xs, ys)
+    wave = 100 * np.sin(np.radians(x) * 40) * np.cos(np.radians(y) * 40)
+    if service_id == "sand":
+        wave = -wave
+    elif service_id == "silt":
+        wave = np.zeros_like(wave)
+    return np.round(base + wave).astype(np.int16)
+
+
+def encode_geotiff(array, west, north, pixel_width, pixel_height):
+    transform = Affine(pixel_width, 0.0, west, 0.0, -pixel_height, north)
+    with MemoryFile() as memfile:
+        with memfile.open(driver="GTiff", width=array.shape[1], height=array.shape[0], count=1,
+                          dtype="int16", crs="EPSG:4326", transform=transform) as dataset:
+            dataset.write(array, 1)
+        return memfile.read()
+
+
+class FakeWCSServer(object):
+    """
+    模拟WCS服务
+
+    参数:
+    latency: 平均响应延迟(秒)
+    jitter: 延迟的标准差(秒)
+    error_rate: 返回错误的比例，错误一半为HTTP 503，一半为XML格式的ServiceException
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def url_template(self):
+        """返回用于SOILGRIDS_WCS_URL的地址模板"""
+        return f"http://127.0.0.1:{self.port}/?map=/map/{{service_id}}.map"
+
+    def _draw(self):
+        """抽取本次请求的延迟和是否出错"""
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self.random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+            error = self.random.random() < self.error_rate
+            kind = self.random.random()
+            if error:
+                self.errors += 1
+        return delay, error, kind
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                params = {key.upper(): values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                delay, error, kind = fake._draw()
+                if delay:
+                    time.sleep(delay)
+
+                if error and kind < 0.5:
+                    self._send(503, "text/plain", b"Service Unavailable")
+                    return
+                if error:
+                    self._send(200, "application/vnd.ogc.se_xml",
+                               b"<ServiceExceptionReport><ServiceException>simulated</ServiceException>"
+                               b"</ServiceExceptionReport>")
+                    return
+
+                try:
+                    west, south, east, north = (float(value) for value in params["BBOX"].split(","))
+                    width, height = int(params["WIDTH"]), int(params["HEIGHT"])
+                    array = synthetic_coverage(params["COVERAGE"], west, south, east, north, width, height)
+                    body = encode_geotiff(array, west, north, (east - west) / width, (north - south) / height)
+                except (KeyError, ValueError) as e:
+                    self._send(400, "text/plain", str(e).encode("utf-8"))
+                    return
+                self._send(200, "image/tiff", body)
+
+            def _send(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """在后台线程中启动服务"""
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的SoilGrids WCS服务")
+    parser.add_argument("--port", type=int, default=8081, help="监听端口")
+    parser.add_argument("--latency", type=float, default=0.05, help="平均响应延迟(秒)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="延迟的标准差(秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误的比例")
+    parser.add_argument("--seed", type=int, default=None, help="随机数种子")
+    args = parser.parse_args()
+
+    server = FakeWCSServer(port=args.port, latency=args.latency, jitter=args.jitter,
+                           error_rate=args.error_rate, seed=args.seed)
+    print(f"模拟WCS服务已启动: SOILGRIDS_WCS_URL={server.url_template()}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""
+服务压测
+
+启动本地模拟WCS服务(fake_wcs.py)和使用替身模型(stub_models)的gunicorn，按指定并发压测
+/api/soil-texture和/api/soil-hydraulics，并在进程内测试query_soil_property和find_closest_soil_code。
+每次运行使用全新的临时栅格存储和结果缓存，结果(p50/p95/p99延迟、每秒请求数、启动耗时、各工作进程内存)以JSON输出。
+
+用法:
+    python benchmarks/run_benchmarks.py [--workers 4] [--concurrency 16] [--requests 400] [--output result.json]
+
+每个接口先对--distinct个坐标各请求一次(cold，需要下载栅格或运行模型)，再从这些坐标中随机请求
+--requests次(warm，主要命中本地栅格和结果缓存)。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+STUB_MODELS_DIR = os.path.join(BENCHMARK_DIR, "stub_models")
+
+sys.path.insert(0, BENCHMARK_DIR)
+from fake_wcs import FakeWCSServer  # noqa: E402
+
+# 合成土壤数据库的粘土、粉粒百分比步长
+SOIL_DATA_STEP = 5
+
+
+def percentiles(latencies):
+    """延迟统计(毫秒)"""
+    if not latencies:
+        return {}
+    values = sorted(latencies)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(round(q * (len(values) - 1))))] * 1000, 3)
+
+    return {
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "mean": round(sum(values) / len(values) * 1000, 3),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+
+def run_load(call, items, concurrency):
+    """
+    按并发数执行call(item)，call返回False或抛出异常计为错误
+
+    返回:
+    dict: 请求数、错误数、每秒请求数及延迟统计
+    """
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            ok = call(item) is not False
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, items))
+    elapsed = time.perf_counter() - start
+
+    latencies = [seconds for seconds, ok in outcomes if ok]
+    return {
+        "requests": len(outcomes),
+        "errors": sum(1 for _, ok in outcomes if not ok),
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(outcomes) / elapsed, 2) if elapsed else None,
+        "latency_ms": percentiles(latencies),
+    }
+
+
+def make_points(count, bbox, seed):
+    """在范围内随机生成坐标"""
+    rng = random.Random(seed)
+    west, south, east, north = bbox
+    return [(round(rng.uniform(west, east), 6), round(rng.uniform(south, north), 6)) for _ in range(count)]
+
+
+def write_soil_data(path):
+    """写入合成土壤数据库，代码为粘土、粉粒百分比各两位"""
+    soil_data = {}
+    for clay in range(0, 100, SOIL_DATA_STEP):
+        for silt in range(0, min(100 - clay, 95) + 1, SOIL_DATA_STEP):
+            soil_data[f"{clay:02d}{silt:02d}"] = {"clay": clay, "silt": silt, "sand": 100 - clay - silt}
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(soil_data, file)
+
+
+def service_env(workdir, wcs_url, model_seconds, upstream_rate=0):
+    """被测服务的环境变量，所有状态写入临时目录"""
+    env = dict(os.environ)
+    env.update({
+        "SOILGRIDS_WCS_URL": wcs_url,
+        "SOIL_RASTER_STORE_DIR": os.path.join(workdir, "raster_store"),
+        "SOIL_RESULT_CACHE_PATH": os.path.join(workdir, "result_cache.sqlite3"),
+        "SOIL_SINGLE_FLIGHT_DIR": os.path.join(workdir, "locks"),
+        "SOIL_HYDRAULICS_TABLE_DIR": os.path.join(workdir, "hydraulics_table"),
+        "SOIL_JOBS_DB_PATH": os.path.join(workdir, "jobs.sqlite3"),
+        "SOIL_METRICS_DIR": os.path.join(workdir, "metrics"),
+        "SOIL_DATA_PATH": os.path.join(workdir, "soil_data.json"),
+        "SOIL_BENCH_MODEL_SECONDS": str(model_seconds),
+        "SOILGRIDS_WCS_QUOTA_FILE": os.path.join(workdir, "upstream_quota"),
+        "SOILGRIDS_WCS_RATE": str(upstream_rate),
+        "PYTHONPATH": os.pathsep.join([STUB_MODELS_DIR, REPO_DIR]),
+    })
+    return env
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_rss_mb(pid):
+    """读取进程的常驻内存(MB)，仅支持Linux"""
+    try:
+        with open(f"/proc/{pid}/status", "r") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+def child_pids(pid):
+    """列出直接子进程，仅支持Linux"""
+    children = []
+    for name in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return sorted(children)
+
+
+def memory_report(master_pid):
+    """gunicorn主进程及各工作进程的内存"""
+    workers = {str(pid): process_rss_mb(pid) for pid in child_pids(master_pid)}
+    return {"master_rss_mb": process_rss_mb(master_pid), "worker_rss_mb": workers}
+
+
+def start_gunicorn(env, workdir, workers, port, timeout=60):
+    """
+    按仓库的gunicorn.conf.py启动gunicorn并等待服务可用
+
+    返回:
+    tuple: (进程, 从启动到可用的秒数)
+    """
+    command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(REPO_DIR, "gunicorn.conf.py"),
+               "-w", str(workers), "-b", f"127.0.0.1:{port}", "soil_texture_web_api:app"]
+    start = time.perf_counter()
+    log = open(os.path.join(workdir, "gunicorn.log"), "w")
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn启动失败，日志见{log.name}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/metrics", timeout=1).status_code == 200:
+                return process, time.perf_counter() - start
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"gunicorn未能在{timeout}秒内启动")
+
+
+def bench_http(args, env, workdir, points):
+    """在gunicorn下压测HTTP接口"""
+    port = free_port()
+    process, startup_seconds = start_gunicorn(env, workdir, args.workers, port)
+    base_url = f"http://127.0.0.1:{port}"
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=args.concurrency, pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    rng = random.Random(args.seed + 1)
+    idle_rss = memory_report(process.pid)["worker_rss_mb"]
+
+    endpoints = {
+        "soil_texture": "/api/soil-texture",
+        "soil_hydraulics": "/api/soil-hydraulics",
+    }
+
+    def make_call(path):
+        def call(point):
+            response = session.get(base_url + path, params={"longitude": point[0], "latitude": point[1]},
+                                   timeout=120)
+            return response.status_code == 200 and "error" not in response.json()
+        return call
+
+    results = {"startup_s": round(startup_seconds, 3)}
+    try:
+        for name, path in endpoints.items():
+            call = make_call(path)
+            warm_points = [rng.choice(points) for _ in range(args.requests)]
+            results[name] = {
+                "cold": run_load(call, points, args.concurrency),
+                "warm": run_load(call, warm_points, args.concurrency),
+            }
+        results["memory"] = memory_report(process.pid)
+        results["memory"]["idle_worker_rss_mb"] = idle_rss
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return results
+
+
+def bench_functions(args, env, points):
+    """在进程内测试查询和土壤代码匹配函数"""
+    os.environ.update(env)
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, STUB_MODELS_DIR)
+    import soil_texture_web_api as api
+
+    def query(point):
+        return api.query_soil_property(point[0], point[1], "clay")[2] is not None
+
+    rng = random.Random(args.seed + 2)
+    textures = []
+    for _ in range(args.requests):
+        clay = rng.uniform(0, 60)
+        textures.append((clay, rng.uniform(0, 100 - clay)))
+    soil_data = api.load_soil_data()
+    index = api.get_soil_code_index()
+
+    return {
+        "query_soil_property": {
+            "cold": run_load(query, points, args.concurrency),
+            "warm": run_load(query, [rng.choice(points) for _ in range(args.requests)], args.concurrency),
+        },
+        "find_closest_soil_code": run_load(
+            lambda texture: api.find_closest_soil_code(texture[0], texture[1], soil_data), textures, 1),
+        "soil_code_index_nearest": run_load(
+            lambda texture: index.nearest(texture[0], texture[1]), textures, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="服务压测")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn工作进程数")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求数")
+    parser.add_argument("--requests", type=int, default=400, help="warm阶段每个接口的请求数")
+    parser.add_argument("--distinct", type=int, default=100, help="不同坐标数(cold阶段的请求数)")
+    parser.add_argument("--bbox", type=float, nargs=4, default=[115.0, 30.0, 116.0, 31.0],
+                        metavar=("WEST", "SOUTH", "EAST", "NORTH"), help="坐标范围")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟WCS的平均延迟(秒)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="模拟WCS延迟的标准差(秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟WCS的错误率")
+    parser.add_argument("--model-seconds", type=float, default=0.05, help="替身模型每个模型的耗时(秒)")
+    parser.add_argument("--upstream-rate", type=float, default=0, help="上游配额(每秒请求数)，默认不限速")
+    parser.add_argument("--seed", type=int, default=42, help="随机数种子")
+    parser.add_argument("--skip-http", action="store_true", help="不压测HTTP接口")
+    parser.add_argument("--skip-functions", action="store_true", help="不测试进程内函数")
+    parser.add_argument("--output", help="结果JSON文件，默认输出到标准输出")
+    args = parser.parse_args()
+
+    wcs = FakeWCSServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed).start()
+    points = make_points(args.distinct, args.bbox, args.seed)
+    report = {
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+    }
+
+    workdirs = []
+    try:
+        if not args.skip_http:
+            workdir = tempfile.mkdtemp(prefix="soil_bench_http_")
+            workdirs.append(workdir)
+            write_soil_data(os.path.join(workdir, "soil_data.json"))
+            env = service_env(workdir, wcs.url_template(), args.model_seconds, args.upstream_rate)
+            report["http"] = bench_http(args, env, workdir, points)
+        if not args.skip_functions:
+            workdir = tempfile.mkdtemp(prefix="soil_bench_func_")
+            workdirs.append(workdir)
+            write_soil_data(os.path.join(workdir, "soil_data.json"))
+            report["functions"] = bench_functions(
+                args, service_env(workdir, wcs.url_template(), args.model_seconds, args.upstream_rate), points)
+        report["fake_wcs"] = {"requests": wcs.requests, "errors": wcs.errors}
+    finally:
+        wcs.stop()
+        for workdir in workdirs:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+压测用的soil_moisture_model替身
+
+返回与真实模型结构相同的结果字典，数值由土壤代码确定，不做任何拟合。每个模型的耗时由环境变量
+SOIL_BENCH_MODEL_SECONDS控制(默认0.05秒)，用于模拟模型运行的开销。
+"""
+import os
+import time
+
+MODEL_SCRIPTS = ["DBC.py", "DVC.py", "KBC.py", "PE.py", "VG-Mualem.py", "VGM.py"]
+
+
+def _model_seconds():
+    return float(os.environ.get("SOIL_BENCH_MODEL_SECONDS", 0.05))
+
+
+def _model_output(code, index):
+    """由土壤代码(粘土、粉粒百分比各两位)合成单个模型的结果"""
+    clay, silt = int(code[:2]), int(code[2:])
+    return {
+        "田间持水量": round(0.1 + clay / 300 + index / 200, 4),
+        "萎蔫点": round(0.03 + clay / 400, 4),
+        "饱和含水量": round(0.35 + silt / 1000, 4),
+        "饱和导水率(cm/day)": round(200.0 - clay * 1.5 + index * 10, 2),
+        "范根参数alpha": 0.0296 if index >= 3 else None,
+        "范根参数n": round(1.3 + silt / 100, 3) if index == 5 else None,
+        "有效水分量": round(0.07 + clay / 300 - clay / 400 + index / 200, 4),
+        "R2 q": 0.98,
+        "R2 logK": 0.93,
+    }
+
+
+def run_soil_moisture_models(code):
+    """依次运行全部模型，返回综合结果及各模型结果"""
+    models = {}
+    for index, script in enumerate(MODEL_SCRIPTS):
+        time.sleep(_model_seconds())
+        models[script] = _model_output(code, index)
+
+    summary = {}
+    for key in models[MODEL_SCRIPTS[0]]:
+        if key.startswith("R2"):
+            continue
+        values = [model[key] for model in models.values() if model[key] is not None]
+        summary[key] = sum(values) / len(values) if values else None
+    summary["各模型结果"] = models
+    return summary
@@ -0,0 +1,180 @@
+"""
+离线构建土壤水力特性代理模型
+
+在质地三角形上按--step百分点的网格取节点，每个节点取最近土壤代码的综合水力特性(优先读取水力特性表，
+表中没有时运行全部土壤水分模型)，写入hydraulics_surrogate目录，供Web API批量插值。
+
+构建后在质地三角形内随机取点(不限于数据库中的代码，其中一组取在最近代码切换处附近)，以最近土壤代码的
+run_soil_moisture_models完整结果(即/api/soil-hydraulics的返回值)为参照评估插值误差，精度报告写入meta.json并打印。
+
+用法:
+    python build_hydraulics_surrogate.py [--step 2] [--output hydraulics_surrogate] [--workers 4]
+                                         [--report-sample 200]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from soil_config import load_soil_data, format_code, HYDRAULICS_TABLE_DIR, HYDRAULICS_SURROGATE_DIR
+from hydraulic_models import run_models
+from hydraulics_table import HydraulicsTable
+from soil_code_index import SoilCodeIndex
+from hydraulics_surrogate import (SURROGATE_FIELDS, HydraulicsSurrogate, accuracy_report, grid_nodes,
+                                  write_surrogate)
+
+
+# 每个进程加载一次的水力特性表，未构建时为False
+_hydraulics_table = None
+
+
+def get_hydraulics_table():
+    """加载水力特性表，每个进程只加载一次；未构建时返回None"""
+    global _hydraulics_table
+    if _hydraulics_table is None:
+        try:
+            _hydraulics_table = HydraulicsTable(HYDRAULICS_TABLE_DIR)
+        except FileNotFoundError:
+            _hydraulics_table = False
+    return _hydraulics_table if _hydraulics_table is not False else None
+
+
+def summary_values(result):
+    """综合结果中的代理字段，缺失值为NaN"""
+    return [float("nan") if getattr(result.summary, field) is None else float(getattr(result.summary, field))
+            for field in SURROGATE_FIELDS]
+
+
+def node_values(code):
+    """节点土壤代码的综合水力特性，优先读取水力特性表；失败时返回None"""
+    try:
+        table = get_hydraulics_table()
+        result = table.lookup(code) if table is not None else None
+        if result is None:
+            result = run_models(code)
+        return summary_values(result)
+    except Exception as e:
+        print(f"土壤代码{code}计算水力特性失败: {str(e)}")
+        return None
+
+
+def reference_values(code):
+    """运行完整的土壤水分模型作为精度评估的参照；失败时返回None"""
+    try:
+        return summary_values(run_models(code))
+    except Exception as e:
+        print(f"土壤代码{code}运行模型失败: {str(e)}")
+        return None
+
+
+# 判断是否靠近代码边界时的扰动幅度(百分点): 向四个方向移动后最近代码改变即视为边界附近
+BOUNDARY_OFFSET = 0.5
+
+
+def random_textures(rng, count):
+    """在质地三角形内均匀取点，返回 (clay, silt) 百分比数组"""
+    fractions = rng.dirichlet((1.0, 1.0, 1.0), count) * 100
+    return fractions[:, 0], fractions[:, 1]
+
+
+def boundary_textures(rng, index, count):
+    """
+    取最近土壤代码切换处附近的点
+
+    返回:
+    tuple: (clay, silt) 百分比数组，数量可能少于count
+    """
+    clay, silt = random_textures(rng, count * 20)
+    nearest = index.nearest_indices(clay, silt)
+    boundary = np.zeros(clay.shape, dtype=bool)
+    for d_clay, d_silt in ((BOUNDARY_OFFSET, 0), (-BOUNDARY_OFFSET, 0), (0, BOUNDARY_OFFSET), (0, -BOUNDARY_OFFSET)):
+        boundary |= index.nearest_indices(clay + d_clay, silt + d_silt) != nearest
+    return clay[boundary][:count], silt[boundary][:count]
+
+
+def evaluate(surrogate, index, codes, clay, silt, executor):
+    """
+    在给定质地上比较插值结果与最近土壤代码的完整模型结果
+
+    返回:
+    dict: accuracy_report的结果
+    """
+    nearest = index.nearest_indices(clay, silt)
+    unique = np.unique(nearest[nearest >= 0])
+    values = dict(zip(unique.tolist(), executor.map(reference_values, [codes[i] for i in unique.tolist()])))
+
+    missing = [float("nan")] * len(SURROGATE_FIELDS)
+    table = np.array([values.get(i) or missing for i in nearest.tolist()],
+                     dtype=np.float64).reshape(-1, len(SURROGATE_FIELDS))
+    reference = {field: table[:, column] for column, field in enumerate(SURROGATE_FIELDS)}
+    return accuracy_report(surrogate.interpolate(clay, silt), reference)
+
+
+def print_report(title, accuracy):
+    print(title)
+    print(f"{'字段':<24}{'点数':>6}{'MAE':>12}{'RMSE':>12}{'最大误差':>12}{'相对MAE':>10}")
+    for field, stats in accuracy.items():
+        if not stats["n"]:
+            print(f"{field:<24}{0:>6}")
+            continue
+        relative = f"{stats['relative_mae']:.2%}" if stats["relative_mae"] is not None else "-"
+        print(f"{field:<24}{stats['n']:>6}{stats['mae']:>12.4g}{stats['rmse']:>12.4g}{stats['max_abs']:>12.4g}"
+              f"{relative:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线构建土壤水力特性代理模型")
+    parser.add_argument("--step", type=float, default=2.0, help="网格步长(百分点)，需能整除100")
+    parser.add_argument("--output", default=HYDRAULICS_SURROGATE_DIR, help="输出目录")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="并行进程数")
+    parser.add_argument("--report-sample", type=int, default=200, help="精度评估的随机质地数(代码边界附近另取同样数量)，0为不评估")
+    parser.add_argument("--seed", type=int, default=42, help="抽样随机数种子")
+    args = parser.parse_args()
+
+    if args.step <= 0 or abs(100 / args.step - round(100 / args.step)) > 1e-9:
+        parser.error("--step必须为正数且能整除100")
+
+    start_time = time.time()
+    index = SoilCodeIndex(load_soil_data())
+    codes = [format_code(code) for code in index.codes]
+
+    clay, silt = grid_nodes(args.step)
+    node_codes = index.nearest_indices(clay.ravel(), silt.ravel())
+    unique = np.unique(node_codes)
+    print(f"网格{clay.shape[0]}x{clay.shape[1]}个节点，对应{len(unique)}个土壤代码，使用{args.workers}个进程")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        values = dict(zip(unique.tolist(), executor.map(node_values, [codes[i] for i in unique.tolist()])))
+
+    failed = sum(1 for value in values.values() if value is None)
+    missing = [float("nan")] * len(SURROGATE_FIELDS)
+    table = np.array([values[i] or missing for i in node_codes.tolist()], dtype=np.float64)
+    grids = {field: table[:, column].reshape(clay.shape) for column, field in enumerate(SURROGATE_FIELDS)}
+
+    hydraulics_table = get_hydraulics_table()
+    source = f"hydraulics_table {hydraulics_table.version}" if hydraulics_table is not None else "run_soil_moisture_models"
+    meta = write_surrogate(args.output, args.step, grids, source=source)
+    print(f"代理模型已写入{args.output}，版本{meta['version']}，失败{failed}个代码，耗时{time.time() - start_time:.1f}秒")
+
+    if args.report_sample <= 0:
+        return
+
+    rng = np.random.default_rng(args.seed)
+    samples = {"random": random_textures(rng, args.report_sample),
+               "boundary": boundary_textures(rng, index, args.report_sample)}
+    print(f"在{len(samples['random'][0])}个随机质地和{len(samples['boundary'][0])}个代码边界附近的质地上，"
+          f"以最近土壤代码的完整模型结果评估插值误差")
+
+    surrogate = HydraulicsSurrogate(args.output)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        accuracy = {name: evaluate(surrogate, index, codes, clay, silt, executor)
+                    for name, (clay, silt) in samples.items()}
+
+    write_surrogate(args.output, args.step, grids, accuracy=accuracy, source=source)
+    print_report("随机质地:", accuracy["random"])
+    print_report("代码边界附近:", accuracy["boundary"])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+离线构建土壤水力特性表
+
+对soil_data.json中的每个土壤代码运行全部土壤水分模型，结果写入hydraulics_table目录，
+供Web API启动时内存映射读取。
+
+用法:
+    python build_hydraulics_table.py [--output hydraulics_table] [--workers 4]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from soil_config import load_soil_data, format_code, HYDRAULICS_TABLE_DIR
+from hydraulic_models import run_models
+from hydraulics_table import flatten_results, write_table
+
+
+def run_code(code):
+    """运行单个土壤代码的全部模型，失败时返回空列表"""
+    try:
+        return flatten_results(run_models(code))
+    except Exception as e:
+        print(f"土壤代码{code}运行模型失败: {str(e)}")
+        return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线构建土壤水力特性表")
+    parser.add_argument("--output", default=HYDRAULICS_TABLE_DIR, help="输出目录")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="并行进程数")
+    args = parser.parse_args()
+
+    codes = sorted({format_code(code) for code in load_soil_data().keys()})
+    print(f"共{len(codes)}个土壤代码，使用{args.workers}个进程")
+
+    start_time = time.time()
+    rows = []
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for index, code_rows in enumerate(executor.map(run_code, codes), 1):
+            if not code_rows:
+                failed += 1
+            rows.extend(code_rows)
+            if index % 100 == 0:
+                print(f"已完成 {index}/{len(codes)}")
+
+    meta = write_table(args.output, rows)
+    print(f"水力特性表已写入{args.output}，版本{meta['version']}，"
+          f"{meta['codes']}个代码，失败{failed}个，耗时{time.time() - start_time:.1f}秒")
+
+
+if __name__ == '__main__':
+    main()
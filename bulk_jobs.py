@@ -0,0 +1,294 @@
+"""
+批量查询任务
+
+上传的坐标逐点保存在SQLite数据库中，由有界的后台线程池处理。每个点单独记录状态和结果，
+处理中的点带有租约，服务重启或工作进程退出后，租约过期的点会被重新领取，已完成的点不会重复查询。
+多个gunicorn工作进程共享同一数据库，通过事务原子地领取待处理的点。
+点完成时在同一写事务中分配单调递增的完成序号(completion_seq)，提交顺序与序号一致，结果流按序号分页，
+不会因为各线程提交顺序与完成时间不一致而漏掉结果。
+"""
+import csv
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# 处理中的点的租约时长(秒)，超时未完成视为处理进程已退出
+LEASE_SECONDS = 300
+# 无待处理点时的轮询间隔(秒)
+POLL_INTERVAL = 1.0
+# follow长轮询等待新结果的最长时间(秒)，只短暂占用同步工作进程；到时结束响应，客户端用最后的cursor重新请求
+FOLLOW_MAX_SECONDS = 5.0
+
+FINISHED_STATUSES = ("done", "failed")
+
+
+def parse_points_csv(text, max_points=None):
+    """
+    解析坐标CSV
+
+    每行为 经度,纬度；首行不是数字时视为表头，表头中有longitude/latitude(或lon/lat、经度/纬度)列时按列名读取
+
+    返回:
+    list: [(longitude, latitude), ...]
+    """
+    rows = [row for row in csv.reader(io.StringIO(text)) if row and any(cell.strip() for cell in row)]
+    if not rows:
+        raise ValueError("CSV中没有坐标")
+
+    lon_column, lat_column = 0, 1
+    try:
+        float(rows[0][0])
+    except (ValueError, IndexError):
+        header = [cell.strip().lower() for cell in rows.pop(0)]
+        for names, column in ((("longitude", "lon", "lng", "经度"), "lon"), (("latitude", "lat", "纬度"), "lat")):
+            index = next((header.index(name) for name in names if name in header), None)
+            if index is not None and column == "lon":
+                lon_column = index
+            elif index is not None:
+                lat_column = index
+
+    if max_points is not None and len(rows) > max_points:
+        raise ValueError(f"单个任务最多{max_points}个坐标")
+
+    points = []
+    for line, row in enumerate(rows, 1):
+        try:
+            longitude, latitude = float(row[lon_column]), float(row[lat_column])
+        except (ValueError, IndexError):
+            raise ValueError(f"第{line}行坐标无效: {','.join(row)}")
+        if longitude < -180 or longitude > 180 or latitude < -90 or latitude > 90:
+            raise ValueError(f"第{line}行经纬度超出范围: {','.join(row)}")
+        points.append((longitude, latitude))
+    return points
+
+
+class JobManager(object):
+    """
+    批量任务管理
+
+    参数:
+    path: SQLite数据库文件路径
+    handlers: {任务类型: handler(longitude, latitude, params)}，返回可JSON序列化的结果
+    workers: 每个进程的后台线程数
+    """
+
+    def __init__(self, path, handlers, workers=4):
+        self.path = path
+        self.handlers = handlers
+        self.workers = workers
+        self._local = threading.local()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL, "
+                "total INTEGER NOT NULL, created_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS points ("
+                "job_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+                "longitude REAL NOT NULL, latitude REAL NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', result TEXT, "
+                "lease_until REAL, completed_at REAL, completion_seq INTEGER, "
+                "PRIMARY KEY (job_id, seq))"
+            )
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(points)")]
+                if "completion_seq" not in columns:
+                    # 旧版数据库: 已完成的点按完成时间补齐序号
+                    conn.execute("ALTER TABLE points ADD COLUMN completion_seq INTEGER")
+                    rowids = conn.execute(
+                        "SELECT rowid FROM points WHERE completed_at IS NOT NULL ORDER BY completed_at, rowid"
+                    ).fetchall()
+                    conn.executemany("UPDATE points SET completion_seq = ? WHERE rowid = ?",
+                                     ((number, rowid) for number, (rowid,) in enumerate(rowids, 1)))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_points_status ON points(status, lease_until)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_points_completion ON points(completion_seq)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_points_job_completion ON points(job_id, completion_seq)")
+            self._local.conn = conn
+        return conn
+
+    def create_job(self, kind, points, params=None):
+        """
+        创建任务
+
+        参数:
+        points: [(longitude, latitude), ...]
+
+        返回:
+        str: 任务ID
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"未知任务类型: {kind}")
+
+        job_id = uuid.uuid4().hex
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, params, total, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(params or {}, ensure_ascii=False), len(points), time.time())
+            )
+            conn.executemany(
+                "INSERT INTO points (job_id, seq, longitude, latitude) VALUES (?, ?, ?, ?)",
+                ((job_id, seq, longitude, latitude) for seq, (longitude, latitude) in enumerate(points))
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def get_job(self, job_id):
+        """读取任务信息及进度，任务不存在时返回None"""
+        conn = self._connect()
+        row = conn.execute("SELECT kind, params, total, created_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        kind, params, total, created_at = row
+        counts = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM points WHERE job_id = ? GROUP BY status", (job_id,)
+        ).fetchall())
+        finished = sum(counts.get(status, 0) for status in FINISHED_STATUSES)
+        return {
+            "job_id": job_id,
+            "kind": kind,
+            "params": json.loads(params),
+            "status": "finished" if finished == total else "running",
+            "total": total,
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "pending": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "progress": round(finished / total, 4) if total else 1.0,
+            "created_at": created_at,
+        }
+
+    def _claim(self, limit):
+        """原子地领取待处理或租约已过期的点"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT p.job_id, p.seq, p.longitude, p.latitude, j.kind, j.params "
+                "FROM points p JOIN jobs j ON j.id = p.job_id "
+                "WHERE p.status = 'pending' OR (p.status = 'running' AND p.lease_until < ?) "
+                "ORDER BY j.created_at, p.seq LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE points SET status = 'running', lease_until = ? WHERE job_id = ? AND seq = ?",
+                ((now + LEASE_SECONDS, row[0], row[1]) for row in rows)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _process(self, row):
+        job_id, seq, longitude, latitude, kind, params = row
+        try:
+            result = self.handlers[kind](longitude, latitude, json.loads(params))
+            status, payload = "done", {"result": result}
+        except Exception as e:
+            status, payload = "failed", {"error": str(e)}
+
+        # 完成序号在这条UPDATE的写事务中分配，写事务串行执行，序号顺序即提交顺序；
+        # 租约过期后被重新领取的点只记录第一次完成的结果
+        self._connect().execute(
+            "UPDATE points SET status = ?, result = ?, completed_at = ?, lease_until = NULL, "
+            "completion_seq = (SELECT COALESCE(MAX(completion_seq), 0) + 1 FROM points) "
+            "WHERE job_id = ? AND seq = ? AND status = 'running'",
+            (status, json.dumps(payload, ensure_ascii=False, default=float), time.time(), job_id, seq)
+        )
+
+    def _run(self):
+        """后台调度线程: 按空闲线程数领取点并提交到线程池"""
+        semaphore = threading.BoundedSemaphore(self.workers)
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        def process(row):
+            try:
+                self._process(row)
+            finally:
+                semaphore.release()
+
+        while True:
+            semaphore.acquire()
+            try:
+                rows = self._claim(1)
+            except Exception as e:
+                print(f"领取批量任务时出错: {str(e)}")
+                rows = []
+            if not rows:
+                semaphore.release()
+                time.sleep(POLL_INTERVAL)
+                continue
+            executor.submit(process, rows[0])
+
+    def ensure_started(self):
+        """在当前进程启动后台调度线程(gunicorn fork出的每个工作进程各启动一次)"""
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid != os.getpid():
+                threading.Thread(target=self._run, name="bulk-jobs", daemon=True).start()
+                self._started_pid = os.getpid()
+
+    def iter_results(self, job_id, follow=False, after=0, max_seconds=FOLLOW_MAX_SECONDS):
+        """
+        按完成顺序逐行返回任务结果(NDJSON)，每行的cursor为该点的完成序号
+
+        参数:
+        follow: 为True时作为长轮询: 没有新结果时最多等待max_seconds，返回已有的新结果后即结束
+        after: 只返回cursor大于该值的结果，用于断开后继续读取
+        """
+        conn = self._connect()
+        deadline = time.monotonic() + max_seconds if max_seconds else None
+        returned = False
+        while True:
+            rows = conn.execute(
+                "SELECT seq, longitude, latitude, status, result, completion_seq FROM points "
+                "WHERE job_id = ? AND completion_seq > ? "
+                "ORDER BY completion_seq LIMIT 1000",
+                (job_id, after)
+            ).fetchall()
+
+            for seq, longitude, latitude, status, result, completion_seq in rows:
+                line = {"seq": seq, "longitude": longitude, "latitude": latitude, "status": status}
+                line.update(json.loads(result))
+                line["cursor"] = completion_seq
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+                after = completion_seq
+                returned = True
+
+            if rows:
+                continue
+            job = self.get_job(job_id)
+            if not follow or returned or job is None or job["status"] == "finished":
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            time.sleep(POLL_INTERVAL)
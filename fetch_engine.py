@@ -0,0 +1,161 @@
+"""
+基于asyncio的上游请求并发引擎
+
+所有请求同时发出，受全局和按主机的并发上限约束；整批请求有统一的截止时间，
+单个请求耗时超过该主机近期延迟的指定分位数时，再发出一个相同的对冲请求，取先完成的结果。
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import profiling
+
+# key: 结果键；host: 上游主机(用于并发限制和延迟统计)；
+# call: 无参数的阻塞调用，失败时抛出异常；hedge_call: 对冲请求使用的调用，默认与call相同
+FetchTask = namedtuple("FetchTask", ["key", "host", "call", "hedge_call"])
+FetchTask.__new__.__defaults__ = (None,)
+
+# 每个主机保留的最近延迟样本数
+LATENCY_WINDOW = 200
+
+
+class DeadlineExceeded(Exception):
+    """请求未能在截止时间内完成"""
+
+
+class FetchEngine(object):
+    """
+    上游请求并发引擎
+
+    参数:
+    max_concurrency: 进程内同时执行的请求上限(含对冲请求)
+    per_host: 同一主机同时执行的请求上限
+    deadline: 一批请求的默认截止时间(秒)
+    hedge_percentile: 触发对冲请求的延迟分位数，为0时不发对冲请求
+    hedge_min_samples: 样本数不足时不发对冲请求
+    hedge_min_delay: 对冲请求的最短等待时间(秒)
+    """
+
+    def __init__(self, max_concurrency=16, per_host=8, deadline=25.0, hedge_percentile=95,
+                 hedge_min_samples=20, hedge_min_delay=0.5):
+        self.max_concurrency = max_concurrency
+        self.per_host = per_host
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self._executor = None
+        self._executor_pid = None
+        self._host_slots = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """按进程创建线程池，gunicorn fork出的子进程不复用父进程的线程池"""
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+                self._executor_pid = os.getpid()
+                self._host_slots = {}
+            return self._executor
+
+    def _host_slot(self, host):
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return slot
+
+    def _record_latency(self, host, seconds):
+        with self._lock:
+            samples = self._latencies.get(host)
+            if samples is None:
+                samples = self._latencies[host] = deque(maxlen=LATENCY_WINDOW)
+            samples.append(seconds)
+
+    def hedge_delay(self, host):
+        """
+        计算对冲请求的等待时间
+
+        返回:
+        float: 该主机近期延迟的hedge_percentile分位数，样本不足或未启用对冲时返回None
+        """
+        if not self.hedge_percentile:
+            return None
+        with self._lock:
+            samples = sorted(self._latencies.get(host, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        index = int(round(self.hedge_percentile / 100.0 * (len(samples) - 1)))
+        return max(self.hedge_min_delay, samples[index])
+
+    def _attempt(self, host, call):
+        """在工作线程中执行一次请求并记录延迟"""
+        with profiling.attribute_thread(), self._host_slot(host):
+            start = time.monotonic()
+            result = call()
+            self._record_latency(host, time.monotonic() - start)
+            return result
+
+    def _submit(self, loop, executor, host, call):
+        """提交到线程池，调用在发起方的上下文(contextvars)中执行"""
+        return loop.run_in_executor(executor, contextvars.copy_context().run, self._attempt, host, call)
+
+    async def _run_task(self, task):
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        primary = self._submit(loop, executor, task.host, task.call)
+
+        delay = self.hedge_delay(task.host)
+        if delay is None:
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        metrics.inc("soil_upstream_hedges_total", {"host": task.host})
+        hedge = self._submit(loop, executor, task.host, task.hedge_call or task.call)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _run_all(self, tasks, deadline):
+        futures = {asyncio.ensure_future(self._run_task(task)): task for task in tasks}
+        done, pending = await asyncio.wait(futures, timeout=deadline)
+
+        outcomes = {}
+        for future in done:
+            error = future.exception()
+            outcomes[futures[future].key] = error if error is not None else future.result()
+        for future in pending:
+            future.cancel()
+            metrics.inc("soil_upstream_deadline_exceeded_total", {"host": futures[future].host})
+            outcomes[futures[future].key] = DeadlineExceeded(f"超过截止时间{deadline}秒")
+        return outcomes
+
+    def run(self, tasks, deadline=None):
+        """
+        并发执行一批请求
+
+        参数:
+        tasks: FetchTask列表
+        deadline: 截止时间(秒)，默认使用引擎配置
+
+        返回:
+        dict: key -> 结果；失败或超时的请求对应异常对象
+        """
+        if not tasks:
+            return {}
+        return asyncio.run(self._run_all(tasks, self.deadline if deadline is None else deadline))
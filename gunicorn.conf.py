@@ -0,0 +1,64 @@
+"""
+gunicorn配置
+
+    gunicorn -c gunicorn.conf.py soil_texture_web_api:app
+
+主进程预加载应用(preload_app)并调用warm_up加载土壤代码索引、水力特性表等只读数据，随后冻结垃圾回收
+跟踪的对象(gc.freeze)，fork出的工作进程以写时复制方式共享这些内存页，启动后无需各自加载。
+每个工作进程fork后立即启动批量任务后台线程，不必等到收到第一个请求。
+
+环境变量:
+    SOIL_BIND                   监听地址，默认0.0.0.0:5000
+    SOIL_WORKERS                工作进程数，默认4
+    SOIL_WORKER_RSS_BUDGET_MB   工作进程常驻内存上限(MB)，超过时处理完当前请求后平滑重启该进程，默认不限制
+"""
+import gc
+import os
+import time
+
+bind = os.environ.get("SOIL_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("SOIL_WORKERS", 4))
+timeout = 120
+preload_app = True
+
+WORKER_RSS_BUDGET_MB = float(os.environ.get("SOIL_WORKER_RSS_BUDGET_MB", 0))
+# 每处理多少个请求检查一次常驻内存
+RSS_CHECK_EVERY = 50
+
+_config_loaded_at = time.perf_counter()
+
+
+def when_ready(server):
+    """主进程加载应用后、fork工作进程前执行预热"""
+    from soil_texture_web_api import warm_up
+
+    timings = warm_up()
+    gc.collect()
+    gc.freeze()
+    server.log.info("预热完成: %s，启动共耗时%.2f秒",
+                    ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()),
+                    time.perf_counter() - _config_loaded_at)
+
+
+def post_fork(server, worker):
+    """在工作进程中启动批量任务后台线程，服务重启后未完成的任务无需等待请求即可继续"""
+    from soil_texture_web_api import job_manager
+
+    job_manager.ensure_started()
+
+
+def post_request(worker, req, environ, resp):
+    """常驻内存超过上限时让工作进程在当前请求后退出，由主进程重新fork"""
+    if not WORKER_RSS_BUDGET_MB:
+        return
+    worker.soil_request_count = getattr(worker, "soil_request_count", 0) + 1
+    if worker.soil_request_count % RSS_CHECK_EVERY:
+        return
+
+    from metrics import process_rss_bytes
+
+    rss_mb = process_rss_bytes() / 1024 / 1024
+    if rss_mb > WORKER_RSS_BUDGET_MB:
+        worker.log.warning("工作进程%s常驻内存%.0fMB超过上限%.0fMB，处理完当前请求后重启",
+                           worker.pid, rss_mb, WORKER_RSS_BUDGET_MB)
+        worker.alive = False
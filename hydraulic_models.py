@@ -0,0 +1,312 @@
+"""
+土壤水分模型的结构化接口
+
+在进程内调用soil_moisture_model，把结果转换为带类型的结果对象(每个模型一个ModelResult)，
+包括拟合优度(R2 q、R2 logK)。结果可直接缓存、批量处理，并在需要时转换为接口的中英文结构。
+
+模型集合在进程池中运行: soil_moisture_model只提供run_soil_moisture_models，一次调用内各模型串行拟合，
+进程池使不同土壤代码的请求并行、超时的拟合不阻塞请求线程。
+"""
+import importlib
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# 土壤水分模型
+MODEL_NAMES = ("DBC", "DVC", "KBC", "PE", "VG-Mualem", "VGM")
+
+# (字段名, 模型输出中的中文键)，字段名同时用作英文接口的键
+HYDRAULIC_FIELDS = [
+    ("field_capacity", "田间持水量"),
+    ("wilting_point", "萎蔫点"),
+    ("saturated_water_content", "饱和含水量"),
+    ("Ks", "饱和导水率(cm/day)"),
+    ("alpha", "范根参数alpha"),
+    ("n", "范根参数n"),
+    ("available_water", "有效水分量"),
+]
+
+# (字段名, 模型输出中的键)，兼容空格和下划线两种写法
+FIT_QUALITY_FIELDS = [
+    ("r2_q", ("R2 q", "R2_q")),
+    ("r2_logk", ("R2 logK", "R2_logK")),
+]
+
+MODEL_RESULTS_KEY = "各模型结果"
+FIT_QUALITY_KEY = "拟合优度"
+
+# 提供run_soil_moisture_models的模型包，首次运行模型时才导入
+MODEL_PACKAGE = "soil_moisture_model"
+
+ModelResult = namedtuple(
+    "ModelResult",
+    ["model"] + [field for field, _ in HYDRAULIC_FIELDS] + [field for field, _ in FIT_QUALITY_FIELDS]
+)
+ModelResult.__doc__ = "单个模型(或综合结果，model为空字符串)的水力参数及拟合优度"
+
+
+class HydraulicsResult(namedtuple("HydraulicsResult", ["code", "summary", "models", "errors"])):
+    """
+    土壤代码的综合水力特性(summary)、各模型结果(models: 模型名 -> ModelResult)
+    及未完成的模型(errors: 模型名 -> 错误信息)
+    """
+    __slots__ = ()
+
+    def __new__(cls, code, summary, models, errors=None):
+        # errors默认为新建的空字典，各结果之间不共享
+        return super(HydraulicsResult, cls).__new__(cls, code, summary, models, {} if errors is None else errors)
+
+
+def model_package():
+    """导入土壤水分模型包(只在首次运行模型时导入，不拖慢服务启动)"""
+    return importlib.import_module(MODEL_PACKAGE)
+
+
+def _to_float(value):
+    """转换为float，缺失或无法转换时返回None"""
+    if value is None:
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if value != value else value
+
+
+def normalize_model_name(name):
+    """统一模型名称，去掉脚本后缀(如DBC.py -> DBC)"""
+    return name[:-3] if name.endswith(".py") else name
+
+
+def model_output_key(name):
+    """模型在接口结果各模型结果中的键，与run_soil_moisture_models一致(如DBC -> DBC.py)"""
+    return f"{name}.py"
+
+
+def parse_model_result(model, data):
+    """由模型输出字典构造ModelResult"""
+    data = data or {}
+    fit_quality = data.get(FIT_QUALITY_KEY) or {}
+    values = {field: _to_float(data.get(key)) for field, key in HYDRAULIC_FIELDS}
+    for field, keys in FIT_QUALITY_FIELDS:
+        values[field] = next((_to_float(source[key]) for source in (data, fit_quality)
+                              for key in keys if key in source), None)
+    return ModelResult(model=model, **values)
+
+
+def parse_model_output(code, hydraulic_properties):
+    """
+    把run_soil_moisture_models的结果字典转换为HydraulicsResult
+
+    返回:
+    HydraulicsResult，输入为None时返回None
+    """
+    if hydraulic_properties is None:
+        return None
+    models = {}
+    for name, data in (hydraulic_properties.get(MODEL_RESULTS_KEY) or {}).items():
+        name = normalize_model_name(name)
+        models[name] = parse_model_result(name, data)
+    return HydraulicsResult(code=code, summary=parse_model_result("", hydraulic_properties), models=models)
+
+
+def _model_to_cn(result):
+    data = {key: getattr(result, field) for field, key in HYDRAULIC_FIELDS}
+    data[FIT_QUALITY_KEY] = {keys[0]: getattr(result, field) for field, keys in FIT_QUALITY_FIELDS}
+    return data
+
+
+def _model_to_en(result):
+    data = {field: getattr(result, field) for field, _ in HYDRAULIC_FIELDS}
+    data["fit_quality"] = {field: getattr(result, field) for field, _ in FIT_QUALITY_FIELDS}
+    return data
+
+
+def result_to_cn(result):
+    """转换为中文结构(与run_soil_moisture_models的结果字典一致)，也用作缓存的序列化格式"""
+    data = {key: getattr(result.summary, field) for field, key in HYDRAULIC_FIELDS}
+    data[MODEL_RESULTS_KEY] = {model_output_key(name): _model_to_cn(model) for name, model in result.models.items()}
+    return data
+
+
+def result_to_en(result):
+    """转换为英文结构"""
+    data = {field: getattr(result.summary, field) for field, _ in HYDRAULIC_FIELDS}
+    data["model_results"] = {model_output_key(name): _model_to_en(model) for name, model in result.models.items()}
+    return data
+
+
+def run_models(code):
+    """
+    在进程内运行土壤代码的全部土壤水分模型
+
+    返回:
+    HydraulicsResult
+    """
+    hydraulic_properties = model_package().run_soil_moisture_models(code)
+    if hydraulic_properties is None:
+        raise ValueError("模型返回了空值 (None)")
+    return parse_model_output(code, hydraulic_properties)
+
+
+def resolve_models(models):
+    """
+    校验并规范化模型列表(不区分大小写)
+
+    返回:
+    tuple: 按MODEL_NAMES顺序排列的模型名，models为空时返回全部模型
+    """
+    if not models:
+        return MODEL_NAMES
+    lookup = {name.lower(): name for name in MODEL_NAMES}
+    unknown = [model for model in models if model.strip().lower() not in lookup]
+    if unknown:
+        raise ValueError(f"未知模型: {', '.join(unknown)}，可选模型: {', '.join(MODEL_NAMES)}")
+    selected = {lookup[model.strip().lower()] for model in models}
+    return tuple(name for name in MODEL_NAMES if name in selected)
+
+
+def summarize(code, models, errors=None):
+    """
+    由部分模型结果计算综合结果，各字段取有值模型的平均值
+
+    返回:
+    HydraulicsResult
+    """
+    values = {}
+    for field, _ in HYDRAULIC_FIELDS:
+        field_values = [getattr(model, field) for model in models.values() if getattr(model, field) is not None]
+        values[field] = sum(field_values) / len(field_values) if field_values else None
+    summary = ModelResult(model="", r2_q=None, r2_logk=None, **values)
+    return HydraulicsResult(code=code, summary=summary, models=models, errors=errors or {})
+
+
+def select_models(result, models):
+    """
+    只保留指定模型的结果，未选择全部模型时重新计算综合结果
+
+    参数:
+    models: resolve_models返回的模型名
+    """
+    if tuple(models) == MODEL_NAMES:
+        return result
+    selected = {name: result.models[name] for name in models if name in result.models}
+    errors = {name: result.errors.get(name, "模型未返回结果") for name in models if name not in result.models}
+    return summarize(result.code, selected, errors)
+
+
+# 模型进程池的启动方式: gunicorn工作进程是多线程的，fork可能复制其他线程持有的锁，默认使用forkserver
+MODEL_POOL_START_METHOD = os.environ.get(
+    "SOIL_MODEL_POOL_START_METHOD",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+# 有模型超时的进程池停止接收任务后，等待其余任务完成的最长时间(秒)，之后终止全部工作进程
+POOL_RETIRE_GRACE = 120.0
+
+
+class ModelPool(object):
+    """
+    模型进程池，记录未完成的任务
+
+    运行中的模型无法取消，超时的模型会一直占用工作进程；此时调用retire退役整个进程池，
+    新请求改用新的进程池
+    """
+
+    def __init__(self, size):
+        context = multiprocessing.get_context(MODEL_POOL_START_METHOD)
+        if MODEL_POOL_START_METHOD == "forkserver":
+            # forkserver预先导入模型包，工作进程不必各自导入
+            context.set_forkserver_preload([__name__, MODEL_PACKAGE])
+        self.executor = ProcessPoolExecutor(max_workers=size, mp_context=context)
+        self.pending = set()
+        self.retired = False
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        future = self.executor.submit(fn, *args)
+        with self._lock:
+            self.pending.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self.pending.discard(future)
+
+    def retire(self, hung=()):
+        """
+        停止接收新任务，等其余任务完成(最多POOL_RETIRE_GRACE秒)后终止全部工作进程
+
+        参数:
+        hung: 已超时的任务，不等待
+        """
+        hung = set(hung)
+        with self._lock:
+            if self.retired:
+                return
+            self.retired = True
+            others = [future for future in self.pending if future not in hung]
+
+        def reap():
+            wait(others, timeout=POOL_RETIRE_GRACE)
+            # ProcessPoolExecutor没有公开终止工作进程的接口
+            for process in list((self.executor._processes or {}).values()):
+                process.terminate()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+        threading.Thread(target=reap, name="model-pool-reaper", daemon=True).start()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_model_pool():
+    """获取当前进程的模型进程池；gunicorn fork出的子进程、进程池已退役或损坏时重新创建"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid() or _pool.retired:
+            _pool = ModelPool(int(os.environ.get("SOIL_MODEL_POOL_SIZE", len(MODEL_NAMES))))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _submit(fn, *args):
+    """提交到模型进程池，进程池已损坏(工作进程异常退出)时退役并重建后重试一次"""
+    pool = get_model_pool()
+    try:
+        return pool, pool.submit(fn, *args)
+    except (BrokenProcessPool, RuntimeError):
+        pool.retire()
+        pool = get_model_pool()
+        return pool, pool.submit(fn, *args)
+
+
+def run_models_in_pool(code, models=None, timeout=60.0):
+    """
+    在进程池中运行全部模型(run_soil_moisture_models)，再筛选所需模型
+
+    全部模型在一次调用内串行拟合，models只影响返回的模型及综合值，不减少计算量；
+    超时或进程异常退出时所选模型均记录在errors中。超时时退役当前进程池，避免仍在运行的拟合长期占用工作进程。
+
+    参数:
+    models: 需要的模型名，默认全部
+    timeout: 整个模型集合的超时时间(秒)
+
+    返回:
+    HydraulicsResult
+    """
+    models = resolve_models(models)
+    pool, future = _submit(run_models, code)
+    try:
+        return select_models(future.result(timeout=timeout), models)
+    except FutureTimeoutError:
+        pool.retire(hung=[future])
+        return summarize(code, {}, {name: f"超过{timeout}秒未完成" for name in models})
+    except BrokenProcessPool as e:
+        pool.retire()
+        return summarize(code, {}, {name: f"模型进程异常退出: {str(e)}" for name in models})
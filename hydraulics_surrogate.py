@@ -0,0 +1,180 @@
+"""
+土壤水力特性代理模型
+
+离线在质地三角形上按粘土、粉粒百分比的规则网格计算各节点的综合水力特性(节点取最近的土壤代码，
+由水力特性表或土壤水分模型得到)，查询时对任意质地做双线性插值。全部计算为NumPy数组运算，
+质地连续变化时结果也连续，不会在土壤代码边界处跳变。
+
+目录结构:
+    {field}.npy  二维float64数组，[粘土节点序号, 粉粒节点序号]，缺失值为NaN
+    meta.json    版本、网格步长、字段及精度报告等元数据
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+# 插值的水力参数，与ModelResult的字段一致
+SURROGATE_FIELDS = ["field_capacity", "wilting_point", "saturated_water_content", "Ks", "alpha", "n",
+                    "available_water"]
+# 跨数量级变化的参数在对数空间插值
+LOG_FIELDS = ("Ks", "alpha")
+
+# 粘土与粉粒之和超过100%的容差(百分点)
+SUM_TOLERANCE = 1e-6
+
+
+def grid_nodes(step):
+    """
+    网格节点
+
+    质地三角形外(粘土+粉粒>100)的节点取同一粘土含量下粉粒最多的有效质地，保证斜边附近的插值有完整的四个角点
+
+    返回:
+    tuple: (clay, silt)，二维数组，[粘土节点序号, 粉粒节点序号]
+    """
+    values = np.arange(0, 100 + step / 2.0, step, dtype=np.float64)
+    clay, silt = np.meshgrid(values, values, indexing="ij")
+    return clay, np.minimum(silt, 100 - clay)
+
+
+def write_surrogate(directory, step, grids, accuracy=None, source=None):
+    """
+    写入代理模型目录
+
+    参数:
+    grids: {字段: 二维数组}
+    accuracy: {评估点集(如random、boundary): accuracy_report的结果}
+    source: 节点数据来源说明(如水力特性表版本)
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha1(str(step).encode("utf-8"))
+    for field in SURROGATE_FIELDS:
+        array = np.ascontiguousarray(grids[field], dtype=np.float64)
+        np.save(os.path.join(directory, f"{field}.npy"), array)
+        digest.update(field.encode("utf-8"))
+        digest.update(array.tobytes())
+
+    meta = {
+        "version": digest.hexdigest()[:16],
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "step": step,
+        "fields": SURROGATE_FIELDS,
+        "source": source,
+        "accuracy": accuracy,
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        json.dump(meta, file, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(directory, "meta.json"))
+    return meta
+
+
+def accuracy_report(predicted, reference):
+    """
+    比较代理模型与完整模型的结果
+
+    参数:
+    predicted, reference: {字段: 一维数组}，同一组质地的代理模型结果和完整模型结果
+
+    返回:
+    dict: {字段: {n, mae, rmse, max_abs, relative_mae}}，只统计两者均有值的点
+    """
+    report = {}
+    for field in SURROGATE_FIELDS:
+        pred = np.asarray(predicted[field], dtype=np.float64)
+        ref = np.asarray(reference[field], dtype=np.float64)
+        mask = np.isfinite(pred) & np.isfinite(ref)
+        if not mask.any():
+            report[field] = {"n": 0}
+            continue
+        error = pred[mask] - ref[mask]
+        scale = float(np.mean(np.abs(ref[mask])))
+        report[field] = {
+            "n": int(mask.sum()),
+            "mae": float(np.mean(np.abs(error))),
+            "rmse": float(np.sqrt(np.mean(error ** 2))),
+            "max_abs": float(np.max(np.abs(error))),
+            "relative_mae": float(np.mean(np.abs(error)) / scale) if scale else None,
+        }
+    return report
+
+
+class HydraulicsSurrogate(object):
+    """
+    质地三角形上的水力特性插值
+
+    参数:
+    directory: write_surrogate写出的目录
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as file:
+            self.meta = json.load(file)
+        self.version = self.meta.get("version")
+        self.step = float(self.meta["step"])
+
+        # 网格很小(步长1%时约1万个节点)，直接读入内存；对数字段预先取对数，非正值视为缺失
+        self.grids = {}
+        for field in SURROGATE_FIELDS:
+            grid = np.load(os.path.join(directory, f"{field}.npy"))
+            if field in LOG_FIELDS:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    grid = np.where(grid > 0, np.log(grid), np.nan)
+            self.grids[field] = np.ascontiguousarray(grid.ravel())
+        self.size = int(round(100 / self.step)) + 1
+        self.complete = {field: not np.isnan(grid).any() for field, grid in self.grids.items()}
+
+    def interpolate(self, clay_percent, silt_percent, fields=None):
+        """
+        按粘土、粉粒百分比双线性插值水力参数
+
+        角点缺失时按其余角点的权重归一化；质地无效(负值、NaN或粘土与粉粒之和超过100)的点结果为NaN
+
+        参数:
+        clay_percent, silt_percent: 一维数组
+        fields: 需要的字段，默认全部
+
+        返回:
+        dict: {字段: float64数组}
+        """
+        clay = np.asarray(clay_percent, dtype=np.float64)
+        silt = np.asarray(silt_percent, dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            invalid = ~((clay >= 0) & (silt >= 0) & (clay + silt <= 100 + SUM_TOLERANCE))
+
+        last = self.size - 1
+        x = np.clip(np.nan_to_num(clay) / self.step, 0, last)
+        y = np.clip(np.nan_to_num(silt) / self.step, 0, last)
+        i0 = np.minimum(x.astype(np.intp), last - 1)
+        j0 = np.minimum(y.astype(np.intp), last - 1)
+        fx, fy = x - i0, y - j0
+
+        base = i0 * self.size + j0
+        corners = (base, base + self.size, base + 1, base + self.size + 1)
+        weights = ((1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy)
+
+        results = {}
+        for field in fields or SURROGATE_FIELDS:
+            grid = self.grids[field]
+            if self.complete[field]:
+                value = sum(grid[index] * weight for index, weight in zip(corners, weights))
+            else:
+                total = np.zeros_like(fx)
+                weight_sum = np.zeros_like(fx)
+                for index, weight in zip(corners, weights):
+                    corner = grid[index]
+                    present = ~np.isnan(corner)
+                    total += np.where(present, corner, 0.0) * weight
+                    weight_sum += np.where(present, weight, 0.0)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    value = total / weight_sum
+            if field in LOG_FIELDS:
+                value = np.exp(value)
+            value[invalid] = np.nan
+            results[field] = value
+        return results
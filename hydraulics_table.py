@@ -0,0 +1,140 @@
+"""
+预计算的土壤水力特性表
+
+离线对每个土壤代码运行全部土壤水分模型，结果按列保存为.npy文件；服务启动后以内存映射方式读取，
+水力特性查询变为一次表查找。
+
+目录结构:
+    code.npy    土壤代码(S4)，按代码、模型排序
+    model.npy   模型名称(S32)，空字符串表示综合结果
+    {field}.npy 各水力参数及拟合优度(float64)，缺失值为NaN
+    meta.json   版本、模型列表等元数据
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from hydraulic_models import ModelResult, HydraulicsResult
+
+# 表中的数值列，与ModelResult的字段一致
+TABLE_FIELDS = [field for field in ModelResult._fields if field != "model"]
+
+SUMMARY_MODEL = ""
+
+
+def _to_float(value):
+    """None转换为NaN"""
+    return float('nan') if value is None else float(value)
+
+
+def _to_value(value):
+    """把表中的float转换回Python值，NaN转换为None"""
+    value = float(value)
+    return None if value != value else value
+
+
+def flatten_results(result):
+    """
+    把HydraulicsResult展开为表的行
+
+    返回:
+    list: [(code, model, {列名: 值}), ...]，第一行为综合结果
+    """
+    models = [result.summary] + [model._replace(model=name) for name, model in result.models.items()]
+    return [(result.code, model.model, {field: _to_float(getattr(model, field)) for field in TABLE_FIELDS})
+            for model in models]
+
+
+def write_table(directory, rows):
+    """
+    把展开后的行写入表目录
+
+    参数:
+    rows: flatten_results返回的行
+    """
+    rows = sorted(rows, key=lambda row: (row[0], row[1]))
+    os.makedirs(directory, exist_ok=True)
+
+    columns = {
+        "code": np.array([row[0] for row in rows], dtype="S4"),
+        "model": np.array([row[1] for row in rows], dtype="S32"),
+    }
+    for column in TABLE_FIELDS:
+        columns[column] = np.array([row[2][column] for row in rows], dtype=np.float64)
+
+    digest = hashlib.sha1()
+    for name, array in columns.items():
+        np.save(os.path.join(directory, f"{name}.npy"), array)
+        digest.update(name.encode("utf-8"))
+        digest.update(array.tobytes())
+
+    meta = {
+        "version": digest.hexdigest()[:16],
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "codes": int(len(set(columns["code"].tolist()))),
+        "models": sorted({row[1] for row in rows if row[1] != SUMMARY_MODEL}),
+        "fields": TABLE_FIELDS,
+    }
+    with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as file:
+        json.dump(meta, file, ensure_ascii=False, indent=2)
+    return meta
+
+
+class HydraulicsTable(object):
+    """
+    内存映射的水力特性表
+
+    参数:
+    directory: write_table写出的表目录
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as file:
+            self.meta = json.load(file)
+        self.version = self.meta.get("version")
+
+        self.code = np.load(os.path.join(directory, "code.npy"), mmap_mode="r")
+        self.model = np.load(os.path.join(directory, "model.npy"), mmap_mode="r")
+        self.columns = {column: np.load(os.path.join(directory, f"{column}.npy"), mmap_mode="r")
+                        for column in TABLE_FIELDS}
+
+    def __len__(self):
+        return len(self.code)
+
+    def rows_for(self, code):
+        """返回土壤代码对应的行范围 (start, stop)"""
+        key = code.encode("ascii")
+        start = int(np.searchsorted(self.code, key, side="left"))
+        stop = int(np.searchsorted(self.code, key, side="right"))
+        return start, stop
+
+    def lookup(self, code):
+        """
+        查询土壤代码的水力特性
+
+        返回:
+        HydraulicsResult，表中没有该代码时返回None
+        """
+        start, stop = self.rows_for(code)
+        if start == stop:
+            return None
+
+        summary = None
+        models = {}
+        for row in range(start, stop):
+            model = ModelResult(
+                model=self.model[row].decode("utf-8"),
+                **{column: _to_value(self.columns[column][row]) for column in TABLE_FIELDS}
+            )
+            if model.model == SUMMARY_MODEL:
+                summary = model
+            else:
+                models[model.model] = model
+
+        if summary is None:
+            return None
+        return HydraulicsResult(code=code, summary=summary, models=models)
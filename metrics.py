@@ -0,0 +1,291 @@
+"""
+服务指标
+
+进程内记录计数器、仪表和直方图，以Prometheus文本格式输出；各阶段耗时同时累计到当前请求，
+用于生成Server-Timing响应头。
+
+设置SOIL_METRICS_DIR时，各工作进程定期把指标快照写入该目录，/metrics合并所有进程的快照
+(已退出进程的仪表不计入)，任一工作进程都能返回全服务的指标。
+"""
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get("SOIL_METRICS_DIR")
+# 快照写入的最短间隔(秒)
+FLUSH_INTERVAL = 5.0
+
+# 延迟直方图的桶上界(秒)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 指标名 -> (类型, 说明)
+METRICS = {
+    "soil_stage_seconds": ("histogram", "各处理阶段耗时(秒)，按阶段和coverage_id区分"),
+    "soil_request_seconds": ("histogram", "请求处理耗时(秒)"),
+    "soil_requests_total": ("counter", "请求数，按端点和状态码区分"),
+    "soil_requests_in_flight": ("gauge", "正在处理的请求数"),
+    "soil_upstream_requests_total": ("counter", "WCS上游请求数，按coverage_id和结果区分"),
+    "soil_upstream_in_flight": ("gauge", "正在进行的WCS上游请求数"),
+    "soil_upstream_hedges_total": ("counter", "发出的对冲请求数"),
+    "soil_upstream_deadline_exceeded_total": ("counter", "超过截止时间的上游请求数"),
+    "soil_upstream_throttled_total": ("counter", "上游限流次数，按优先级和原因(429、5xx状态码或queue等待超时)区分"),
+    "soil_upstream_batched_tiles_total": ("counter", "合并到共享窗口下载中的瓦片数"),
+    "soil_cache_requests_total": ("counter", "缓存查询数，按缓存、类型和结果(hit、stale、miss)区分"),
+    "soil_cache_hit_ratio": ("gauge", "缓存命中率(hit与stale之和占全部查询的比例)"),
+    "soil_models_in_flight": ("gauge", "正在运行的土壤水分模型任务数"),
+    "soil_process_rss_bytes": ("gauge", "各进程的常驻内存(字节)"),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_last_flush = 0.0
+
+# 当前请求各阶段的累计耗时 {阶段: 秒}
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def inc(name, labels=None, value=1):
+    """计数器加value"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge_add(name, value, labels=None):
+    """仪表加value(可为负数)"""
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + value
+
+
+def observe(name, seconds, labels=None):
+    """在直方图中记录一次耗时"""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+        buckets = histogram[0]
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                buckets[index] += 1
+                break
+        else:
+            buckets[-1] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+@contextmanager
+def in_flight(name, labels=None):
+    """执行期间仪表加1"""
+    gauge_add(name, 1, labels)
+    try:
+        yield
+    finally:
+        gauge_add(name, -1, labels)
+
+
+@contextmanager
+def stage(name, coverage_id=""):
+    """
+    记录一个处理阶段的耗时
+
+    耗时写入soil_stage_seconds直方图，并累计到当前请求的Server-Timing
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe("soil_stage_seconds", seconds, {"stage": name, "coverage_id": coverage_id})
+        timings = _request_timings.get()
+        if timings is not None:
+            with _lock:
+                timings[name] = timings.get(name, 0.0) + seconds
+
+
+def start_request():
+    """开始记录当前请求的阶段耗时"""
+    _request_timings.set({})
+
+
+def server_timing(total=None):
+    """
+    生成当前请求的Server-Timing响应头
+
+    并行执行的阶段(如多个下载)耗时相加，可能超过总耗时
+
+    参数:
+    total: 请求总耗时(秒)
+    """
+    timings = dict(_request_timings.get() or {})
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def record_cache(cache, kind, result):
+    """记录一次缓存查询，result为hit、stale或miss"""
+    inc("soil_cache_requests_total", {"cache": cache, "kind": kind, "result": result})
+
+
+def process_rss_bytes():
+    """当前进程的常驻内存(字节)，Linux读取/proc，其他平台返回峰值常驻内存"""
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _snapshot():
+    rss_key = _key("soil_process_rss_bytes", {"pid": str(os.getpid())})
+    rss = process_rss_bytes()
+    with _lock:
+        _gauges[rss_key] = rss
+        return {
+            "pid": os.getpid(),
+            "counters": [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            "gauges": [[name, list(labels), value] for (name, labels), value in _gauges.items()],
+            "histograms": [[name, list(labels), list(h[0]), h[1], h[2]] for (name, labels), h in _histograms.items()],
+        }
+
+
+def flush(force=False):
+    """把当前进程的指标快照写入METRICS_DIR，未设置目录或距上次写入不足FLUSH_INTERVAL时跳过"""
+    global _last_flush
+    if not METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        return
+    _last_flush = now
+
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        json.dump(_snapshot(), file)
+    os.replace(tmp_path, os.path.join(METRICS_DIR, f"{os.getpid()}.json"))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load_snapshots():
+    """读取所有进程的快照，未设置METRICS_DIR时只返回当前进程"""
+    if not METRICS_DIR:
+        return [_snapshot()]
+
+    flush(force=True)
+    snapshots = []
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name), "r", encoding="utf-8") as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge(snapshots):
+    counters, gauges, histograms = {}, {}, {}
+    for snapshot in snapshots:
+        alive = snapshot["pid"] == os.getpid() or _pid_alive(snapshot["pid"])
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(tuple(item) for item in labels))
+            counters[key] = counters.get(key, 0) + value
+        if alive:
+            for name, labels, value in snapshot["gauges"]:
+                key = (name, tuple(tuple(item) for item in labels))
+                gauges[key] = gauges.get(key, 0) + value
+        for name, labels, buckets, total, count in snapshot["histograms"]:
+            key = (name, tuple(tuple(item) for item in labels))
+            merged = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+            merged[1] += total
+            merged[2] += count
+    return counters, gauges, histograms
+
+
+def _hit_ratios(counters):
+    """由缓存查询计数计算命中率"""
+    totals, hits = {}, {}
+    for (name, labels), value in counters.items():
+        if name != "soil_cache_requests_total":
+            continue
+        labels = dict(labels)
+        key = (("cache", labels["cache"]), ("kind", labels["kind"]))
+        totals[key] = totals.get(key, 0) + value
+        if labels["result"] != "miss":
+            hits[key] = hits.get(key, 0) + value
+    return {("soil_cache_hit_ratio", key): hits.get(key, 0) / total for key, total in totals.items() if total}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    以Prometheus文本格式输出指标
+
+    返回:
+    str
+    """
+    counters, gauges, histograms = _merge(_load_snapshots())
+    gauges.update(_hit_ratios(counters))
+
+    samples = {}
+    for values in (counters, gauges):
+        for (name, labels), value in values.items():
+            samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    for (name, labels), (buckets, total, count) in histograms.items():
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, bucket in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+            cumulative += bucket
+            le = bound if bound == "+Inf" else repr(bound)
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    output = []
+    for name, (metric_type, description) in METRICS.items():
+        if name not in samples:
+            continue
+        output.append(f"# HELP {name} {description}")
+        output.append(f"# TYPE {name} {metric_type}")
+        output.extend(sorted(samples[name]) if metric_type != "histogram" else samples[name])
+    return "\n".join(output) + "\n"
@@ -0,0 +1,125 @@
+"""
+离线预取区域质地数据包
+
+按块下载指定区域内各深度层的粘土、砂粒、粉粒coverage，写入texture_packs目录下的内存映射数据包，
+Web API启动时加载，区域内的质地查询不再访问上游。下载限速并带重试，中断后重新执行同一命令
+只下载尚未完成的块。
+
+用法:
+    python prefetch_region.py --bbox 114.5 30 115.5 31 --name wuhan [--depths 0-5cm 5-15cm]
+                              [--rate 2] [--concurrency 4]
+"""
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from soil_config import TEXTURE_DEPTHS, TEXTURE_PACK_DIR
+from query_planner import TEXTURE_SERVICES
+from texture_pack import MANIFEST_FILE, TexturePack, region_pixels
+from upstream_scheduler import BULK, lane
+from wcs_client import fetch_coverage
+
+
+class RateLimiter(object):
+    """限制每秒发出的请求数，多个下载线程共享"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def fetch_chunk(pack, coverage_index, cy, cx, limiter, retries):
+    """下载一个块，失败时按指数退避重试"""
+    coverage_id = pack.coverage_ids[coverage_index]
+    service_id = pack.manifest["services"][coverage_id]
+    (row0, row1, col0, col1), (west, south, east, north) = pack.chunk_window(cy, cx)
+
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            # 与Web服务共享上游配额，以bulk优先级让行交互查询
+            with lane(BULK):
+                return fetch_coverage(service_id, coverage_id, west, south, east, north, col1 - col0, row1 - row0)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = 2 ** attempt
+            print(f"下载{coverage_id}块({cy},{cx})失败: {str(e)}，{delay}秒后重试")
+            time.sleep(delay)
+
+
+def open_pack(directory, bbox, coverages):
+    """打开已有数据包继续下载，不存在时新建；已有数据包的范围或coverage不同时退出"""
+    if not os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+        return TexturePack.create(directory, *bbox, coverages)
+
+    pack = TexturePack(directory, writable=True)
+    if list(region_pixels(*bbox)) != pack.manifest["pixels"] or \
+            [coverage_id for _, coverage_id in coverages] != pack.coverage_ids:
+        raise SystemExit(f"{directory}中已有范围或coverage不同的数据包，请使用其他--name或删除该目录")
+    return pack
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线预取区域质地数据包")
+    parser.add_argument("--bbox", type=float, nargs=4, required=True, metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+                        help="区域范围(度)")
+    parser.add_argument("--name", required=True, help="数据包名称(输出目录下的子目录名)")
+    parser.add_argument("--depths", nargs="+", default=TEXTURE_DEPTHS, choices=TEXTURE_DEPTHS, help="深度层")
+    parser.add_argument("--properties", nargs="+", default=list(TEXTURE_SERVICES), choices=TEXTURE_SERVICES,
+                        help="质地组分")
+    parser.add_argument("--stat", default="mean", help="统计量")
+    parser.add_argument("--output", default=TEXTURE_PACK_DIR, help="数据包根目录")
+    parser.add_argument("--rate", type=float, default=2.0, help="每秒最多请求数，0为不限")
+    parser.add_argument("--concurrency", type=int, default=4, help="并发下载数")
+    parser.add_argument("--retries", type=int, default=3, help="每块失败重试次数")
+    args = parser.parse_args()
+
+    west, south, east, north = args.bbox
+    if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+        parser.error("--bbox范围无效")
+
+    coverages = [(service_id, f"{service_id}_{depth}_{args.stat}")
+                 for service_id in args.properties for depth in args.depths]
+    directory = os.path.join(args.output, args.name)
+    pack = open_pack(directory, args.bbox, coverages)
+
+    pending = pack.pending_chunks()
+    total = pack.chunks.size
+    print(f"数据包{directory}: 范围{pack.manifest['bounds']}，{len(pack.coverage_ids)}个coverage，"
+          f"共{total}块，待下载{len(pending)}块")
+
+    start_time = time.time()
+    limiter = RateLimiter(args.rate)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(fetch_chunk, pack, *chunk, limiter, args.retries): chunk for chunk in pending}
+        for index, future in enumerate(as_completed(futures), 1):
+            coverage_index, cy, cx = futures[future]
+            try:
+                array, unit = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"下载{pack.coverage_ids[coverage_index]}块({cy},{cx})失败，已跳过: {str(e)}")
+                continue
+            pack.write_chunk(coverage_index, cy, cx, array, unit)
+            if index % 10 == 0 or index == len(pending):
+                print(f"已完成 {index}/{len(pending)}")
+
+    print(f"预取结束，失败{failed}块，耗时{time.time() - start_time:.1f}秒"
+          + ("，重新执行同一命令可继续下载" if failed else ""))
+
+
+if __name__ == '__main__':
+    main()
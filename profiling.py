@@ -0,0 +1,322 @@
+"""
+请求剖析
+
+按请求剖析: 请求带profile=sample或profile=cprofile参数，并在X-Admin-Token头中给出SOIL_ADMIN_TOKEN时，
+剖析该请求(含序列化)，结果保存到SOIL_PROFILE_DIR，文件名通过X-Profile响应头返回。
+    sample   每PROFILE_SAMPLE_INTERVAL秒采样处理该请求的线程，以及正在为该请求执行任务的线程池线程
+             (fetch_engine、批量查询线程池，通过attribute_thread登记)的调用栈，其他请求、批量任务和后台刷新
+             线程不计入；输出折叠栈(collapsed stacks)，可直接用flamegraph.pl、speedscope等生成火焰图
+    cprofile 用cProfile记录处理请求的线程，输出pstats文件(snakeviz、flameprof等可读取)；同一进程同时只能
+             有一个cProfile剖析
+在进程池中运行的土壤水分模型不在采样范围内，只体现为等待结果的时间。
+
+持续采样: 每个工作进程的后台线程以SOIL_PROFILE_SAMPLE_INTERVAL秒(默认0.1，为0时关闭)的间隔采样调用栈，
+累计为折叠栈并定期写入SOIL_PROFILE_DIR，/debug/stacks合并所有存活进程的结果。
+"""
+import contextvars
+import cProfile
+import hmac
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+ADMIN_TOKEN = os.environ.get("SOIL_ADMIN_TOKEN")
+PROFILE_DIR = os.environ.get("SOIL_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "soil_api_profiles"))
+PROFILE_MODES = ("sample", "cprofile")
+
+# 按请求采样的间隔(秒)
+PROFILE_SAMPLE_INTERVAL = 0.005
+# 持续采样的间隔(秒)，为0时不启动
+CONTINUOUS_SAMPLE_INTERVAL = float(os.environ.get("SOIL_PROFILE_SAMPLE_INTERVAL", 0.1))
+# 持续采样结果写入文件的间隔(秒)
+CONTINUOUS_FLUSH_INTERVAL = 60.0
+
+# 调用栈最多保留的层数(保留最内层)及不同调用栈的数量上限，超过时计入"(other)"
+MAX_STACK_DEPTH = 64
+MAX_STACKS = 10000
+
+# 空闲线程(线程池等待任务、批量任务轮询、服务器等待连接)的栈顶函数，采样时跳过
+IDLE_FRAMES = {
+    ("thread.py", "_worker"),
+    ("bulk_jobs.py", "_run"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+    ("socketserver.py", "serve_forever"),
+}
+
+_PROFILE_NAME = re.compile(r"^[\w.-]+\.(folded|prof)$")
+
+
+# 当前请求的剖析，线程池任务通过contextvars.copy_context()继承
+_current_profile = contextvars.ContextVar("request_profile", default=None)
+# 线程ident -> 该线程正在为之工作的剖析
+_thread_profiles = {}
+_thread_profiles_lock = threading.Lock()
+
+
+@contextmanager
+def attribute_thread():
+    """
+    把当前线程在执行期间归属到上下文中的请求剖析
+
+    在线程池任务中调用(任务需在提交方的上下文中运行)，当前请求未剖析时不做任何事
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    ident = threading.get_ident()
+    with _thread_profiles_lock:
+        previous = _thread_profiles.get(ident)
+        _thread_profiles[ident] = profile
+    try:
+        yield
+    finally:
+        with _thread_profiles_lock:
+            if previous is None:
+                _thread_profiles.pop(ident, None)
+            else:
+                _thread_profiles[ident] = previous
+
+
+class ProfilerBusy(Exception):
+    """已有cProfile剖析在进行"""
+
+
+def authorized(token):
+    """校验管理员令牌，未配置SOIL_ADMIN_TOKEN时一律拒绝"""
+    if not ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    """把调用栈转为折叠栈格式(由外到内，以分号分隔)"""
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def _idle(frame):
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+
+def format_folded(counts):
+    """折叠栈文本，每行为 "调用栈 次数"，按次数降序"""
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+def parse_folded(text):
+    counts = Counter()
+    for line in text.splitlines():
+        stack, _, count = line.rpartition(" ")
+        if stack and count.isdigit():
+            counts[stack] += int(count)
+    return counts
+
+
+class StackSampler(object):
+    """
+    定时采样进程内全部线程的调用栈
+
+    参数:
+    interval: 采样间隔(秒)
+    on_tick: 每次采样后调用，用于定期写入结果
+    threads: 返回需要采样的线程ident集合的函数，这些线程空闲时也计入(等待上游的时间也需要体现)；
+             为None时采样全部非空闲线程
+    """
+
+    def __init__(self, interval, on_tick=None, threads=None):
+        self.interval = interval
+        self.on_tick = on_tick
+        self.threads = threads
+        self.counts = Counter()
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        own = threading.get_ident()
+        frames = sys._current_frames().items()
+        if self.threads is not None:
+            selected = self.threads()
+            stacks = [collapse(frame) for ident, frame in frames if ident != own and ident in selected]
+        else:
+            stacks = [collapse(frame) for ident, frame in frames if ident != own and not _idle(frame)]
+        with self._lock:
+            self.samples += 1
+            for stack in stacks:
+                if len(self.counts) >= MAX_STACKS and stack not in self.counts:
+                    stack = "(other)"
+                self.counts[stack] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if self.on_tick is not None:
+                self.on_tick()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.counts)
+
+
+_cprofile_lock = threading.Lock()
+
+
+class RequestProfile(object):
+    """
+    单个请求的剖析
+
+    参数:
+    mode: sample或cprofile
+    name: 结果文件名前缀(如端点名)
+    """
+
+    def __init__(self, mode, name):
+        self.mode = mode
+        self.name = name
+        self.start_time = time.time()
+        if mode == "cprofile":
+            if not _cprofile_lock.acquire(blocking=False):
+                raise ProfilerBusy("已有cProfile剖析在进行，请稍后重试或使用profile=sample")
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.thread = threading.get_ident()
+            self.profiler = StackSampler(PROFILE_SAMPLE_INTERVAL, threads=self._threads).start()
+        _current_profile.set(self)
+
+    def _threads(self):
+        """处理请求的线程及正在为该请求工作的线程池线程"""
+        with _thread_profiles_lock:
+            return {self.thread} | {ident for ident, profile in _thread_profiles.items() if profile is self}
+
+    def stop(self):
+        """
+        结束剖析并保存结果
+
+        返回:
+        str: 结果文件名(位于PROFILE_DIR)
+        """
+        _current_profile.set(None)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.localtime(self.start_time))
+        prefix = f"{stamp}-{self.name}-{uuid.uuid4().hex[:8]}"
+        if self.mode == "cprofile":
+            try:
+                self.profiler.disable()
+                filename = f"{prefix}.prof"
+                self.profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+            finally:
+                _cprofile_lock.release()
+        else:
+            self.profiler.stop()
+            filename = f"{prefix}.folded"
+            with open(os.path.join(PROFILE_DIR, filename), "w", encoding="utf-8") as file:
+                file.write(format_folded(self.profiler.snapshot()))
+        return filename
+
+
+def profile_path(filename):
+    """剖析结果文件的路径，文件名不合法或文件不存在时返回None"""
+    if not _PROFILE_NAME.match(filename):
+        return None
+    path = os.path.join(PROFILE_DIR, filename)
+    return path if os.path.isfile(path) else None
+
+
+_continuous = None
+_continuous_pid = None
+_continuous_lock = threading.Lock()
+_last_flush = 0.0
+
+
+def _continuous_path(pid):
+    return os.path.join(PROFILE_DIR, f"continuous-{pid}.folded")
+
+
+def _flush_continuous(force=False):
+    """把当前进程的持续采样结果写入PROFILE_DIR"""
+    global _last_flush
+    now = time.monotonic()
+    if _continuous is None or (not force and now - _last_flush < CONTINUOUS_FLUSH_INTERVAL):
+        return
+    _last_flush = now
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=PROFILE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        file.write(format_folded(_continuous.snapshot()))
+    os.replace(tmp_path, _continuous_path(os.getpid()))
+
+
+def ensure_continuous_sampler():
+    """在当前进程启动持续采样线程(每个进程一次，fork出的子进程重新启动)"""
+    global _continuous, _continuous_pid
+    if not CONTINUOUS_SAMPLE_INTERVAL or _continuous_pid == os.getpid():
+        return
+    with _continuous_lock:
+        if _continuous_pid != os.getpid():
+            _continuous = StackSampler(CONTINUOUS_SAMPLE_INTERVAL, on_tick=_flush_continuous).start()
+            _continuous_pid = os.getpid()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def continuous_stacks():
+    """
+    合并所有存活进程的持续采样结果
+
+    返回:
+    str: 折叠栈文本
+    """
+    if _continuous_pid == os.getpid():
+        _flush_continuous(force=True)
+    counts = Counter()
+    if os.path.isdir(PROFILE_DIR):
+        for name in os.listdir(PROFILE_DIR):
+            match = re.match(r"^continuous-(\d+)\.folded$", name)
+            if not match or not _pid_alive(int(match.group(1))):
+                continue
+            try:
+                with open(os.path.join(PROFILE_DIR, name), "r", encoding="utf-8") as file:
+                    counts.update(parse_folded(file.read()))
+            except OSError:
+                continue
+    return format_folded(counts)
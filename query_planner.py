@@ -0,0 +1,77 @@
+"""
+查询规划
+
+根据接口实际需要的深度层，推导出最少的coverage请求集合。
+"""
+
+# 质地三组分
+TEXTURE_SERVICES = ("clay", "sand", "silt")
+# SoilGrids中三组分含量之和(g/kg)
+FRACTION_TOTAL = 1000
+# 可由另外两个组分推导的组分
+DERIVED_SERVICE = "silt"
+
+
+def plan_texture_queries(depths, derive_fraction=False):
+    """
+    规划质地查询所需的coverage请求
+
+    参数:
+    depths: 需要的深度层列表
+    derive_fraction: 为True时只请求粘土和砂粒，粉粒由两者推导
+
+    返回:
+    list: [(service_id, depth), ...]
+    """
+    services = [service for service in TEXTURE_SERVICES
+                if not (derive_fraction and service == DERIVED_SERVICE)]
+    return [(service, depth) for service in services for depth in depths]
+
+
+def derive_fractions(values, depths):
+    """
+    由粘土和砂粒推导粉粒含量
+
+    推导结果落在0到FRACTION_TOTAL之间时写入values；粘土或砂粒缺失、推导结果不合理时，
+    返回仍需向上游请求的粉粒coverage
+
+    参数:
+    values: {(service_id, depth): value}，原地更新
+
+    返回:
+    list: 仍需请求的 [(service_id, depth), ...]
+    """
+    fallback = []
+    for depth in depths:
+        if (DERIVED_SERVICE, depth) in values:
+            continue
+
+        clay = values.get(("clay", depth))
+        sand = values.get(("sand", depth))
+        if clay is not None and sand is not None:
+            derived = FRACTION_TOTAL - float(clay) - float(sand)
+            if 0 <= derived <= FRACTION_TOTAL:
+                values[(DERIVED_SERVICE, depth)] = derived
+                continue
+
+        fallback.append((DERIVED_SERVICE, depth))
+    return fallback
+
+
+# 剖面查询可选的属性、深度层和统计量(SoilGrids 2.0；ocs只有0-30cm一层，不参与剖面查询)
+PROFILE_SERVICES = ("bdod", "cec", "cfvo", "clay", "nitrogen", "phh2o", "sand", "silt", "soc", "ocd")
+PROFILE_DEPTHS = ("0-5cm", "5-15cm", "15-30cm", "30-60cm", "60-100cm", "100-200cm")
+PROFILE_STATS = ("mean", "Q0.05", "Q0.5", "Q0.95", "uncertainty")
+
+
+def plan_profile_queries(services, depths, stats):
+    """
+    规划剖面查询所需的coverage请求
+
+    重复的属性、深度或统计量只请求一次，顺序按首次出现
+
+    返回:
+    list: [(service_id, depth, stat), ...]
+    """
+    services, depths, stats = (list(dict.fromkeys(values)) for values in (services, depths, stats))
+    return [(service, depth, stat) for service in services for stat in stats for depth in depths]
@@ -0,0 +1,292 @@
+"""
+SoilGrids栅格窗口的本地持久化存储
+
+每次从SoilGrids下载的栅格都按coverage_id和网格对齐的瓦片保存为.npy文件，
+读取后保存在进程内的LRU缓存中，瓦片内的任意坐标都可直接在本地查询，无需再次请求上游。
+瓦片很小(约200字节)，读取后即关闭文件，不会随瓦片数量占用文件描述符。
+"""
+import os
+import json
+import functools
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# 瓦片网格: 每个瓦片覆盖 TILE_DEGREES x TILE_DEGREES 度，由 TILE_PIXELS x TILE_PIXELS 个像元组成
+TILE_DEGREES = 0.02
+TILE_PIXELS = 10
+PIXEL_DEGREES = TILE_DEGREES / TILE_PIXELS
+
+# 每个进程内存中最多缓存的瓦片数量(每个瓦片约200字节)
+MAX_CACHED_TILES = 16384
+
+
+def pixel_index(longitude, latitude):
+    """
+    计算经纬度所在像元的全局索引
+
+    返回:
+    tuple: (px, py)，px自西经180度向东计数，py自南纬90度向北计数
+    """
+    # 先四舍五入再取整，避免0.002这类步长带来的浮点误差
+    px = math.floor(round((longitude + 180.0) / PIXEL_DEGREES, 6))
+    py = math.floor(round((latitude + 90.0) / PIXEL_DEGREES, 6))
+    return px, py
+
+
+def pixel_indices(longitudes, latitudes):
+    """pixel_index的向量化版本，输入输出均为NumPy数组"""
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    px = np.floor(np.round((longitudes + 180.0) / PIXEL_DEGREES, 6)).astype(np.int64)
+    py = np.floor(np.round((latitudes + 90.0) / PIXEL_DEGREES, 6)).astype(np.int64)
+    return px, py
+
+
+def tile_index(longitude, latitude):
+    """计算经纬度所在瓦片的索引 (ix, iy)"""
+    px, py = pixel_index(longitude, latitude)
+    return px // TILE_PIXELS, py // TILE_PIXELS
+
+
+def tile_bounds(ix, iy):
+    """返回瓦片的地理范围 (west, south, east, north)"""
+    west = -180.0 + ix * TILE_DEGREES
+    south = -90.0 + iy * TILE_DEGREES
+    return west, south, west + TILE_DEGREES, south + TILE_DEGREES
+
+
+def pixel_in_tile(longitude, latitude):
+    """
+    计算经纬度在其瓦片内的行列号
+
+    返回:
+    tuple: (ix, iy, row, col)，行号自北向南计数，与GeoTIFF的行顺序一致
+    """
+    px, py = pixel_index(longitude, latitude)
+    ix, iy = px // TILE_PIXELS, py // TILE_PIXELS
+    row = TILE_PIXELS - 1 - (py % TILE_PIXELS)
+    col = px % TILE_PIXELS
+    return ix, iy, row, col
+
+
+class RasterWindowStore(object):
+    """
+    按coverage_id和瓦片组织的栅格存储
+
+    目录结构: {root}/{coverage_id}/{ix}/{iy}.npy，单位等元数据保存在
+    {root}/{coverage_id}/meta.json。写入先落临时文件再原子替换，
+    因此多个gunicorn工作进程可以安全地共享同一目录。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._tiles = OrderedDict()
+        self._units = {}
+        self._lock = threading.Lock()
+
+    def _coverage_dir(self, coverage_id):
+        return os.path.join(self.root, coverage_id)
+
+    def _tile_path(self, coverage_id, ix, iy):
+        return os.path.join(self._coverage_dir(coverage_id), str(ix), f"{iy}.npy")
+
+    def get_unit(self, coverage_id):
+        """读取coverage的单位，未知时返回None"""
+        if coverage_id in self._units:
+            return self._units[coverage_id]
+        meta_path = os.path.join(self._coverage_dir(coverage_id), 'meta.json')
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as file:
+                unit = json.load(file).get('unit')
+        except (OSError, ValueError):
+            return None
+        self._units[coverage_id] = unit
+        return unit
+
+    def get_tile(self, coverage_id, ix, iy):
+        """
+        读取瓦片，不存在时返回None
+
+        文件损坏时视为不存在(重新下载后覆盖)；其他读取错误(如文件描述符耗尽)直接抛出，
+        不当作未命中，避免已保存的瓦片被反复向上游请求
+        """
+        key = (coverage_id, ix, iy)
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                return tile
+
+        path = self._tile_path(coverage_id, ix, iy)
+        try:
+            with open(path, 'rb') as file:
+                tile = np.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        tile.setflags(write=False)
+
+        with self._lock:
+            self._tiles[key] = tile
+            if len(self._tiles) > MAX_CACHED_TILES:
+                self._tiles.popitem(last=False)
+        return tile
+
+    def put_tile(self, coverage_id, ix, iy, array, unit=None):
+        """保存一个瓦片的像元数组"""
+        array = np.ascontiguousarray(array)
+        if array.shape != (TILE_PIXELS, TILE_PIXELS):
+            raise ValueError(f"瓦片尺寸应为{TILE_PIXELS}x{TILE_PIXELS}，实际为{array.shape}")
+
+        path = self._tile_path(coverage_id, ix, iy)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as file:
+            np.save(file, array)
+        os.replace(temp_path, path)
+
+        if unit is not None and self.get_unit(coverage_id) is None:
+            meta_path = os.path.join(self._coverage_dir(coverage_id), 'meta.json')
+            temp_meta = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_meta, 'w', encoding='utf-8') as file:
+                json.dump({'unit': unit}, file, ensure_ascii=False)
+            os.replace(temp_meta, meta_path)
+            self._units[coverage_id] = unit
+
+        with self._lock:
+            self._tiles.pop((coverage_id, ix, iy), None)
+
+    def read(self, coverage_id, longitude, latitude):
+        """
+        从本地存储查询单个像元
+
+        返回:
+        tuple: (value, unit)，瓦片未下载时返回None
+        """
+        ix, iy, row, col = pixel_in_tile(longitude, latitude)
+        tile = self.get_tile(coverage_id, ix, iy)
+        if tile is None:
+            return None
+        return tile[row, col], self.get_unit(coverage_id)
+
+    def fetch_tile(self, coverage_id, ix, iy, fetch):
+        """
+        下载并保存一个瓦片
+
+        参数:
+        fetch: 下载函数，签名为 fetch(west, south, east, north, width, height)，
+               返回 (二维数组, 单位)，数组行顺序自北向南
+
+        返回:
+        瓦片像元数组
+        """
+        west, south, east, north = tile_bounds(ix, iy)
+        array, unit = fetch(west, south, east, north, TILE_PIXELS, TILE_PIXELS)
+        self.put_tile(coverage_id, ix, iy, array, unit)
+        return array
+
+    def read_through(self, coverage_id, longitude, latitude, fetch):
+        """
+        查询单个像元，本地没有时下载整个瓦片并保存
+
+        参数:
+        fetch: 下载函数，签名同fetch_tile
+        """
+        cached = self.read(coverage_id, longitude, latitude)
+        if cached is not None:
+            return cached
+
+        ix, iy, row, col = pixel_in_tile(longitude, latitude)
+        tile = self.fetch_tile(coverage_id, ix, iy, fetch)
+        return tile[row, col], self.get_unit(coverage_id)
+
+    def put_window(self, coverage_id, ix0, iy0, array, unit=None):
+        """
+        将由多个瓦片组成的窗口拆分保存
+
+        参数:
+        ix0, iy0: 窗口西南角瓦片的索引
+        array: 窗口像元数组，行顺序自北向南，尺寸为瓦片尺寸的整数倍
+        """
+        height, width = array.shape
+        ny, nx = height // TILE_PIXELS, width // TILE_PIXELS
+        for j in range(ny):
+            # 数组第一行对应最北侧的瓦片
+            iy = iy0 + ny - 1 - j
+            for i in range(nx):
+                tile = array[j * TILE_PIXELS:(j + 1) * TILE_PIXELS,
+                             i * TILE_PIXELS:(i + 1) * TILE_PIXELS]
+                self.put_tile(coverage_id, ix0 + i, iy, tile, unit)
+
+    def read_window(self, coverage_id, ix0, iy0, nx, ny):
+        """
+        由本地瓦片拼接窗口
+
+        返回:
+        tuple: (窗口像元数组, unit)，行顺序自北向南；任一瓦片未下载时返回None
+        """
+        rows = []
+        for iy in range(iy0 + ny - 1, iy0 - 1, -1):
+            row = []
+            for ix in range(ix0, ix0 + nx):
+                tile = self.get_tile(coverage_id, ix, iy)
+                if tile is None:
+                    return None
+                row.append(tile)
+            rows.append(np.hstack(row))
+        return np.vstack(rows), self.get_unit(coverage_id)
+
+    def fetch_window(self, coverage_id, ix0, iy0, nx, ny, fetch):
+        """
+        下载由 nx x ny 个瓦片组成的窗口并拆分保存
+
+        返回:
+        tuple: (窗口像元数组, unit)
+        """
+        west, south = tile_bounds(ix0, iy0)[:2]
+        east, north = tile_bounds(ix0 + nx - 1, iy0 + ny - 1)[2:]
+        array, unit = fetch(west, south, east, north, nx * TILE_PIXELS, ny * TILE_PIXELS)
+        self.put_window(coverage_id, ix0, iy0, array, unit)
+        return array, unit
+
+    def sample_points(self, coverage_id, longitudes, latitudes, fetch, coalesce=None):
+        """
+        批量查询一组相邻坐标的像元值
+
+        所需瓦片均已在本地时直接读取；否则一次下载覆盖全部坐标的窗口，
+        拆分保存为瓦片后按像元索引向量化取值。
+
+        参数:
+        fetch: 下载函数，签名同fetch_tile
+        coalesce: 合并相同窗口下载的函数，签名同SingleFlight.do(key, fn, recheck)，默认不合并
+
+        返回:
+        tuple: (values数组, unit)
+        """
+        px, py = pixel_indices(longitudes, latitudes)
+        ix, iy = px // TILE_PIXELS, py // TILE_PIXELS
+
+        needed = set(zip(ix.tolist(), iy.tolist()))
+        tiles = {key: self.get_tile(coverage_id, *key) for key in needed}
+        if all(tile is not None for tile in tiles.values()):
+            rows = TILE_PIXELS - 1 - (py % TILE_PIXELS)
+            cols = px % TILE_PIXELS
+            values = np.array([tiles[(i, j)][r, c] for i, j, r, c
+                               in zip(ix.tolist(), iy.tolist(), rows.tolist(), cols.tolist())])
+            return values, self.get_unit(coverage_id)
+
+        ix0, ix1 = int(ix.min()), int(ix.max())
+        iy0, iy1 = int(iy.min()), int(iy.max())
+        nx, ny = ix1 - ix0 + 1, iy1 - iy0 + 1
+        download = functools.partial(self.fetch_window, coverage_id, ix0, iy0, nx, ny, fetch)
+        if coalesce is None:
+            array, unit = download()
+        else:
+            array, unit = coalesce(f"window:{coverage_id}:{ix0}:{iy0}:{nx}:{ny}", download,
+                                   recheck=functools.partial(self.read_window, coverage_id, ix0, iy0, nx, ny))
+
+        rows = (iy1 + 1) * TILE_PIXELS - 1 - py
+        cols = px - ix0 * TILE_PIXELS
+        return array[rows, cols], unit
@@ -0,0 +1,202 @@
+"""
+响应编码与内容协商
+
+根据Accept选择JSON、MessagePack或Arrow IPC编码，根据Accept-Encoding对较大的响应做gzip/brotli压缩。
+orjson、msgpack、pyarrow、brotli均为可选依赖，未安装时对应格式不可用(JSON退回标准库json)。
+"""
+import gzip
+import json
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/msgpack"
+ARROW_TYPE = "application/vnd.apache.arrow.stream"
+
+# 请求参数format的取值与媒体类型
+FORMAT_TYPES = {
+    "json": JSON_TYPE,
+    "msgpack": MSGPACK_TYPE,
+    "arrow": ARROW_TYPE,
+}
+# Accept中的别名
+TYPE_ALIASES = {
+    "application/x-msgpack": MSGPACK_TYPE,
+    "application/vnd.msgpack": MSGPACK_TYPE,
+    "application/vnd.apache.arrow.file": ARROW_TYPE,
+}
+
+# 超过该字节数的响应才压缩
+COMPRESS_MIN_BYTES = 4096
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 5
+
+# 中英文结果的顶层键
+LANGUAGE_KEYS = {
+    "zh": "中文数据",
+    "en": "英文数据",
+}
+
+
+def select_language(result, lang=None):
+    """
+    只保留一种语言的结果
+
+    参数:
+    result: 含"中文数据"和"英文数据"的结果字典；其他结构(如错误信息)原样返回
+    lang: zh、en，为空时保留两种语言
+
+    返回:
+    dict: 对应语言的结果
+    """
+    if not lang:
+        return result
+    if lang not in LANGUAGE_KEYS:
+        raise ValueError(f"lang参数只能为{'、'.join(LANGUAGE_KEYS)}")
+    key = LANGUAGE_KEYS[lang]
+    return result[key] if isinstance(result, dict) and key in result else result
+
+
+def _default(value):
+    """把numpy类型转换为Python内置类型"""
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"无法序列化的类型: {type(value).__name__}")
+
+
+def _nan_to_none(value):
+    """递归把NaN转换为None(MessagePack和Arrow中以空值表示)"""
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, dict):
+        return {key: _nan_to_none(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_nan_to_none(item) for item in value]
+    return value
+
+
+def available_types():
+    """当前环境可用的媒体类型"""
+    types = [JSON_TYPE]
+    if msgpack is not None:
+        types.append(MSGPACK_TYPE)
+    try:
+        import pyarrow  # noqa: F401
+        types.append(ARROW_TYPE)
+    except ImportError:
+        pass
+    return types
+
+
+def negotiate(accept_mimetypes, format_name=None):
+    """
+    选择响应的媒体类型
+
+    参数:
+    accept_mimetypes: 请求的Accept(werkzeug的MIMEAccept)
+    format_name: 请求参数format，优先于Accept
+
+    返回:
+    str: 媒体类型
+    """
+    types = available_types()
+    if format_name:
+        media_type = FORMAT_TYPES.get(format_name)
+        if media_type is None:
+            raise ValueError(f"format参数只能为{'、'.join(FORMAT_TYPES)}")
+        if media_type not in types:
+            raise ValueError(f"当前服务未安装{format_name}编码所需的依赖")
+        return media_type
+
+    best, best_quality = JSON_TYPE, 0
+    for value, quality in accept_mimetypes:
+        value = TYPE_ALIASES.get(value, value)
+        if value in types and quality > best_quality:
+            best, best_quality = value, quality
+    return best
+
+
+def encode_json(data):
+    """编码为UTF-8 JSON，安装orjson时使用orjson"""
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, default=_default, separators=(",", ":")).encode("utf-8")
+
+
+def encode_msgpack(data):
+    """编码为MessagePack"""
+    return msgpack.packb(_nan_to_none(data), default=_default, use_bin_type=True)
+
+
+def encode_arrow(data):
+    """
+    编码为Arrow IPC流
+
+    列表的每个元素为一行，单个字典为一行；嵌套字典和列表编码为struct和list列
+    """
+    import pyarrow as pa
+
+    rows = data if isinstance(data, list) else [data]
+    table = pa.Table.from_pylist(_nan_to_none(rows))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+ENCODERS = {
+    JSON_TYPE: encode_json,
+    MSGPACK_TYPE: encode_msgpack,
+    ARROW_TYPE: encode_arrow,
+}
+
+
+def compress(body, accept_encodings):
+    """
+    按Accept-Encoding压缩响应体，小于COMPRESS_MIN_BYTES时不压缩
+
+    参数:
+    accept_encodings: 请求的Accept-Encoding(werkzeug的Accept)
+
+    返回:
+    tuple: (压缩后的数据, Content-Encoding或None)
+    """
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    if brotli is not None and accept_encodings["br"]:
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if accept_encodings["gzip"]:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+    return body, None
+
+
+def encode_response(data, media_type, accept_encodings):
+    """
+    编码并压缩响应
+
+    参数:
+    media_type: negotiate选择的媒体类型
+
+    返回:
+    tuple: (响应体, Content-Encoding或None)
+    """
+    return compress(ENCODERS[media_type](data), accept_encodings)
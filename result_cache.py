@@ -0,0 +1,176 @@
+"""
+基于SQLite的查询结果缓存
+
+多个gunicorn工作进程共享同一个数据库文件，支持容量上限(LRU淘汰)、过期时间(TTL)，
+以及过期后在后台刷新、期间继续返回旧结果(stale-while-revalidate)。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+# 后台刷新期间，其他进程把该条目视为新鲜的时长(秒)
+REFRESH_GRACE_SECONDS = 60
+# 每写入多少次检查一次容量上限
+EVICT_EVERY = 100
+# 命中时距上次记录的访问时间超过该时长(秒)才更新last_access；更新需要获取数据库的写锁，
+# 每次命中都更新会让所有工作进程的读取在写锁上排队。LRU淘汰只需要这一精度
+ACCESS_UPDATE_SECONDS = 60
+
+
+def _json_default(obj):
+    """序列化NumPy标量等非标准JSON类型"""
+    if hasattr(obj, 'item'):
+        return obj.item()
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError(f"无法序列化类型: {type(obj).__name__}")
+
+
+class ResultCache(object):
+    """
+    查询结果缓存
+
+    参数:
+    path: SQLite数据库文件路径
+    max_entries: 最大条目数，超出后淘汰最久未访问的条目
+    ttl: 条目保持新鲜的时长(秒)
+    stale_ttl: 过期后仍可返回旧结果的时长(秒)
+    """
+
+    def __init__(self, path, max_entries=100000, ttl=30 * 24 * 3600, stale_ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._local = threading.local()
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        self._writes = 0
+
+    def _connect(self):
+        """每个线程使用独立的数据库连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_results_access ON results(last_access)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        """
+        读取缓存条目
+
+        返回:
+        tuple: (value, fresh)，fresh为False表示条目已过期但仍在可用期内；
+               条目不存在或已彻底过期时返回None
+        """
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT value, expires_at, last_access FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        value, expires_at, last_access = row
+        now = time.time()
+        if now > expires_at + self.stale_ttl:
+            return None
+
+        if now - last_access > ACCESS_UPDATE_SECONDS:
+            conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+        return json.loads(value), now <= expires_at
+
+    def set(self, key, value):
+        """写入缓存条目"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO results (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False, default=_json_default), now + self.ttl, now)
+        )
+
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """淘汰超出容量上限的最久未访问条目"""
+        conn = self._connect()
+        count = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM results WHERE key IN ("
+                "SELECT key FROM results ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def _claim_refresh(self, key):
+        """
+        申请刷新过期条目
+
+        通过条件更新把过期时间推迟REFRESH_GRACE_SECONDS，只有更新成功的进程负责刷新
+        """
+        conn = self._connect()
+        now = time.time()
+        cursor = conn.execute(
+            "UPDATE results SET expires_at = ? WHERE key = ? AND expires_at < ?",
+            (now + REFRESH_GRACE_SECONDS, key, now)
+        )
+        return cursor.rowcount == 1
+
+    def _refresh(self, key, compute, cacheable):
+        try:
+            value = compute()
+            if cacheable is None or cacheable(value):
+                self.set(key, value)
+        except Exception as e:
+            print(f"后台刷新缓存{key}时出错: {str(e)}")
+        finally:
+            with self._refresh_lock:
+                self._refreshing.discard(key)
+
+    def get_or_compute(self, key, compute, cacheable=None):
+        """
+        读取缓存，未命中时计算并写入
+
+        条目已过期但仍在可用期内时直接返回旧结果，同时在后台线程刷新
+
+        参数:
+        compute: 无参数的计算函数
+        cacheable: 判断结果是否可缓存的函数，默认全部缓存
+        """
+        kind = key.split(":", 1)[0]
+        cached = self.get(key)
+        if cached is not None:
+            value, fresh = cached
+            metrics.record_cache("result", kind, "hit" if fresh else "stale")
+            if not fresh:
+                with self._refresh_lock:
+                    start = key not in self._refreshing and self._claim_refresh(key)
+                    if start:
+                        self._refreshing.add(key)
+                if start:
+                    threading.Thread(
+                        target=self._refresh, args=(key, compute, cacheable), daemon=True
+                    ).start()
+            return value
+
+        metrics.record_cache("result", kind, "miss")
+        value = compute()
+        if cacheable is None or cacheable(value):
+            self.set(key, value)
+        return value
@@ -0,0 +1,88 @@
+"""
+相同请求的合并执行(single-flight)
+
+同一键的并发调用只有第一个真正执行，其余等待并共享其结果。进程内通过Future合并；
+跨gunicorn工作进程时，执行者先获取该键的文件锁，拿到锁后再检查共享存储(栅格存储、结果缓存)，
+其他进程已经完成的工作直接复用。文件锁按键的哈希分散到固定数量的锁文件上，锁目录中的文件数不随键增长；
+不同键偶尔共用一个锁文件时只会互相等待，结果仍按键区分。键的第一段(如tile、model)各用一组锁文件，
+耗时长的模型运行不会阻塞瓦片下载。
+"""
+import hashlib
+import os
+import threading
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:  # Windows下只做进程内合并
+    fcntl = None
+
+
+# 跨进程文件锁的数量
+LOCK_STRIPES = 256
+
+
+class SingleFlight(object):
+    """
+    参数:
+    lock_dir: 跨进程文件锁目录，为None时只在进程内合并
+    stripes: 文件锁数量
+
+    共用锁文件的键会互相等待，fn中不能再调用同一SingleFlight的do，否则可能等待自己持有的锁
+    """
+
+    def __init__(self, lock_dir=None, stripes=LOCK_STRIPES):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _lock_path(self, key):
+        kind = key.split(":", 1)[0]
+        stripe = int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16) % self.stripes
+        return os.path.join(self.lock_dir, f"{kind}.{stripe:03d}.lock")
+
+    def _run_leader(self, key, fn, recheck):
+        if self.lock_dir is None or fcntl is None:
+            return fn()
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with open(self._lock_path(key), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if recheck is not None:
+                    result = recheck()
+                    if result is not None:
+                        return result
+                return fn()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def do(self, key, fn, recheck=None):
+        """
+        执行fn，同一key的并发调用共享一次执行结果
+
+        参数:
+        fn: 无参数的执行函数
+        recheck: 获取跨进程锁后调用，返回非None时直接作为结果，不再执行fn
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = self._run_leader(key, fn, recheck)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
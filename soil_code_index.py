@@ -0,0 +1,234 @@
+"""
+土壤代码最近邻索引
+
+把土壤数据库一次性转换为连续的NumPy数组，用向量化的L1距离查找最接近的土壤代码。
+结果(包括距离相等时取数据库中靠前代码的规则)与逐条比较的find_closest_soil_code完全一致。
+
+构建索引时把质地三角形划分为 CELL_PERCENT x CELL_PERCENT 百分点的格子，为每个格子预先算出可能成为
+最近代码的候选(距离下界不超过格子内任一点到某个代码距离上界的代码)，查询只计算所在格子的候选，
+不再扫描全部代码。候选过多的格子、三角形外及含NaN的输入仍扫描全部代码。
+
+代码也保存为定长字符串数组而不是Python对象列表，gunicorn预加载后fork出的工作进程读取时不修改引用计数，
+内存页保持写时复制共享。
+"""
+import numpy as np
+
+# 批量查询时每块距离矩阵的最大元素数
+MAX_CHUNK_ELEMENTS = 4 * 1024 * 1024
+# 候选格子的边长(百分点)，需能整除100
+CELL_PERCENT = 1
+# 单个格子最多保存的候选数，超过时该格子扫描全部代码
+MAX_CELL_CANDIDATES = 64
+# 比较距离上下界时的容差，覆盖浮点舍入
+BOUND_TOLERANCE = 1e-6
+
+
+def find_closest_soil_code(input_clay, input_silt, soil_data):
+    """查找最接近的土壤代码"""
+    closest_code = None
+    min_diff = float('inf')
+    input_sand = 100 - input_clay - input_silt
+
+    for code, fractions in soil_data.items():
+        clay_diff = abs(fractions['clay'] - input_clay)
+        silt_diff = abs(fractions['silt'] - input_silt)
+        sand_diff = abs(fractions['sand'] - input_sand)
+        total_diff = clay_diff + silt_diff + sand_diff
+
+        if total_diff < min_diff:
+            min_diff = total_diff
+            closest_code = code
+
+    return closest_code
+
+
+def _interval_gap(values, low, high):
+    """values到区间[low, high]的距离(在区间内为0)"""
+    return np.maximum(np.maximum(low - values, values - high), 0)
+
+
+def _interval_reach(values, low, high):
+    """values到区间[low, high]内最远点的距离"""
+    return np.maximum(np.abs(values - low), np.abs(values - high))
+
+
+class SoilCodeIndex(object):
+    """
+    土壤代码索引
+
+    参数:
+    soil_data: 土壤数据库 {code: {"clay": ..., "silt": ..., "sand": ...}}，保持原有顺序
+    """
+
+    def __init__(self, soil_data):
+        self.codes = np.array(list(soil_data.keys()), dtype=str)
+        fractions = np.array(
+            [[item['clay'], item['silt'], item['sand']] for item in soil_data.values()],
+            dtype=np.float64
+        ).reshape(-1, 3)
+        self.clay = np.ascontiguousarray(fractions[:, 0])
+        self.silt = np.ascontiguousarray(fractions[:, 1])
+        self.sand = np.ascontiguousarray(fractions[:, 2])
+        self._build_cells()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _build_cells(self):
+        """
+        预计算每个格子的候选代码
+
+        格子内任一输入到代码j的距离不小于下界lower[j]，到某个代码的距离不超过min(upper)，
+        因此最近代码(含距离相等的全部代码)都满足 lower[j] <= min(upper)。
+        _cells[clay格, silt格]为候选行号，-1表示扫描全部代码；_candidates每行按代码顺序排列，
+        宽度为各格子候选数的最大值，不足处补-1
+        """
+        cells_per_side = 100 // CELL_PERCENT
+        self._cells = np.full((cells_per_side, cells_per_side), -1, dtype=np.int32)
+        rows = []
+        if len(self.codes) == 0:
+            self._candidates = np.full((0, 1), -1, dtype=np.int64)
+            return
+
+        for i in range(cells_per_side):
+            clay_low, clay_high = i * CELL_PERCENT, (i + 1) * CELL_PERCENT
+            # 只为与质地三角形(clay + silt <= 100)相交的格子建立候选
+            silt_low = np.arange(0, 100 - clay_low, CELL_PERCENT, dtype=np.float64)[:, None]
+            silt_high = silt_low + CELL_PERCENT
+            sand_low, sand_high = 100 - clay_high - silt_high, 100 - clay_low - silt_low
+
+            lower = (_interval_gap(self.clay, clay_low, clay_high)
+                     + _interval_gap(self.silt, silt_low, silt_high)
+                     + _interval_gap(self.sand, sand_low, sand_high))
+            upper = (_interval_reach(self.clay, clay_low, clay_high)
+                     + _interval_reach(self.silt, silt_low, silt_high)
+                     + _interval_reach(self.sand, sand_low, sand_high))
+            # 含NaN的代码永远不会被选中，不作为候选
+            upper[np.isnan(upper)] = np.inf
+            threshold = upper.min(axis=1, keepdims=True)
+            is_candidate = lower - BOUND_TOLERANCE <= threshold + BOUND_TOLERANCE
+
+            for j, row in enumerate(is_candidate):
+                candidates = np.flatnonzero(row)
+                if 0 < candidates.size <= MAX_CELL_CANDIDATES and np.isfinite(threshold[j, 0]):
+                    self._cells[i, j] = len(rows)
+                    rows.append(candidates)
+
+        width = max([len(row) for row in rows] or [1])
+        self._candidates = np.full((len(rows), width), -1, dtype=np.int64)
+        for position, row in enumerate(rows):
+            self._candidates[position, :len(row)] = row
+
+    def _cell_rows(self, input_clays, input_silts):
+        """输入所在格子的候选行号，没有候选(需扫描全部代码)时为-1"""
+        result = np.full(input_clays.shape, -1, dtype=np.int64)
+        inside = ((input_clays >= 0) & (input_silts >= 0) & (input_clays + input_silts <= 100)
+                  & (input_clays < 100) & (input_silts < 100))
+        if inside.any():
+            i = (input_clays[inside] // CELL_PERCENT).astype(np.int64)
+            j = (input_silts[inside] // CELL_PERCENT).astype(np.int64)
+            result[inside] = self._cells[i, j]
+        return result
+
+    def nearest(self, input_clay, input_silt):
+        """
+        查找最接近的土壤代码
+
+        返回:
+        str: 土壤代码，没有可比较的代码时返回None
+        """
+        index = int(self.nearest_indices([input_clay], [input_silt])[0])
+        return str(self.codes[index]) if index >= 0 else None
+
+    def nearest_indices(self, input_clays, input_silts):
+        """
+        批量查找最接近的土壤代码
+
+        相同的(粘土, 粉粒)组合只查找一次，格网等重复值多的输入查找量远小于输入点数
+
+        参数:
+        input_clays, input_silts: 粘土、粉粒百分比数组
+
+        返回:
+        np.ndarray: 每个输入对应的代码序号，没有可比较代码时为-1
+        """
+        input_clays = np.asarray(input_clays, dtype=np.float64).ravel()
+        input_silts = np.asarray(input_silts, dtype=np.float64).ravel()
+        if len(self.codes) == 0 or input_clays.size == 0:
+            return np.full(input_clays.shape, -1, dtype=np.int64)
+
+        # 以复数表示(粘土, 粉粒)组合去重，比按行去重快；含NaN的组合可能合并，它们的结果都是-1
+        pairs = np.empty(input_clays.shape, dtype=np.complex128)
+        pairs.real, pairs.imag = input_clays, input_silts
+        pairs, inverse = np.unique(pairs, return_inverse=True)
+        clays, silts = np.ascontiguousarray(pairs.real), np.ascontiguousarray(pairs.imag)
+
+        result = np.full(clays.shape, -1, dtype=np.int64)
+        cell_rows = self._cell_rows(clays, silts)
+        pruned = cell_rows >= 0
+        if pruned.any():
+            result[pruned] = self._scan_candidates(clays[pruned], silts[pruned], cell_rows[pruned])
+        if not pruned.all():
+            result[~pruned] = self._scan(clays[~pruned], silts[~pruned])
+        return result[inverse.reshape(-1)]
+
+    def _distances(self, clay, silt, sand, input_clays, input_silts, input_sands):
+        """
+        计算输入与代码的距离矩阵
+
+        与find_closest_soil_code相同的运算顺序，保证浮点结果逐位一致；NaN在逐条比较中永远不会被选中，视为无穷大
+        """
+        total_diff = (np.abs(clay - input_clays[:, None])
+                      + np.abs(silt - input_silts[:, None])
+                      + np.abs(sand - input_sands[:, None]))
+        total_diff[np.isnan(total_diff)] = np.inf
+        return total_diff
+
+    def _scan_candidates(self, input_clays, input_silts, cell_rows):
+        """只计算所在格子的候选代码，返回每个输入的代码序号"""
+        result = np.full(input_clays.shape, -1, dtype=np.int64)
+        input_sands = 100 - input_clays - input_silts
+        chunk = max(1, MAX_CHUNK_ELEMENTS // self._candidates.shape[1])
+
+        for start in range(0, input_clays.size, chunk):
+            stop = start + chunk
+            candidates = self._candidates[cell_rows[start:stop]]
+            padding = candidates < 0
+            total_diff = self._distances(self.clay[candidates], self.silt[candidates], self.sand[candidates],
+                                         input_clays[start:stop], input_silts[start:stop], input_sands[start:stop])
+            total_diff[padding] = np.inf
+
+            # 候选按代码顺序排列，距离相等时argmin取靠前的代码
+            positions = np.argmin(total_diff, axis=1)
+            rows = np.arange(positions.size)
+            found = total_diff[rows, positions] != np.inf
+            result[start:stop] = np.where(found, candidates[rows, positions], -1)
+
+        return result
+
+    def _scan(self, input_clays, input_silts):
+        """分块计算输入与全部代码的距离，返回每个输入的代码序号，没有可比较代码时为-1"""
+        result = np.full(input_clays.shape, -1, dtype=np.int64)
+        input_sands = 100 - input_clays - input_silts
+        chunk = max(1, MAX_CHUNK_ELEMENTS // len(self.codes))
+
+        for start in range(0, input_clays.size, chunk):
+            stop = start + chunk
+            total_diff = self._distances(self.clay[None, :], self.silt[None, :], self.sand[None, :],
+                                         input_clays[start:stop], input_silts[start:stop], input_sands[start:stop])
+
+            indices = np.argmin(total_diff, axis=1)
+            found = total_diff[np.arange(indices.size), indices] != np.inf
+            result[start:stop] = np.where(found, indices, -1)
+
+        return result
+
+    def nearest_many(self, input_clays, input_silts):
+        """
+        批量查找最接近的土壤代码
+
+        返回:
+        list: 土壤代码列表，没有可比较代码的位置为None
+        """
+        return [str(self.codes[index]) if index >= 0 else None
+                for index in self.nearest_indices(input_clays, input_silts).tolist()]
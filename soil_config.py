@@ -0,0 +1,50 @@
+"""
+共享配置和土壤数据库读取
+
+Web API和离线工具(prefetch_region.py、build_hydraulics_table.py、build_hydraulics_surrogate.py)共用的
+深度层、数据目录和土壤数据库读取函数。只依赖标准库，离线工具导入时不会创建Flask应用、缓存和线程池。
+"""
+import json
+import os
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+
+# 质地深度层
+TEXTURE_DEPTHS = ["0-5cm", "5-15cm", "15-30cm", "30-60cm"]
+
+# 离线质地数据包目录(由prefetch_region.py生成)
+TEXTURE_PACK_DIR = os.environ.get("SOIL_TEXTURE_PACK_DIR", os.path.join(package_dir, "texture_packs"))
+# 预计算水力特性表目录(由build_hydraulics_table.py生成)
+HYDRAULICS_TABLE_DIR = os.environ.get("SOIL_HYDRAULICS_TABLE_DIR", os.path.join(package_dir, "hydraulics_table"))
+# 水力特性代理模型目录(由build_hydraulics_surrogate.py生成)
+HYDRAULICS_SURROGATE_DIR = os.environ.get("SOIL_HYDRAULICS_SURROGATE_DIR",
+                                          os.path.join(package_dir, "hydraulics_surrogate"))
+
+
+def load_soil_data(filename='soil_data.json'):
+    """加载土壤数据库，环境变量SOIL_DATA_PATH指定的文件优先"""
+    # 尝试多个可能的路径
+    possible_paths = [
+        os.path.join(package_dir, 'soil_moisture_model', filename),
+        os.path.join(package_dir, filename)
+    ]
+    if os.environ.get("SOIL_DATA_PATH"):
+        possible_paths.insert(0, os.environ["SOIL_DATA_PATH"])
+
+    for path in possible_paths:
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                return json.load(file)
+
+    raise FileNotFoundError(f"找不到 {filename}，已尝试路径: {possible_paths}")
+
+
+def format_code(code):
+    """格式化土壤代码为4位字符串"""
+    if not isinstance(code, str):
+        code = str(code)
+
+    if len(code) != 4:
+        code = (code[:4] if len(code) > 4 else code.zfill(4))
+
+    return code
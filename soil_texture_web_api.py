@@ -1,29 +1,162 @@
 """
 基于Flask实现的HTTP API,用于查询任意经纬度位置的土壤质地组成和水力特性(数据源基于SoilGrid250m)
 """
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template, g, redirect, send_file
 from flask_cors import CORS
-import pandas as pd
-from soilgrids import SoilGrids
-import rioxarray
+import numpy as np
 import os
 import tempfile
-import concurrent.futures
+import functools
+import hashlib
+import importlib
+import threading
 import time
-import json
 import sys
+from urllib.parse import urlparse, urlencode
 
 # 添加当前目录到Python路径，确保可以导入soil_moisture_model
 current_dir = os.path.dirname(os.path.abspath(__file__))
 if current_dir not in sys.path:
     sys.path.append(current_dir)
 
-from soil_moisture_model import run_soil_moisture_models
+from hydraulic_models import (MODEL_NAMES, model_package, run_models_in_pool, resolve_models, select_models,
+                              parse_model_output, result_to_cn, result_to_en)
+from raster_store import RasterWindowStore, TILE_PIXELS, PIXEL_DEGREES, pixel_index, pixel_indices, pixel_in_tile
+from result_cache import ResultCache
+from wcs_client import fetch_coverage, coverage_url, is_throttled, scheduler as upstream_scheduler
+from fetch_engine import FetchEngine, FetchTask
+from single_flight import SingleFlight
+from query_planner import (plan_texture_queries, derive_fractions, plan_profile_queries, TEXTURE_SERVICES,
+                           PROFILE_SERVICES, PROFILE_DEPTHS, PROFILE_STATS)
+from soil_code_index import SoilCodeIndex, find_closest_soil_code
+from hydraulics_table import HydraulicsTable
+from hydraulics_surrogate import HydraulicsSurrogate, SURROGATE_FIELDS
+import metrics
+import profiling
+from response_encoding import LANGUAGE_KEYS, negotiate, encode_response, select_language
+from bulk_jobs import JobManager, parse_points_csv
+from texture_pack import TexturePackIndex
+from upstream_scheduler import TileBatcher, BULK, lane as upstream_lane, current_lane as current_upstream_lane
+from soil_config import (TEXTURE_DEPTHS, TEXTURE_PACK_DIR, HYDRAULICS_TABLE_DIR, HYDRAULICS_SURROGATE_DIR,
+                         load_soil_data, format_code)
+from texture_grid import (MAX_GRID_CELLS, grid_shape, compose_texture_grid, codes_to_numbers,
+                          encode_npz, encode_geotiff, iter_chunks)
+
+# 本地栅格存储目录，可通过环境变量覆盖
+RASTER_STORE_DIR = os.environ.get("SOIL_RASTER_STORE_DIR", os.path.join(current_dir, "raster_store"))
+raster_store = RasterWindowStore(RASTER_STORE_DIR)
+
+# 离线质地数据包(目录TEXTURE_PACK_DIR)启动时加载，新增数据包在重启后生效
+texture_packs = TexturePackIndex(TEXTURE_PACK_DIR)
+
+# 查询结果缓存(各gunicorn工作进程共享同一SQLite文件)
+RESULT_CACHE_PATH = os.environ.get("SOIL_RESULT_CACHE_PATH", os.path.join(current_dir, "result_cache.sqlite3"))
+result_cache = ResultCache(
+    RESULT_CACHE_PATH,
+    max_entries=int(os.environ.get("SOIL_RESULT_CACHE_MAX_ENTRIES", 100000)),
+    ttl=float(os.environ.get("SOIL_RESULT_CACHE_TTL", 30 * 24 * 3600)),
+    stale_ttl=float(os.environ.get("SOIL_RESULT_CACHE_STALE_TTL", 7 * 24 * 3600)),
+)
+
+# 上游请求并发引擎: 并发上限、截止时间和对冲请求的延迟分位数均可通过环境变量配置
+fetch_engine = FetchEngine(
+    max_concurrency=int(os.environ.get("SOIL_FETCH_MAX_CONCURRENCY", 16)),
+    per_host=int(os.environ.get("SOIL_FETCH_PER_HOST", 8)),
+    deadline=float(os.environ.get("SOIL_FETCH_DEADLINE", 25)),
+    hedge_percentile=float(os.environ.get("SOIL_FETCH_HEDGE_PERCENTILE", 95)),
+    hedge_min_delay=float(os.environ.get("SOIL_FETCH_HEDGE_MIN_DELAY", 0.5)),
+)
+
+# 相同瓦片下载和相同土壤代码的模型运行只执行一次，文件锁目录在各工作进程间共享
+SINGLE_FLIGHT_DIR = os.environ.get("SOIL_SINGLE_FLIGHT_DIR", os.path.join(tempfile.gettempdir(), "soil_api_locks"))
+single_flight = SingleFlight(SINGLE_FLIGHT_DIR)
+
+# 等待上游配额期间，同一coverage相邻瓦片(最多10x10个)的下载合并为一次窗口请求
+tile_batcher = TileBatcher(raster_store, upstream_scheduler, fetch_coverage, span=10)
 
 
 app = Flask(__name__)
 CORS(app)  
 
+@app.before_request
+def start_request_metrics():
+    """开始记录请求耗时及各阶段耗时"""
+    g.metrics_start = time.perf_counter()
+    g.metrics_endpoint = request.endpoint or "unknown"
+    metrics.start_request()
+    metrics.gauge_add("soil_requests_in_flight", 1, {"endpoint": g.metrics_endpoint})
+
+@app.after_request
+def record_request_metrics(response):
+    """记录请求耗时，并在响应中附加Server-Timing"""
+    if "metrics_start" in g:
+        total = time.perf_counter() - g.metrics_start
+        metrics.observe("soil_request_seconds", total, {"endpoint": g.metrics_endpoint})
+        metrics.inc("soil_requests_total", {"endpoint": g.metrics_endpoint, "status": str(response.status_code)})
+        response.headers["Server-Timing"] = metrics.server_timing(total)
+    metrics.flush()
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if "metrics_endpoint" in g:
+        metrics.gauge_add("soil_requests_in_flight", -1, {"endpoint": g.metrics_endpoint})
+
+@app.route('/metrics')
+def metrics_api():
+    """Prometheus格式的服务指标"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.before_request
+def start_request_profile():
+    """请求带profile参数及管理员令牌时开始剖析，并启动本进程的持续采样"""
+    profiling.ensure_continuous_sampler()
+    mode = request.args.get('profile')
+    if not mode:
+        return None
+    if mode not in profiling.PROFILE_MODES:
+        return jsonify({"error": f"profile参数只能为{'、'.join(profiling.PROFILE_MODES)}"}), 400
+    if not profiling.authorized(request.headers.get("X-Admin-Token")):
+        return jsonify({"error": "剖析需要有效的管理员令牌(X-Admin-Token)"}), 403
+    try:
+        g.profile = profiling.RequestProfile(mode, request.endpoint or "unknown")
+    except profiling.ProfilerBusy as e:
+        return jsonify({"error": str(e)}), 409
+    return None
+
+@app.after_request
+def finish_request_profile(response):
+    """结束剖析，结果文件名通过X-Profile响应头返回"""
+    profile = g.pop("profile", None)
+    if profile is not None:
+        response.headers["X-Profile"] = profile.stop()
+        response.headers["Cache-Control"] = "no-store"
+    return response
+
+@app.teardown_request
+def abort_request_profile(error=None):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.stop()
+
+@app.route('/debug/profiles/<name>')
+def profile_file_api(name):
+    """下载按请求剖析的结果文件(需要管理员令牌)"""
+    if not profiling.authorized(request.headers.get("X-Admin-Token")):
+        return jsonify({"error": "需要有效的管理员令牌(X-Admin-Token)"}), 403
+    path = profiling.profile_path(name)
+    if path is None:
+        return jsonify({"error": "剖析结果不存在"}), 404
+    mimetype = "text/plain" if name.endswith(".folded") else "application/octet-stream"
+    return send_file(path, mimetype=mimetype, as_attachment=True, download_name=name)
+
+@app.route('/debug/stacks')
+def continuous_stacks_api():
+    """持续采样累计的折叠栈(需要管理员令牌)"""
+    if not profiling.authorized(request.headers.get("X-Admin-Token")):
+        return jsonify({"error": "需要有效的管理员令牌(X-Admin-Token)"}), 403
+    return Response(profiling.continuous_stacks(), mimetype="text/plain")
+
 @app.route('/')
 def index():
     return '''
@@ -168,275 +301,856 @@ def index():
     </html>
     '''
 
+def read_coverage_pixel(longitude, latitude, service_id, coverage_id, coalesce=True):
+    """
+    读取单个像元值，本地没有时下载所在瓦片
+
+    coalesce为True时，同一瓦片、同一优先级的并发下载(含其他工作进程)只执行一次，排队等待上游配额的
+    同coverage瓦片合并为一次窗口下载；对冲请求传入False以绕过合并。interactive请求不等待bulk请求的
+    下载(bulk可能长时间让行)，两者在TileBatcher中仍会合并为一次下载
+
+    返回:
+    tuple: (value, unit)
+    """
+    ix, iy, row, col = pixel_in_tile(longitude, latitude)
+    tile = raster_store.get_tile(coverage_id, ix, iy)
+
+    if tile is None:
+        if coalesce:
+            tile = single_flight.do(
+                f"tile:{current_upstream_lane()}:{coverage_id}:{ix}:{iy}",
+                functools.partial(tile_batcher.fetch_tile, service_id, coverage_id, ix, iy),
+                recheck=functools.partial(raster_store.get_tile, coverage_id, ix, iy)
+            )
+        else:
+            fetch = functools.partial(fetch_coverage, service_id, coverage_id)
+            tile = raster_store.fetch_tile(coverage_id, ix, iy, fetch)
+
+    return tile[row, col], raster_store.get_unit(coverage_id)
+
 def query_soil_property(longitude, latitude, service_id, depth="0-5cm", stat="mean"):
     """
     查询特定经纬度位置的单个土壤属性数据
+
+    优先从离线数据包和本地栅格存储读取，所在瓦片尚未下载时整块下载并保存
     """
-    west = longitude - 0.01
-    east = longitude + 0.01
-    south = latitude - 0.01
-    north = latitude + 0.01
-    
     coverage_id = f"{service_id}_{depth}_{stat}"
-    
-    with tempfile.NamedTemporaryFile(suffix='.tif', delete=False) as temp:
-        temp_filename = temp.name
-    
+
+    packed = texture_packs.read(coverage_id, longitude, latitude)
+    if packed is not None:
+        return (service_id, depth) + tuple(packed)
+
     try:
-        sg = SoilGrids()
-        data = sg.get_coverage_data(
-            service_id=service_id,
-            coverage_id=coverage_id,
-            west=west,
-            south=south,
-            east=east,
-            north=north,
-            crs="urn:ogc:def:crs:EPSG::4326",
-            width=10,  
-            height=10,
-            output=temp_filename,
-        )
-        
-        ds = rioxarray.open_rasterio(temp_filename)
-        value = ds.sel(x=longitude, y=latitude, method='nearest').values[0]  # 获取第一个值
-        
-        unit = sg.metadata.get("units", "未知单位")
-        
+        value, unit = read_coverage_pixel(longitude, latitude, service_id, coverage_id)
         return service_id, depth, value, unit
     except Exception as e:
         print(f"查询{coverage_id}时出错: {str(e)}")
         return service_id, depth, None, None
-    finally:
-        try:
-            if os.path.exists(temp_filename):
-                os.remove(temp_filename)
-        except:
-            pass
 
-def query_worker(args):
-    """并行查询的工作函数"""
-    longitude, latitude, prop_id, depth = args
-    return query_soil_property(longitude, latitude, prop_id, depth)
+def record_failure(failures, coverage_id, error):
+    """在failures中记录查询失败的coverage及原因("throttled"为上游限流，其余为"failed")"""
+    print(f"查询{coverage_id}时出错: {str(error)}")
+    if failures is not None:
+        failures[coverage_id] = "throttled" if is_throttled(error) else "failed"
+
+def failure_report(failures):
+    """查询失败的coverage列表: missing为全部失败的coverage，throttled为其中因上游限流失败的"""
+    return {
+        "missing": sorted(failures),
+        "throttled": sorted(coverage_id for coverage_id, reason in failures.items() if reason == "throttled")
+    }
+
+def report_failures(response, failures):
+    """部分coverage查询失败时，在X-Soil-Missing和X-Soil-Throttled响应头中列出，响应不可缓存"""
+    if failures:
+        report = failure_report(failures)
+        response.headers["X-Soil-Missing"] = ",".join(report["missing"])
+        if report["throttled"]:
+            response.headers["X-Soil-Throttled"] = ",".join(report["throttled"])
+    return response
 
-def get_soil_texture(longitude, latitude):
+def upstream_unavailable(failures):
+    """全部数据都因上游查询失败而缺失时的503响应"""
+    return jsonify({"error": "上游数据源暂时不可用，请稍后重试", **failure_report(failures)}), 503
+
+def query_coverages(longitude, latitude, queries, failures=None):
+    """
+    并发查询特定经纬度位置的多个coverage
+
+    离线数据包或本地栅格存储已有的直接读取，其余请求交给fetch_engine同时发出；相同的coverage只查询一次
+
+    参数:
+    queries: [(service_id, depth, stat), ...]
+    failures: 传入dict时记录查询失败的 {coverage_id: "throttled"或"failed"}
+
+    返回:
+    list: 与queries顺序一致的 (value, unit)，失败时为 (None, None)
+    """
+    values = {}
+    tasks = {}
+
+    for service_id, depth, stat in queries:
+        coverage_id = f"{service_id}_{depth}_{stat}"
+        if coverage_id in values or coverage_id in tasks:
+            continue
+
+        if texture_packs:
+            packed = texture_packs.read(coverage_id, longitude, latitude)
+            metrics.record_cache("pack", service_id, "miss" if packed is None else "hit")
+            if packed is not None:
+                values[coverage_id] = tuple(packed)
+                continue
+
+        cached = raster_store.read(coverage_id, longitude, latitude)
+        metrics.record_cache("raster", service_id, "miss" if cached is None else "hit")
+        if cached is not None:
+            values[coverage_id] = tuple(cached)
+            continue
+
+        read = functools.partial(read_coverage_pixel, longitude, latitude, service_id, coverage_id)
+        tasks[coverage_id] = FetchTask(
+            key=coverage_id,
+            host=urlparse(coverage_url(service_id)).netloc,
+            call=read,
+            hedge_call=functools.partial(read, coalesce=False)
+        )
+
+    outcomes = fetch_engine.run(list(tasks.values()))
+
+    for coverage_id in tasks:
+        outcome = outcomes[coverage_id]
+        if isinstance(outcome, Exception):
+            record_failure(failures, coverage_id, outcome)
+            values[coverage_id] = (None, None)
+        else:
+            values[coverage_id] = tuple(outcome)
+
+    return [values[f"{service_id}_{depth}_{stat}"] for service_id, depth, stat in queries]
+
+def query_soil_properties(longitude, latitude, queries, stat="mean", failures=None):
+    """
+    并发查询特定经纬度位置的多个土壤属性数据
+
+    参数:
+    queries: [(service_id, depth), ...]
+    failures: 同query_coverages
+
+    返回:
+    list: 与queries顺序一致的 (service_id, depth, value, unit)，失败的value和unit为None
+    """
+    outcomes = query_coverages(longitude, latitude, [(service_id, depth, stat) for service_id, depth in queries],
+                               failures)
+    return [(service_id, depth) + outcome for (service_id, depth), outcome in zip(queries, outcomes)]
+
+# 质地属性(深度层见soil_config.TEXTURE_DEPTHS)
+TEXTURE_PROPERTIES = [
+    {"id": "clay", "name": "粘土含量"},
+    {"id": "sand", "name": "砂粒含量"},
+    {"id": "silt", "name": "粉粒含量"}
+]
+
+def compose_texture_layer(depth, clay_value, sand_value, silt_value):
+    """
+    由粘土、砂粒、粉粒含量计算单个深度层的质地组成及占比
+
+    返回:
+    dict: 深度层数据，任一含量缺失或总量不为正时返回None
+    """
+    if clay_value is None or sand_value is None or silt_value is None:
+        return None
+
+    total = clay_value + sand_value + silt_value
+    if not total > 0:
+        return None
+
+    clay_pct = clay_value / total * 100
+    sand_pct = sand_value / total * 100
+    silt_pct = silt_value / total * 100
+
+    return {
+        "depth": depth,
+        "clay_content": float(clay_value),
+        "sand_content": float(sand_value),
+        "silt_content": float(silt_value),
+        "total": float(total),
+        "clay_percent": round(float(clay_pct), 2),
+        "sand_percent": round(float(sand_pct), 2),
+        "silt_percent": round(float(silt_pct), 2)
+    }
+
+def get_soil_texture(longitude, latitude, depths=None, derive_fraction=False, failures=None):
     """
     查询特定经纬度位置的土壤质地组成及占比
     
     参数:
     longitude: 经度
     latitude: 纬度
+    depths: 需要的深度层列表，默认为全部深度层
+    derive_fraction: 为True时粉粒含量由粘土和砂粒推导，推导不可行时再请求上游
+    failures: 同query_coverages，上游查询失败的深度层不在结果中
     
     返回:
     dict: 包含不同深度土壤质地组成及占比的字典
     """
-    texture_properties = [
-        {"id": "clay", "name": "粘土含量"},
-        {"id": "sand", "name": "砂粒含量"},
-        {"id": "silt", "name": "粉粒含量"}
-    ]
-    
-    depths = ["0-5cm", "5-15cm", "15-30cm", "30-60cm"]
-    
-    texture_data = {}
-    for prop in texture_properties:
-        texture_data[prop["id"]] = {"name": prop["name"], "values": {}}
-    
-    tasks = []
-    for prop in texture_properties:
-        for depth in depths:
-            tasks.append((longitude, latitude, prop["id"], depth))
-    
-    start_time = time.time()
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-        results = list(executor.map(query_worker, tasks))
-    
-    for service_id, depth, value, unit in results:
+    depths = TEXTURE_DEPTHS if depths is None else depths
+
+    values = {}
+    queries = plan_texture_queries(depths, derive_fraction)
+    for service_id, depth, value, unit in query_soil_properties(longitude, latitude, queries, failures=failures):
         if value is not None:
-            texture_data[service_id]["values"][depth] = value
-            texture_data[service_id]["unit"] = unit
+            values[(service_id, depth)] = value
+
+    if derive_fraction:
+        fallback = derive_fractions(values, depths)
+        for service_id, depth, value, unit in query_soil_properties(longitude, latitude, fallback,
+                                                                    failures=failures):
+            if value is not None:
+                values[(service_id, depth)] = value
     
     response_data = []
     
     for depth in depths:
-        clay_value = texture_data.get("clay", {}).get("values", {}).get(depth)
-        sand_value = texture_data.get("sand", {}).get("values", {}).get(depth)
-        silt_value = texture_data.get("silt", {}).get("values", {}).get(depth)
-        
-        if clay_value is not None and sand_value is not None and silt_value is not None:
-            total = clay_value + sand_value + silt_value
-            if total > 0:
-                clay_pct = clay_value / total * 100
-                sand_pct = sand_value / total * 100
-                silt_pct = silt_value / total * 100
-                
-                response_data.append({
-                    "depth": depth,
-                    "clay_content": float(clay_value),
-                    "sand_content": float(sand_value),
-                    "silt_content": float(silt_value),
-                    "total": float(total),
-                    "clay_percent": round(float(clay_pct), 2),
-                    "sand_percent": round(float(sand_pct), 2),
-                    "silt_percent": round(float(silt_pct), 2)
-                })
+        layer = compose_texture_layer(
+            depth,
+            values.get(("clay", depth)),
+            values.get(("sand", depth)),
+            values.get(("silt", depth))
+        )
+        if layer is not None:
+            response_data.append(layer)
     
     return response_data
 
+def pixel_cache_key(kind, longitude, latitude, *parts):
+    """以坐标所在的SoilGrids像元构造缓存键，同一像元内的坐标共享结果"""
+    px, py = pixel_index(longitude, latitude)
+    return ":".join([kind, str(px), str(py)] + [str(part) for part in parts])
+
+def get_soil_texture_cached(longitude, latitude, depths=None, derive_fraction=False, failures=None):
+    """带结果缓存的get_soil_texture，只缓存所有深度层都查询成功的结果；命中缓存时failures不变"""
+    depths = TEXTURE_DEPTHS if depths is None else depths
+    return result_cache.get_or_compute(
+        pixel_cache_key("texture", longitude, latitude, ",".join(depths), int(derive_fraction)),
+        lambda: get_soil_texture(longitude, latitude, depths, derive_fraction, failures),
+        cacheable=lambda result: len(result) == len(depths)
+    )
+
+def parse_flag(value, default=False):
+    """解析布尔型查询参数"""
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# 是否默认由粘土和砂粒推导粉粒含量，可被查询参数derive覆盖
+DERIVE_FRACTION_DEFAULT = parse_flag(os.environ.get("SOIL_DERIVE_FRACTION"))
+
+# 批量查询时每个聚类最多覆盖 BATCH_CLUSTER_TILES x BATCH_CLUSTER_TILES 个瓦片
+BATCH_CLUSTER_TILES = 10
+# 单次批量请求允许的最大坐标数
+MAX_BATCH_POINTS = 5000
+# 单次批量请求允许的最大聚类数，每个聚类需下载 属性数 x 深度层数 个窗口，分布更广的坐标应使用批量任务
+MAX_BATCH_CLUSTERS = int(os.environ.get("SOIL_MAX_BATCH_CLUSTERS", 20))
+# 批量请求下载窗口的截止时间(秒)
+BATCH_FETCH_DEADLINE = float(os.environ.get("SOIL_BATCH_FETCH_DEADLINE", 60))
+
+def cluster_points(longitudes, latitudes):
+    """
+    将坐标按相邻瓦片块分组，同一组共享一次栅格下载
+
+    返回:
+    list: 每个元素为一组坐标在输入中的序号数组
+    """
+    px, py = pixel_indices(longitudes, latitudes)
+    cluster_size = TILE_PIXELS * BATCH_CLUSTER_TILES
+    cx, cy = px // cluster_size, py // cluster_size
+
+    clusters = {}
+    for index, key in enumerate(zip(cx.tolist(), cy.tolist())):
+        clusters.setdefault(key, []).append(index)
+    return [np.array(indices) for indices in clusters.values()]
+
+def coalesce_window(key, fn, recheck):
+    """合并相同窗口的并发下载(含其他工作进程)，与瓦片下载一样按优先级区分"""
+    kind, rest = key.split(":", 1)
+    return single_flight.do(f"{kind}:{current_upstream_lane()}:{rest}", fn, recheck=recheck)
+
+def sample_cluster(longitudes, latitudes, service_id, depth, stat="mean"):
+    """批量查询一组相邻坐标的单个土壤属性，返回值数组，失败时抛出异常"""
+    coverage_id = f"{service_id}_{depth}_{stat}"
+    fetch = functools.partial(fetch_coverage, service_id, coverage_id)
+    values, unit = raster_store.sample_points(coverage_id, longitudes, latitudes, fetch, coalesce=coalesce_window)
+    return values
+
+def get_soil_texture_batch(points, failures=None):
+    """
+    批量查询多个经纬度位置的土壤质地组成及占比
+
+    相邻坐标聚类后按聚类、属性、深度各下载一次栅格窗口，再按像元索引向量化取值。窗口下载由fetch_engine
+    在BATCH_FETCH_DEADLINE内并发执行，相同窗口的并发下载(含其他请求和工作进程)只执行一次
+
+    参数:
+    points: [(longitude, latitude), ...]
+    failures: 同query_coverages，记录下载失败的coverage
+
+    返回:
+    list: 与输入顺序一致，每个元素包含坐标及与get_soil_texture相同结构的深度层列表
+    """
+    longitudes = np.array([point[0] for point in points], dtype=np.float64)
+    latitudes = np.array([point[1] for point in points], dtype=np.float64)
+
+    clusters = cluster_points(longitudes, latitudes)
+    tasks = []
+    for position, indices in enumerate(clusters):
+        for prop in TEXTURE_PROPERTIES:
+            for depth in TEXTURE_DEPTHS:
+                tasks.append(FetchTask(
+                    key=(position, prop["id"], depth),
+                    host=urlparse(coverage_url(prop["id"])).netloc + "#batch",
+                    call=functools.partial(sample_cluster, longitudes[indices], latitudes[indices], prop["id"], depth)
+                ))
+    outcomes = fetch_engine.run(tasks, deadline=BATCH_FETCH_DEADLINE)
+
+    # values[prop_id][depth] 为与输入等长的数组，未取得的值为None
+    values = {prop["id"]: {depth: [None] * len(points) for depth in TEXTURE_DEPTHS}
+              for prop in TEXTURE_PROPERTIES}
+    for (position, prop_id, depth), sampled in outcomes.items():
+        if isinstance(sampled, Exception):
+            record_failure(failures, f"{prop_id}_{depth}_mean", sampled)
+            continue
+        indices = clusters[position]
+        column = values[prop_id][depth]
+        for index, value in zip(indices.tolist(), sampled):
+            column[index] = value
+
+    response_data = []
+    for index, (longitude, latitude) in enumerate(points):
+        layers = []
+        for depth in TEXTURE_DEPTHS:
+            layer = compose_texture_layer(
+                depth,
+                values["clay"][depth][index],
+                values["sand"][depth][index],
+                values["silt"][depth][index]
+            )
+            if layer is not None:
+                layers.append(layer)
+        response_data.append({
+            "longitude": longitude,
+            "latitude": latitude,
+            "texture": layers
+        })
+
+    return response_data
+
+def encoded_response(data, media_type):
+    """按negotiate选择的媒体类型编码响应，并按Accept-Encoding压缩较大的响应"""
+    with metrics.stage("serialize"):
+        body, encoding = encode_response(data, media_type, request.accept_encodings)
+    response = Response(body, mimetype=media_type)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.update(("Accept", "Accept-Encoding"))
+    return response
+
+# HTTP缓存: 结果只取决于像元、参数和数据版本，响应带强ETag并允许边缘缓存HTTP_CACHE_MAX_AGE秒。
+# SoilGrids数据或模型更新后修改SOIL_DATASET_VERSION，使已缓存的ETag全部失效
+HTTP_CACHE_MAX_AGE = int(os.environ.get("SOIL_HTTP_CACHE_MAX_AGE", 30 * 24 * 3600))
+DATASET_VERSION = os.environ.get("SOIL_DATASET_VERSION", "soilgrids-2.0")
+# 为True时把坐标重定向到所在像元中心，同一像元的请求共用一个URL
+CANONICAL_REDIRECT = parse_flag(os.environ.get("SOIL_CANONICAL_REDIRECT"))
+
+def pixel_center(longitude, latitude):
+    """坐标所在SoilGrids像元的中心坐标"""
+    px, py = pixel_index(longitude, latitude)
+    return round((px + 0.5) * PIXEL_DEGREES - 180.0, 6), round((py + 0.5) * PIXEL_DEGREES - 90.0, 6)
+
+def canonical_redirect(longitude, latitude):
+    """开启CANONICAL_REDIRECT且坐标不是像元中心时，返回到像元中心URL的永久重定向，否则返回None"""
+    if not CANONICAL_REDIRECT:
+        return None
+    center = pixel_center(longitude, latitude)
+    if (longitude, latitude) == center:
+        return None
+
+    args = request.args.to_dict(flat=False)
+    args["longitude"], args["latitude"] = [f"{center[0]:.3f}"], [f"{center[1]:.3f}"]
+    response = redirect(f"{request.path}?{urlencode(args, doseq=True)}", code=301)
+    response.headers["Cache-Control"] = f"public, max-age={HTTP_CACHE_MAX_AGE}"
+    return response
+
+def response_etag(kind, longitude, latitude, *parts):
+    """由像元、请求参数和数据版本计算强ETag(不含引号)"""
+    key = pixel_cache_key(kind, longitude, latitude, *parts, DATASET_VERSION)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:32]
+
+def not_modified(etag):
+    """
+    If-None-Match与etag匹配时返回304响应，否则返回None
+
+    压缩后的响应ETag带有"-gzip"等后缀，经反向代理压缩后可能变为弱ETag，比较时均忽略；
+    304响应回传匹配到的带编码后缀的ETag，与200响应的验证器一致
+    """
+    if_none_match = request.if_none_match
+    if not if_none_match:
+        return None
+    if if_none_match.star_tag:
+        matched = etag
+    else:
+        matched = next((tag for tag in sorted(if_none_match.as_set(include_weak=True))
+                        if tag.split("-", 1)[0] == etag), None)
+        if matched is None:
+            return None
+
+    response = Response(status=304)
+    response.set_etag(matched)
+    response.headers["Cache-Control"] = f"public, max-age={HTTP_CACHE_MAX_AGE}"
+    response.vary.update(("Accept", "Accept-Encoding"))
+    return response
+
+def cacheable(response, etag):
+    """为完整结果设置强ETag和Cache-Control，压缩的响应在ETag后附加编码"""
+    encoding = response.headers.get("Content-Encoding")
+    response.set_etag(f"{etag}-{encoding}" if encoding else etag)
+    response.headers["Cache-Control"] = f"public, max-age={HTTP_CACHE_MAX_AGE}"
+    return response
+
 @app.route('/api/soil-texture', methods=['GET'])
 def soil_texture_api():
     """土壤质地查询API端点"""
     try:
+        try:
+            media_type = negotiate(request.accept_mimetypes, request.args.get('format'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
         longitude = float(request.args.get('longitude'))
         latitude = float(request.args.get('latitude'))
         
         if longitude < -180 or longitude > 180 or latitude < -90 or latitude > 90:
             return jsonify({"error": "经纬度参数无效，经度范围-180到180，纬度范围-90到90"}), 400
         
-        result = get_soil_texture(longitude, latitude)
+        derive_fraction = parse_flag(request.args.get('derive'), DERIVE_FRACTION_DEFAULT)
+        
+        redirect_response = canonical_redirect(longitude, latitude)
+        if redirect_response is not None:
+            return redirect_response
+        
+        etag = response_etag("texture", longitude, latitude, int(derive_fraction), media_type)
+        cached_response = not_modified(etag)
+        if cached_response is not None:
+            return cached_response
         
-        return jsonify(result)
+        failures = {}
+        result = get_soil_texture_cached(longitude, latitude, derive_fraction=derive_fraction, failures=failures)
+        if failures and not result:
+            return upstream_unavailable(failures)
+        
+        response = encoded_response(result, media_type)
+        return cacheable(response, etag) if len(result) == len(TEXTURE_DEPTHS) else report_failures(response, failures)
     
     except Exception as e:
         return jsonify({"error": f"查询出错: {str(e)}"}), 500
 
+@app.route('/api/soil-texture/batch', methods=['POST'])
+def soil_texture_batch_api():
+    """批量土壤质地查询API端点"""
+    try:
+        try:
+            media_type = negotiate(request.accept_mimetypes, request.args.get('format'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        body = request.get_json(silent=True) or {}
+        raw_points = body.get("points") if isinstance(body, dict) else body
+
+        if not isinstance(raw_points, list) or not raw_points:
+            return jsonify({"error": "请求体需包含非空的points数组"}), 400
+        if len(raw_points) > MAX_BATCH_POINTS:
+            return jsonify({"error": f"单次最多查询{MAX_BATCH_POINTS}个坐标"}), 400
+
+        points = []
+        for item in raw_points:
+            if isinstance(item, dict):
+                longitude, latitude = float(item["longitude"]), float(item["latitude"])
+            else:
+                longitude, latitude = float(item[0]), float(item[1])
+
+            if longitude < -180 or longitude > 180 or latitude < -90 or latitude > 90:
+                return jsonify({"error": "经纬度参数无效，经度范围-180到180，纬度范围-90到90"}), 400
+            points.append((longitude, latitude))
+
+        cluster_count = len(cluster_points(np.array([point[0] for point in points], dtype=np.float64),
+                                           np.array([point[1] for point in points], dtype=np.float64)))
+        if cluster_count > MAX_BATCH_CLUSTERS:
+            return jsonify({"error": f"坐标分布在{cluster_count}个区域，超过单次上限{MAX_BATCH_CLUSTERS}，"
+                                     f"请按区域分批请求或使用/api/jobs批量任务"}), 400
+
+        failures = {}
+        result = get_soil_texture_batch(points, failures)
+        if failures and not any(item["texture"] for item in result):
+            return upstream_unavailable(failures)
+
+        return report_failures(encoded_response(result, media_type), failures)
+
+    except Exception as e:
+        return jsonify({"error": f"查询出错: {str(e)}"}), 500
+
+# 单次剖面查询允许的最大coverage数(属性数 x 深度层数 x 统计量数)
+MAX_PROFILE_COVERAGES = int(os.environ.get("SOIL_MAX_PROFILE_COVERAGES", 120))
+
+def get_soil_profile(longitude, latitude, properties, depths, stats, failures=None):
+    """
+    查询特定经纬度位置多个属性、深度层和统计量的土壤剖面
+
+    全部coverage由plan_profile_queries去重后一次交给fetch_engine并发查询
+
+    参数:
+    failures: 同query_coverages
+
+    返回:
+    dict: 列式结果，columns中每列为 "{属性}_{统计量}"，值与depths一一对应，查询失败的为None
+    """
+    queries = plan_profile_queries(properties, depths, stats)
+    outcomes = query_coverages(longitude, latitude, queries, failures)
+
+    columns = {}
+    units = {}
+    for (service_id, depth, stat), (value, unit) in zip(queries, outcomes):
+        columns.setdefault(f"{service_id}_{stat}", []).append(None if value is None else float(value))
+        if unit is not None:
+            units[service_id] = unit
+
+    return {
+        "longitude": longitude,
+        "latitude": latitude,
+        "depths": list(dict.fromkeys(depths)),
+        "units": units,
+        "columns": columns
+    }
+
+def get_soil_profile_cached(longitude, latitude, properties, depths, stats, failures=None):
+    """
+    带结果缓存的get_soil_profile，只缓存全部coverage都查询成功的结果
+
+    缓存按像元共用，缓存值不含坐标，返回前填入本次请求的坐标
+    """
+    def compute():
+        result = get_soil_profile(longitude, latitude, properties, depths, stats, failures)
+        return {key: value for key, value in result.items() if key not in ("longitude", "latitude")}
+
+    cached = result_cache.get_or_compute(
+        pixel_cache_key("profile", longitude, latitude, ",".join(properties), ",".join(depths), ",".join(stats)),
+        compute,
+        cacheable=lambda result: all(value is not None for column in result["columns"].values() for value in column)
+    )
+    result = {"longitude": longitude, "latitude": latitude}
+    result.update((key, value) for key, value in cached.items() if key not in result)
+    return result
+
+def parse_choices(value, choices, default):
+    """解析逗号分隔的列表参数，含不在choices中的值时返回None"""
+    if value is None:
+        return list(default)
+    items = [item.strip() for item in value.split(',') if item.strip()]
+    if not items or any(item not in choices for item in items):
+        return None
+    return items
+
+@app.route('/api/soil-profile', methods=['GET'])
+def soil_profile_api():
+    """土壤剖面查询API端点"""
+    try:
+        try:
+            media_type = negotiate(request.accept_mimetypes, request.args.get('format'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        longitude = float(request.args.get('longitude'))
+        latitude = float(request.args.get('latitude'))
+
+        if longitude < -180 or longitude > 180 or latitude < -90 or latitude > 90:
+            return jsonify({"error": "经纬度参数无效，经度范围-180到180，纬度范围-90到90"}), 400
+
+        properties = parse_choices(request.args.get('properties'), PROFILE_SERVICES, TEXTURE_SERVICES)
+        if properties is None:
+            return jsonify({"error": f"属性参数无效，可选属性: {', '.join(PROFILE_SERVICES)}"}), 400
+        depths = parse_choices(request.args.get('depths'), PROFILE_DEPTHS, PROFILE_DEPTHS)
+        if depths is None:
+            return jsonify({"error": f"深度参数无效，可选深度: {', '.join(PROFILE_DEPTHS)}"}), 400
+        stats = parse_choices(request.args.get('stats'), PROFILE_STATS, ["mean"])
+        if stats is None:
+            return jsonify({"error": f"统计量参数无效，可选统计量: {', '.join(PROFILE_STATS)}"}), 400
+
+        count = len(set(properties)) * len(set(depths)) * len(set(stats))
+        if count > MAX_PROFILE_COVERAGES:
+            return jsonify({"error": f"请求的coverage数{count}超过上限{MAX_PROFILE_COVERAGES}，请减少属性、深度或统计量"}), 400
+
+        redirect_response = canonical_redirect(longitude, latitude)
+        if redirect_response is not None:
+            return redirect_response
+
+        # 响应包含请求坐标，ETag也按精确坐标区分
+        etag = response_etag("profile", longitude, latitude, f"{longitude!r},{latitude!r}", ",".join(properties),
+                             ",".join(depths), ",".join(stats), media_type)
+        cached_response = not_modified(etag)
+        if cached_response is not None:
+            return cached_response
+
+        failures = {}
+        result = get_soil_profile_cached(longitude, latitude, properties, depths, stats, failures)
+        values = [value for column in result["columns"].values() for value in column]
+        complete = all(value is not None for value in values)
+        if not complete and failures:
+            if all(value is None for value in values):
+                return upstream_unavailable(failures)
+            result.update(failure_report(failures))
+
+        response = encoded_response(result, media_type)
+        return cacheable(response, etag) if complete else report_failures(response, failures)
+
+    except Exception as e:
+        return jsonify({"error": f"查询出错: {str(e)}"}), 500
+
+# 格网请求的截止时间(秒)，整块下载比单个瓦片耗时更长
+GRID_FETCH_DEADLINE = float(os.environ.get("SOIL_GRID_FETCH_DEADLINE", 120))
+
+def get_soil_texture_grid(west, south, east, north, resolution=PIXEL_DEGREES, depths=None, derived=False):
+    """
+    查询矩形范围内格网的土壤质地组成及占比
+
+    每个属性、深度只下载一次覆盖整个范围的栅格，占比、土壤代码及派生水力参数均以数组运算完成。
+    派生水力参数只取自预计算水力特性表，不实时运行模型，表中没有的土壤代码为NaN
+
+    参数:
+    resolution: 格网分辨率(度)
+    depths: 深度层列表，默认为全部深度层
+    derived: 为True时附加各深度层的田间持水量和萎蔫点图层，需要已构建水力特性表
+
+    返回:
+    tuple: (layers, meta)，layers为 {图层名: 二维数组}，图层名形如"clay_percent_0-5cm"
+    """
+    depths = TEXTURE_DEPTHS if depths is None else depths
+    height, width = grid_shape(west, south, east, north, resolution)
+    east, south = west + width * resolution, north - height * resolution
+
+    tasks = []
+    for service_id, depth in plan_texture_queries(depths):
+        coverage_id = f"{service_id}_{depth}_mean"
+        tasks.append(FetchTask(
+            key=(service_id, depth),
+            host=urlparse(coverage_url(service_id)).netloc + "#grid",
+            call=functools.partial(fetch_coverage, service_id, coverage_id,
+                                   west, south, east, north, width, height)
+        ))
+    outcomes = fetch_engine.run(tasks, deadline=GRID_FETCH_DEADLINE)
+
+    missing = np.full((height, width), -1, dtype=np.int16)
+    values = {}
+    for key, outcome in outcomes.items():
+        if isinstance(outcome, Exception):
+            print(f"格网查询{key[0]}_{key[1]}_mean时出错: {str(outcome)}")
+            values[key] = missing
+        else:
+            values[key] = outcome[0]
+
+    soil_code_index = get_soil_code_index()
+    codes = [format_code(code) for code in soil_code_index.codes]
+    code_numbers = codes_to_numbers(codes)
+    table = get_hydraulics_table() if derived else None
+
+    layers = {}
+    for depth in depths:
+        percents = compose_texture_grid(values[("clay", depth)], values[("sand", depth)], values[("silt", depth)])
+        for name, array in percents.items():
+            layers[f"{name}_{depth}"] = array
+
+        # 无数据像元的占比为NaN，查找结果为-1
+        code_indices = soil_code_index.nearest_indices(percents["clay_percent"], percents["silt_percent"])
+        layers[f"soil_code_{depth}"] = np.where(code_indices >= 0, code_numbers[code_indices], -1).reshape(height, width)
+
+        if derived:
+            unique, inverse = np.unique(code_indices, return_inverse=True)
+            field_capacity = np.full(unique.shape, np.nan)
+            wilting_point = np.full(unique.shape, np.nan)
+            for position, index in enumerate(unique.tolist()):
+                hydraulic_properties = table.lookup(codes[index]) if index >= 0 and table is not None else None
+                if hydraulic_properties is None:
+                    continue
+                summary = hydraulic_properties.summary
+                if summary.field_capacity is not None:
+                    field_capacity[position] = summary.field_capacity
+                if summary.wilting_point is not None:
+                    wilting_point[position] = summary.wilting_point
+            layers[f"field_capacity_{depth}"] = field_capacity[inverse].reshape(height, width)
+            layers[f"wilting_point_{depth}"] = wilting_point[inverse].reshape(height, width)
+
+    meta = {
+        "bounds": [west, south, east, north],
+        "resolution": resolution,
+        "shape": [height, width],
+        "depths": list(depths),
+    }
+    return layers, meta
+
+@app.route('/api/soil-texture/grid', methods=['GET'])
+def soil_texture_grid_api():
+    """格网土壤质地查询API端点，结果以.npz或GeoTIFF分块返回"""
+    try:
+        west = float(request.args.get('west'))
+        south = float(request.args.get('south'))
+        east = float(request.args.get('east'))
+        north = float(request.args.get('north'))
+        resolution = float(request.args.get('resolution', PIXEL_DEGREES))
+        depths = [depth for depth in request.args.get('depths', ",".join(TEXTURE_DEPTHS)).split(',') if depth]
+        output_format = request.args.get('format', 'npz').lower()
+        derived = parse_flag(request.args.get('derived'))
+
+        if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+            return jsonify({"error": "范围参数无效，需满足 -180<=west<east<=180，-90<=south<north<=90"}), 400
+        if resolution <= 0:
+            return jsonify({"error": "分辨率必须为正数"}), 400
+        unknown = [depth for depth in depths if depth not in TEXTURE_DEPTHS]
+        if unknown or not depths:
+            return jsonify({"error": f"深度参数无效，可选深度: {', '.join(TEXTURE_DEPTHS)}"}), 400
+        if output_format not in ('npz', 'geotiff'):
+            return jsonify({"error": "format仅支持npz或geotiff"}), 400
+
+        height, width = grid_shape(west, south, east, north, resolution)
+        if height * width > MAX_GRID_CELLS:
+            return jsonify({"error": f"格网像元数{height * width}超过上限{MAX_GRID_CELLS}，请缩小范围、降低分辨率或分块请求"}), 400
+        if derived and get_hydraulics_table() is None:
+            return jsonify({"error": "derived需要预计算水力特性表，请先运行build_hydraulics_table.py"}), 503
+
+        layers, meta = get_soil_texture_grid(west, south, east, north, resolution, depths, derived)
+
+        if output_format == 'geotiff':
+            data = encode_geotiff(layers, west, north, resolution)
+            mimetype, filename = 'image/tiff', 'soil_texture_grid.tif'
+        else:
+            data = encode_npz(layers, meta)
+            mimetype, filename = 'application/octet-stream', 'soil_texture_grid.npz'
+
+        return Response(iter_chunks(data), mimetype=mimetype,
+                        headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+    except Exception as e:
+        return jsonify({"error": f"查询出错: {str(e)}"}), 500
+
 # 以下是新增的水力特性相关函数
 
-def load_soil_data(filename='soil_data.json'):
-    """加载土壤数据库"""
-    # 尝试多个可能的路径
-    module_dir = os.path.dirname(os.path.abspath(__file__))
-    possible_paths = [
-        os.path.join(module_dir, 'soil_moisture_model', filename),
-        os.path.join(module_dir, filename)
-    ]
-    
-    for path in possible_paths:
-        if os.path.exists(path):
-            with open(path, 'r') as file:
-                return json.load(file)
-    
-    raise FileNotFoundError(f"找不到 {filename}，已尝试路径: {possible_paths}")
+_soil_code_index = None
+_soil_code_index_lock = threading.Lock()
 
-def find_closest_soil_code(input_clay, input_silt, soil_data):
-    """查找最接近的土壤代码"""
-    closest_code = None
-    min_diff = float('inf')
-    input_sand = 100 - input_clay - input_silt  
-    
-    for code, fractions in soil_data.items():
-        clay_diff = abs(fractions['clay'] - input_clay)
-        silt_diff = abs(fractions['silt'] - input_silt)
-        sand_diff = abs(fractions['sand'] - input_sand)
-        total_diff = clay_diff + silt_diff + sand_diff
-        
-        if total_diff < min_diff:
-            min_diff = total_diff
-            closest_code = code
-    
-    return closest_code
+def get_soil_code_index():
+    """获取土壤代码索引，首次调用时加载土壤数据库，之后复用"""
+    global _soil_code_index
+    if _soil_code_index is None:
+        with _soil_code_index_lock:
+            if _soil_code_index is None:
+                _soil_code_index = SoilCodeIndex(load_soil_data())
+    return _soil_code_index
 
-def format_code(code):
-    """格式化土壤代码为4位字符串"""
-    if not isinstance(code, str):
-        code = str(code)
-    
-    if len(code) != 4:
-        code = (code[:4] if len(code) > 4 else code.zfill(4))
-        
-    return code
+# 模型集合的超时时间(秒)
+MODEL_TIMEOUT = float(os.environ.get("SOIL_MODEL_TIMEOUT", 60))
 
-def extract_hydraulic_properties(output_data):
-    """从模型输出中提取水力特性参数"""
-    properties = {}
-    
-    # 遍历所有模型输出
-    for model_name, model_data in output_data.items():
-        if not model_data or not isinstance(model_data, dict) or 'output' not in model_data:
-            continue
-            
-        output = model_data['output']
-        lines = output.splitlines() if output else []
-        
-        for line in lines:
-            # 提取饱和含水量 (qs)
-            if 'qs =' in line:
-                try:
-                    parts = line.split('qs =')
-                    if len(parts) > 1:
-                        value = float(parts[1].split()[0])
-                        properties['saturated_water_content'] = value
-                except:
-                    pass
-                    
-            # 提取田间持水量
-            if '33KPa' in line:
-                try:
-                    value = float(line.split()[-1])
-                    properties['field_capacity'] = value
-                except:
-                    pass
-                    
-            # 提取萎蔫点
-            if '15000KPa' in line:
-                try:
-                    value = float(line.split()[-1])
-                    properties['wilting_point'] = value
-                except:
-                    pass
-                    
-            # 提取饱和导水率 (Ks)
-            if 'Ks =' in line:
-                try:
-                    ks_str = line.split('Ks =')[1].split()[0]
-                    if 'e+' in ks_str:
-                        base, exp = ks_str.split('e+')
-                        properties['Ks'] = float(base) * (10 ** int(exp))
-                    else:
-                        properties['Ks'] = float(ks_str)
-                except:
-                    pass
-                    
-            # 提取van Genuchten参数 (alpha)
-            if 'a =' in line:
-                try:
-                    alpha_str = line.split('a =')[1].split()[0]
-                    properties['alpha'] = float(alpha_str)
-                except:
-                    pass
-                    
-            # 提取van Genuchten参数 (n)
-            if 'n =' in line or 'Therefore n =' in line:
+def run_models_for_code(code, models=MODEL_NAMES):
+    """
+    运行土壤水分模型
+
+    全部模型在进程池中运行一次后筛选所需模型，超时或出错时记录在结果的errors中。完整结果按土壤代码
+    保存在共享结果缓存中，不同模型集合的请求共用；同一土壤代码的并发调用(含其他工作进程)只运行一次模型
+
+    参数:
+    models: resolve_models返回的模型名
+
+    返回:
+    HydraulicsResult
+    """
+    key = f"model:{code}"
+    cached = result_cache.get(key)
+    metrics.record_cache("result", "model", "miss" if cached is None else "hit")
+    if cached is not None:
+        return select_models(parse_model_output(code, cached[0]), models)
+
+    def compute():
+        with metrics.in_flight("soil_models_in_flight"), metrics.stage("model_run"):
+            result = run_models_in_pool(code, timeout=MODEL_TIMEOUT)
+        if not result.errors:
+            result_cache.set(key, result_to_cn(result))
+        return result
+
+    def recheck():
+        cached = result_cache.get(key)
+        return parse_model_output(code, cached[0]) if cached is not None else None
+
+    return select_models(single_flight.do(key, compute, recheck=recheck), models)
+
+# 水力特性表、代理模型不存在或加载失败后，再次尝试加载的间隔(秒)
+LOAD_RETRY_SECONDS = 60
+
+_hydraulics_table = None
+_hydraulics_table_retry_at = 0.0
+_hydraulics_table_lock = threading.Lock()
+
+def get_hydraulics_table():
+    """
+    获取预计算水力特性表，首次调用时内存映射加载
+
+    表不存在或加载失败时返回None，LOAD_RETRY_SECONDS秒后的调用再次尝试加载
+    """
+    global _hydraulics_table, _hydraulics_table_retry_at
+    if _hydraulics_table is None and time.monotonic() >= _hydraulics_table_retry_at:
+        with _hydraulics_table_lock:
+            if _hydraulics_table is None and time.monotonic() >= _hydraulics_table_retry_at:
                 try:
-                    if 'n =' in line:
-                        n_str = line.split('n =')[1].split()[0]
-                    else:
-                        n_str = line.split('Therefore n =')[1].split()[0]
-                    properties['n'] = float(n_str)
-                except:
+                    _hydraulics_table = HydraulicsTable(HYDRAULICS_TABLE_DIR)
+                except FileNotFoundError:
                     pass
-    
-    # 计算可利用水分量
-    if 'field_capacity' in properties and 'wilting_point' in properties:
-        properties['available_water'] = round(
-            properties['field_capacity'] - properties['wilting_point'], 3)
-    
-    return properties
+                except Exception as e:
+                    print(f"加载水力特性表失败，{LOAD_RETRY_SECONDS}秒后重试: {str(e)}")
+                if _hydraulics_table is None:
+                    _hydraulics_table_retry_at = time.monotonic() + LOAD_RETRY_SECONDS
+    return _hydraulics_table
+
+def get_hydraulic_properties(code, models=None):
+    """
+    查询土壤代码的水力特性，优先使用预计算表，表中没有该代码时实时运行模型
+
+    参数:
+    models: 需要的模型名，默认全部
+
+    返回:
+    HydraulicsResult
+    """
+    models = resolve_models(models)
+    table = get_hydraulics_table()
+    if table is not None:
+        with metrics.stage("hydraulics_table"):
+            hydraulic_properties = table.lookup(code)
+        if hydraulic_properties is not None:
+            return select_models(hydraulic_properties, models)
+    return run_models_for_code(code, models)
 
-def get_soil_hydraulics(longitude, latitude, depth="0-5cm"):
+def get_soil_hydraulics(longitude, latitude, depth="0-5cm", derive_fraction=False, models=None, failures=None):
     """
     查询特定经纬度位置的土壤水力特性
     
     参数:
     longitude: 经度
     latitude: 纬度
-    depth: 土壤深度层
+    depth: 土壤深度层，只查询该深度层的质地
+    derive_fraction: 为True时粉粒含量由粘土和砂粒推导
+    models: 需要的模型名列表，默认全部；未选择的模型不运行
+    failures: 同query_coverages
     
     返回:
     dict: 包含土壤水力特性的字典
     """
     # 1. 获取土壤质地数据
-    texture_data = get_soil_texture(longitude, latitude)
+    if depth not in TEXTURE_DEPTHS:
+        return {"error": f"未找到深度为{depth}的土壤数据"}
+
+    texture_data = get_soil_texture_cached(longitude, latitude, [depth], derive_fraction, failures)
     
     # 2. 查找指定深度的数据
     target_data = None
@@ -452,14 +1166,15 @@ def get_soil_hydraulics(longitude, latitude, depth="0-5cm"):
     clay_percent = target_data["clay_percent"]
     silt_percent = target_data["silt_percent"]
     
-    # 4. 加载土壤数据
+    # 4. 加载土壤代码索引
     try:
-        soil_data = load_soil_data()
+        soil_code_index = get_soil_code_index()
     except Exception as e:
         return {"error": f"加载土壤数据失败: {str(e)}"}
     
     # 5. 查找最接近的土壤代码
-    closest_code = find_closest_soil_code(clay_percent, silt_percent, soil_data)
+    with metrics.stage("soil_code_lookup"):
+        closest_code = soil_code_index.nearest(clay_percent, silt_percent)
     closest_code = format_code(closest_code)
     
     # 6. 运行土壤水分模型并捕获所有输出
@@ -468,8 +1183,8 @@ def get_soil_hydraulics(longitude, latitude, depth="0-5cm"):
         model_start_time = time.time()
         print(f"开始运行土壤水分模型，土壤代码: {closest_code}")
         
-        # 运行模型并获取原始结果
-        hydraulic_properties = run_soil_moisture_models(closest_code)
+        # 查表或运行模型，得到结构化结果
+        hydraulic_properties = get_hydraulic_properties(closest_code, models)
         
         # 记录模型运行时间
         model_run_time = time.time() - model_start_time
@@ -492,7 +1207,7 @@ def get_soil_hydraulics(longitude, latitude, depth="0-5cm"):
                 "砂粒百分比": target_data["sand_percent"]
             },
             "土壤代码": closest_code,
-            "水力特性": hydraulic_properties
+            "水力特性": result_to_cn(hydraulic_properties)
         }
         
         # 同时提供英文版本的数据，确保API的通用性
@@ -508,30 +1223,13 @@ def get_soil_hydraulics(longitude, latitude, depth="0-5cm"):
                 "sand_percent": target_data["sand_percent"]
             },
             "soil_code": closest_code,
-            "hydraulic_properties": {
-                "field_capacity": hydraulic_properties.get("田间持水量"),
-                "wilting_point": hydraulic_properties.get("萎蔫点"),
-                "saturated_water_content": hydraulic_properties.get("饱和含水量"),
-                "Ks": hydraulic_properties.get("饱和导水率(cm/day)"),
-                "alpha": hydraulic_properties.get("范根参数alpha"),
-                "n": hydraulic_properties.get("范根参数n"),
-                "available_water": hydraulic_properties.get("有效水分量"),
-                "model_results": {}
-            }
+            "hydraulic_properties": result_to_en(hydraulic_properties)
         }
         
-        # 添加各个模型结果到英文数据
-        if "各模型结果" in hydraulic_properties:
-            for model_name, model_data in hydraulic_properties["各模型结果"].items():
-                response_en["hydraulic_properties"]["model_results"][model_name] = {
-                    "field_capacity": model_data.get("田间持水量"),
-                    "wilting_point": model_data.get("萎蔫点"),
-                    "saturated_water_content": model_data.get("饱和含水量"),
-                    "Ks": model_data.get("饱和导水率(cm/day)"),
-                    "alpha": model_data.get("范根参数alpha"),
-                    "n": model_data.get("范根参数n"),
-                    "available_water": model_data.get("有效水分量")
-                }
+        # 超时或出错的模型
+        if hydraulic_properties.errors:
+            response["未完成模型"] = hydraulic_properties.errors
+            response_en["incomplete_models"] = hydraulic_properties.errors
         
         # 合并两个响应
         final_response = {
@@ -563,6 +1261,26 @@ def get_soil_hydraulics(longitude, latitude, depth="0-5cm"):
             "水力特性": None
         }
 
+def get_soil_hydraulics_cached(longitude, latitude, depth="0-5cm", derive_fraction=False, models=None, failures=None):
+    """
+    带结果缓存的get_soil_hydraulics
+
+    缓存按像元、深度和模型集合共享，返回前把位置信息替换为本次请求的坐标；出错或有模型未完成的结果不缓存
+    """
+    models = resolve_models(models)
+    result = result_cache.get_or_compute(
+        pixel_cache_key("hydraulics", longitude, latitude, depth, int(derive_fraction), ",".join(models)),
+        lambda: get_soil_hydraulics(longitude, latitude, depth, derive_fraction, models, failures),
+        cacheable=lambda result: "中文数据" in result and "未完成模型" not in result["中文数据"]
+    )
+
+    if "中文数据" in result:
+        result["中文数据"]["位置信息"]["经度"] = longitude
+        result["中文数据"]["位置信息"]["纬度"] = latitude
+        result["英文数据"]["location"]["longitude"] = longitude
+        result["英文数据"]["location"]["latitude"] = latitude
+    return result
+
 @app.route('/api/soil-hydraulics', methods=['GET'])
 def soil_hydraulics_api():
     """土壤水力特性查询API端点"""
@@ -571,20 +1289,276 @@ def soil_hydraulics_api():
         longitude = float(request.args.get('longitude'))
         latitude = float(request.args.get('latitude'))
         depth = request.args.get('depth', "0-5cm")  # 默认为0-5cm深度
+        derive_fraction = parse_flag(request.args.get('derive'), DERIVE_FRACTION_DEFAULT)
+        models = [name for name in request.args.get('models', '').split(',') if name.strip()]
+        lang = request.args.get('lang')
         
         # 检查参数有效性
         if longitude < -180 or longitude > 180 or latitude < -90 or latitude > 90:
             return jsonify({"error": "经纬度参数无效，经度范围-180到180，纬度范围-90到90"}), 400
         
+        if lang and lang not in LANGUAGE_KEYS:
+            return jsonify({"error": f"lang参数只能为{'、'.join(LANGUAGE_KEYS)}"}), 400
+        
+        try:
+            models = resolve_models(models)
+            media_type = negotiate(request.accept_mimetypes, request.args.get('format'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        redirect_response = canonical_redirect(longitude, latitude)
+        if redirect_response is not None:
+            return redirect_response
+        
+        # 响应中包含请求坐标，ETag同时按坐标区分
+        table = get_hydraulics_table()
+        etag = response_etag("hydraulics", longitude, latitude, f"{longitude!r},{latitude!r}", depth,
+                             int(derive_fraction), ",".join(models), lang or "", media_type,
+                             table.version if table is not None else "")
+        cached_response = not_modified(etag)
+        if cached_response is not None:
+            return cached_response
+        
         # 执行查询
-        result = get_soil_hydraulics(longitude, latitude, depth)
+        failures = {}
+        result = get_soil_hydraulics_cached(longitude, latitude, depth, derive_fraction, models, failures)
+        if failures and "error" in result:
+            return upstream_unavailable(failures)
         
         # 返回结果
-        return jsonify(result)
+        response = encoded_response(select_language(result, lang), media_type)
+        complete = "中文数据" in result and "未完成模型" not in result["中文数据"]
+        return cacheable(response, etag) if complete else response
     
     except Exception as e:
         return jsonify({"error": f"查询出错: {str(e)}"}), 500
 
+# 单次代理模型批量请求允许的最大质地点数
+MAX_SURROGATE_POINTS = int(os.environ.get("SOIL_MAX_SURROGATE_POINTS", 1000000))
+
+_hydraulics_surrogate = None
+_hydraulics_surrogate_retry_at = 0.0
+_hydraulics_surrogate_lock = threading.Lock()
+
+def get_hydraulics_surrogate():
+    """
+    获取水力特性代理模型，首次调用时加载
+
+    不存在或加载失败时返回None，LOAD_RETRY_SECONDS秒后的调用再次尝试加载
+    """
+    global _hydraulics_surrogate, _hydraulics_surrogate_retry_at
+    if _hydraulics_surrogate is None and time.monotonic() >= _hydraulics_surrogate_retry_at:
+        with _hydraulics_surrogate_lock:
+            if _hydraulics_surrogate is None and time.monotonic() >= _hydraulics_surrogate_retry_at:
+                try:
+                    _hydraulics_surrogate = HydraulicsSurrogate(HYDRAULICS_SURROGATE_DIR)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    print(f"加载水力特性代理模型失败，{LOAD_RETRY_SECONDS}秒后重试: {str(e)}")
+                if _hydraulics_surrogate is None:
+                    _hydraulics_surrogate_retry_at = time.monotonic() + LOAD_RETRY_SECONDS
+    return _hydraulics_surrogate
+
+def get_soil_hydraulics_surrogate(clay, silt, sand=None, fields=None):
+    """
+    用代理模型批量计算水力特性
+
+    参数:
+    clay, silt: 粘土、粉粒百分比数组；给出sand时三者视为含量(如SoilGrids的g/kg)，先换算为百分比
+    fields: 需要的字段，默认全部
+
+    返回:
+    dict: {字段: float64数组}，质地无效的点为NaN；代理模型未构建时返回None
+    """
+    surrogate = get_hydraulics_surrogate()
+    if surrogate is None:
+        return None
+
+    clay = np.asarray(clay, dtype=np.float64)
+    silt = np.asarray(silt, dtype=np.float64)
+    if sand is not None:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            total = clay + silt + np.asarray(sand, dtype=np.float64)
+            total = np.where(total > 0, total, np.nan)
+            clay, silt = clay / total * 100, silt / total * 100
+
+    with metrics.stage("hydraulics_surrogate"):
+        return surrogate.interpolate(clay, silt, fields)
+
+@app.route('/api/soil-hydraulics/surrogate', methods=['GET'])
+def soil_hydraulics_surrogate_info_api():
+    """代理模型的版本、网格步长和精度报告"""
+    surrogate = get_hydraulics_surrogate()
+    if surrogate is None:
+        return jsonify({"error": "代理模型尚未构建，请先运行build_hydraulics_surrogate.py"}), 503
+    return jsonify(surrogate.meta)
+
+@app.route('/api/soil-hydraulics/surrogate', methods=['POST'])
+def soil_hydraulics_surrogate_api():
+    """代理模型批量水力特性API端点，请求和响应均为列式"""
+    try:
+        try:
+            media_type = negotiate(request.accept_mimetypes, request.args.get('format'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get("clay"), list) or \
+                not isinstance(body.get("silt"), list):
+            return jsonify({"error": "请求体需包含clay和silt数组"}), 400
+
+        clay, silt, sand = body["clay"], body["silt"], body.get("sand")
+        if len(clay) != len(silt) or (sand is not None and (not isinstance(sand, list) or len(sand) != len(clay))):
+            return jsonify({"error": "clay、silt(及sand)数组长度必须一致"}), 400
+        if len(clay) > MAX_SURROGATE_POINTS:
+            return jsonify({"error": f"单次最多计算{MAX_SURROGATE_POINTS}个质地点"}), 400
+
+        fields = body.get("fields") or SURROGATE_FIELDS
+        unknown = [field for field in fields if field not in SURROGATE_FIELDS]
+        if unknown:
+            return jsonify({"error": f"未知字段: {', '.join(map(str, unknown))}，可选字段: {', '.join(SURROGATE_FIELDS)}"}), 400
+
+        results = get_soil_hydraulics_surrogate(clay, silt, sand, fields)
+        if results is None:
+            return jsonify({"error": "代理模型尚未构建，请先运行build_hydraulics_surrogate.py"}), 503
+
+        columns = {field: np.where(np.isnan(values), None, np.round(values, 6)).tolist()
+                   for field, values in results.items()}
+        return encoded_response({"version": get_hydraulics_surrogate().version, "columns": columns}, media_type)
+
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"质地数组无效: {str(e)}"}), 400
+    except Exception as e:
+        return jsonify({"error": f"查询出错: {str(e)}"}), 500
+
+# 批量任务数据库、每个进程的后台线程数和单个任务的最大坐标数
+JOBS_DB_PATH = os.environ.get("SOIL_JOBS_DB_PATH", os.path.join(current_dir, "jobs.sqlite3"))
+JOB_WORKERS = int(os.environ.get("SOIL_JOB_WORKERS", 4))
+MAX_JOB_POINTS = int(os.environ.get("SOIL_MAX_JOB_POINTS", 200000))
+
+def check_job_failures(failures):
+    """批量任务的坐标有coverage查询失败时抛出异常，该点记为failed，不返回缺少深度层的结果"""
+    if failures:
+        report = failure_report(failures)
+        raise RuntimeError(f"上游查询失败: {','.join(report['missing'])}"
+                           + (f"(限流: {','.join(report['throttled'])})" if report["throttled"] else ""))
+
+def run_texture_job_point(longitude, latitude, params):
+    """批量任务: 查询单个坐标的土壤质地(上游请求使用bulk优先级)"""
+    failures = {}
+    with upstream_lane(BULK):
+        result = get_soil_texture_cached(longitude, latitude, derive_fraction=params.get("derive", False),
+                                         failures=failures)
+    check_job_failures(failures)
+    return result
+
+def run_hydraulics_job_point(longitude, latitude, params):
+    """批量任务: 查询单个坐标的土壤水力特性(上游请求使用bulk优先级)"""
+    failures = {}
+    with upstream_lane(BULK):
+        result = get_soil_hydraulics_cached(longitude, latitude, params.get("depth", "0-5cm"),
+                                            params.get("derive", False), params.get("models"), failures)
+    check_job_failures(failures)
+    return result
+
+job_manager = JobManager(JOBS_DB_PATH, {
+    "texture": run_texture_job_point,
+    "hydraulics": run_hydraulics_job_point,
+}, workers=JOB_WORKERS)
+
+@app.before_request
+def start_job_workers():
+    """
+    在处理请求的进程中启动批量任务后台线程，重启后自动继续未完成的任务
+
+    gunicorn部署时由gunicorn.conf.py的post_fork在工作进程启动时调用，这里保证直接运行Flask时也会启动
+    """
+    job_manager.ensure_started()
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job_api():
+    """创建批量任务API端点，上传坐标CSV(multipart的file字段或text/csv请求体)"""
+    try:
+        kind = request.args.get('kind', 'texture')
+        if kind not in ("texture", "hydraulics"):
+            return jsonify({"error": "kind参数只能为texture或hydraulics"}), 400
+
+        upload = request.files.get('file')
+        text = upload.read().decode('utf-8-sig') if upload else request.get_data(as_text=True)
+
+        params = {"derive": parse_flag(request.args.get('derive'), DERIVE_FRACTION_DEFAULT)}
+        if kind == "hydraulics":
+            depth = request.args.get('depth', "0-5cm")
+            if depth not in TEXTURE_DEPTHS:
+                return jsonify({"error": f"深度参数无效，可选深度: {', '.join(TEXTURE_DEPTHS)}"}), 400
+            params["depth"] = depth
+            params["models"] = list(resolve_models(
+                [name for name in request.args.get('models', '').split(',') if name.strip()]))
+
+        points = parse_points_csv(text, MAX_JOB_POINTS)
+        job_id = job_manager.create_job(kind, points, params)
+
+        return jsonify(job_manager.get_job(job_id)), 202
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"创建任务出错: {str(e)}"}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status_api(job_id):
+    """批量任务进度API端点"""
+    job = job_manager.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在"}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/results', methods=['GET'])
+def job_results_api(job_id):
+    """
+    批量任务结果API端点，以NDJSON按完成顺序返回
+
+    follow=true时为长轮询: 没有新结果时最多等待FOLLOW_MAX_SECONDS秒，返回已有的新结果后即结束，
+    客户端以after=最后一行的cursor再次请求
+    """
+    if job_manager.get_job(job_id) is None:
+        return jsonify({"error": "任务不存在"}), 404
+    follow = parse_flag(request.args.get('follow'))
+    try:
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        return jsonify({"error": "after参数必须是整数"}), 400
+    return Response(job_manager.iter_results(job_id, follow, after), mimetype="application/x-ndjson")
+
+def warm_up():
+    """
+    预热: 加载土壤代码索引、水力特性表和代理模型，导入栅格解码和土壤水分模型依赖
+
+    gunicorn以preload_app启动时在主进程中调用一次(见gunicorn.conf.py)，fork出的工作进程直接共享
+    这些只读数据。各项失败只打印日志: 土壤代码索引和依赖在首次使用时再次尝试，水力特性表和代理模型
+    在LOAD_RETRY_SECONDS秒后的首次使用时再次尝试
+
+    返回:
+    dict: 各项耗时(秒)
+    """
+    steps = [
+        ("soil_code_index", get_soil_code_index),
+        ("hydraulics_table", get_hydraulics_table),
+        ("hydraulics_surrogate", get_hydraulics_surrogate),
+        ("rasterio", lambda: importlib.import_module("rasterio.io")),
+        ("model_package", model_package),
+    ]
+    timings = {}
+    for name, load in steps:
+        start = time.perf_counter()
+        try:
+            load()
+        except Exception as e:
+            print(f"预热{name}失败: {str(e)}")
+        timings[name] = round(time.perf_counter() - start, 3)
+    return timings
+
 if __name__ == '__main__':
     # 确保在正确的目录启动
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
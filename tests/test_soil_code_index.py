@@ -0,0 +1,80 @@
+"""SoilCodeIndex的格子候选查找与逐条比较的find_closest_soil_code一致"""
+import random
+
+import numpy as np
+import pytest
+
+from soil_code_index import SoilCodeIndex, find_closest_soil_code
+
+
+def make_soil_data(step, seed=0):
+    """按step百分点生成土壤数据库，附加距离相等的重复代码、砂粒不等于余量的代码和含NaN的代码"""
+    rng = random.Random(seed)
+    soil_data = {}
+    for clay in range(0, 101, step):
+        for silt in range(0, 101 - clay, step):
+            soil_data[f"{clay:02d}{silt:02d}"] = {"clay": clay, "silt": silt, "sand": 100 - clay - silt}
+    soil_data["dup0"] = {"clay": 0, "silt": 0, "sand": 100}
+    soil_data["dup1"] = {"clay": step, "silt": step, "sand": 100 - 2 * step}
+    for position in range(20):
+        clay, silt = rng.uniform(0, 60), rng.uniform(0, 40)
+        soil_data[f"odd{position}"] = {"clay": clay, "silt": silt, "sand": 100 - clay - silt + rng.uniform(-3, 3)}
+    soil_data["nan0"] = {"clay": float("nan"), "silt": 10, "sand": 90}
+    return soil_data
+
+
+def sample_inputs(step, seed=0):
+    rng = random.Random(seed)
+    clays, silts = [], []
+    for _ in range(1000):
+        clay = round(rng.uniform(0, 100), 2)
+        clays.append(clay)
+        silts.append(round(rng.uniform(0, 100 - clay), 2))
+    # 格子边界、相邻代码的中点(距离相等)
+    for clay in range(0, 100, 1):
+        for silt in (0, step / 2, 50 - clay / 2, 100 - clay):
+            clays.append(float(clay) + step / 2 * (clay % 2))
+            silts.append(float(silt))
+    # 质地三角形外、越界及NaN
+    clays += [60.0, 100.0, -1.0, 120.0, float("nan"), 5.0, float("nan")]
+    silts += [60.0, 0.0, 10.0, 0.0, 5.0, float("nan"), float("nan")]
+    return clays, silts
+
+
+@pytest.mark.parametrize("step", [1, 2, 5, 10])
+def test_matches_find_closest_soil_code(step):
+    soil_data = make_soil_data(step)
+    index = SoilCodeIndex(soil_data)
+    clays, silts = sample_inputs(step)
+
+    expected = [find_closest_soil_code(clay, silt, soil_data) for clay, silt in zip(clays, silts)]
+    assert index.nearest_many(clays, silts) == expected
+    assert [index.nearest(clay, silt) for clay, silt in zip(clays, silts)] == expected
+
+
+def test_ties_pick_first_code():
+    soil_data = {"b": {"clay": 10, "silt": 10, "sand": 80}, "a": {"clay": 10, "silt": 10, "sand": 80},
+                 "c": {"clay": 12, "silt": 10, "sand": 78}}
+    index = SoilCodeIndex(soil_data)
+    assert index.nearest(10, 10) == find_closest_soil_code(10, 10, soil_data) == "b"
+    # 与b、c距离相等
+    assert index.nearest(11, 10) == find_closest_soil_code(11, 10, soil_data) == "b"
+
+
+def test_nan_inputs_and_codes():
+    soil_data = {"nan": {"clay": float("nan"), "silt": 0, "sand": 100}, "0505": {"clay": 5, "silt": 5, "sand": 90}}
+    index = SoilCodeIndex(soil_data)
+    assert index.nearest(0, 0) == find_closest_soil_code(0, 0, soil_data) == "0505"
+    assert index.nearest(float("nan"), 0) is None
+    assert index.nearest_indices([float("nan"), 5.0], [1.0, float("nan")]).tolist() == [-1, -1]
+
+    empty = SoilCodeIndex({"nan": {"clay": float("nan"), "silt": 0, "sand": 100}})
+    assert empty.nearest(10, 10) is None
+
+
+def test_pruned_lookup_matches_full_scan():
+    index = SoilCodeIndex(make_soil_data(2, seed=1))
+    rng = np.random.default_rng(1)
+    clays = np.round(rng.uniform(0, 70, 50000), 2)
+    silts = np.round(rng.uniform(0, 30, 50000), 2)
+    assert np.array_equal(index.nearest_indices(clays, silts), index._scan(clays, silts))
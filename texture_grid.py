@@ -0,0 +1,99 @@
+"""
+格网土壤质地计算与编码
+
+整块栅格的粘土、砂粒、粉粒占比和土壤代码都以数组运算完成，结果编码为NumPy .npz或多波段GeoTIFF。
+"""
+import io
+import math
+
+import numpy as np
+
+# 单次格网请求允许的最大像元数，更大的范围需分块请求
+MAX_GRID_CELLS = 250000
+# 流式返回时每块的字节数
+CHUNK_SIZE = 1024 * 1024
+
+
+def grid_shape(west, south, east, north, resolution):
+    """
+    计算格网的行列数
+
+    返回:
+    tuple: (height, width)
+    """
+    width = max(1, int(math.ceil(round((east - west) / resolution, 6))))
+    height = max(1, int(math.ceil(round((north - south) / resolution, 6))))
+    return height, width
+
+
+def compose_texture_grid(clay, sand, silt):
+    """
+    由粘土、砂粒、粉粒含量数组计算各组分占比
+
+    任一组分缺失(负值为SoilGrids的无数据值)或总量不为正的像元为NaN
+
+    返回:
+    dict: {"clay_percent": ..., "sand_percent": ..., "silt_percent": ...}，float64数组
+    """
+    clay = np.asarray(clay, dtype=np.float64)
+    sand = np.asarray(sand, dtype=np.float64)
+    silt = np.asarray(silt, dtype=np.float64)
+
+    total = clay + sand + silt
+    valid = (clay >= 0) & (sand >= 0) & (silt >= 0) & (total > 0)
+    safe_total = np.where(valid, total, 1.0)
+
+    layers = {}
+    for name, values in (("clay", clay), ("sand", sand), ("silt", silt)):
+        percent = np.round(values / safe_total * 100, 2)
+        layers[f"{name}_percent"] = np.where(valid, percent, np.nan)
+    return layers
+
+
+def codes_to_numbers(codes):
+    """把土壤代码列表转换为整数数组，无法转换的代码为-1"""
+    return np.array([int(code) if code is not None and code.isdigit() else -1 for code in codes],
+                    dtype=np.int32)
+
+
+def encode_npz(layers, meta):
+    """
+    编码为NumPy .npz
+
+    参数:
+    layers: {图层名: 二维数组}
+    meta: 格网元数据(范围、分辨率等)，以同名数组保存
+    """
+    buffer = io.BytesIO()
+    arrays = dict(layers)
+    for key, value in meta.items():
+        arrays[f"meta_{key}"] = np.asarray(value)
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def encode_geotiff(layers, west, north, resolution):
+    """
+    编码为多波段float32 GeoTIFF，每个图层一个波段，波段描述为图层名
+    """
+    from rasterio.io import MemoryFile
+    from rasterio.transform import Affine
+
+    names = list(layers)
+    height, width = layers[names[0]].shape
+    transform = Affine(resolution, 0.0, west, 0.0, -resolution, north)
+
+    with MemoryFile() as memfile:
+        with memfile.open(driver="GTiff", width=width, height=height, count=len(names),
+                          dtype="float32", crs="EPSG:4326", transform=transform,
+                          nodata=float("nan"), compress="deflate", tiled=True) as dataset:
+            for band, name in enumerate(names, 1):
+                dataset.write(layers[name].astype(np.float32), band)
+                dataset.set_band_description(band, name)
+        return memfile.read()
+
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    """按块返回字节数据，用于分块传输"""
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
@@ -0,0 +1,210 @@
+"""
+区域质地数据包
+
+把一个矩形区域内各coverage的栅格按SoilGrids像元网格保存在单个内存映射数组中，查询时按像元索引直接取值，
+不访问上游。由prefetch_region.py分块下载生成，中断后可继续下载未完成的块。
+
+目录结构:
+    manifest.json  区域范围(像元索引)、coverage列表、单位等元数据
+    texture.npy    int16数组 (coverage数, 行数, 列数)，行自北向南，未下载的像元为NODATA
+    chunks.npy     uint8数组 (coverage数, 块行数, 块列数)，已下载完成的块为1
+"""
+import json
+import math
+import os
+import tempfile
+
+import numpy as np
+
+from raster_store import PIXEL_DEGREES, pixel_index
+
+MANIFEST_FILE = "manifest.json"
+DATA_FILE = "texture.npy"
+CHUNKS_FILE = "chunks.npy"
+
+# 每次下载的块大小(像元)，250像元为0.5度
+CHUNK_PIXELS = 250
+NODATA = -32768
+
+
+def region_pixels(west, south, east, north):
+    """
+    把地理范围扩展到像元边界
+
+    返回:
+    tuple: (px0, py0, px1, py1)，像元索引范围，px1、py1不含
+    """
+    px0, py0 = pixel_index(west, south)
+    px1 = int(math.ceil(round((east + 180.0) / PIXEL_DEGREES, 6)))
+    py1 = int(math.ceil(round((north + 90.0) / PIXEL_DEGREES, 6)))
+    return px0, py0, max(px1, px0 + 1), max(py1, py0 + 1)
+
+
+def pixel_bounds(px0, py0, px1, py1):
+    """像元索引范围对应的地理范围 (west, south, east, north)"""
+    return (round(px0 * PIXEL_DEGREES - 180.0, 6), round(py0 * PIXEL_DEGREES - 90.0, 6),
+            round(px1 * PIXEL_DEGREES - 180.0, 6), round(py1 * PIXEL_DEGREES - 90.0, 6))
+
+
+def write_manifest(directory, manifest):
+    """原子写入manifest.json"""
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST_FILE))
+
+
+class TexturePack(object):
+    """
+    区域质地数据包
+
+    参数:
+    directory: 数据包目录
+    writable: 为True时以读写方式映射(供prefetch_region.py写入)
+    """
+
+    def __init__(self, directory, writable=False):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILE), "r", encoding="utf-8") as file:
+            self.manifest = json.load(file)
+
+        self.px0, self.py0, self.px1, self.py1 = self.manifest["pixels"]
+        self.coverage_ids = self.manifest["coverages"]
+        self.coverage_index = {coverage_id: index for index, coverage_id in enumerate(self.coverage_ids)}
+        mode = "r+" if writable else "r"
+        self.data = np.load(os.path.join(directory, DATA_FILE), mmap_mode=mode)
+        self.chunks = np.load(os.path.join(directory, CHUNKS_FILE), mmap_mode=mode)
+
+    @classmethod
+    def create(cls, directory, west, south, east, north, coverages):
+        """
+        创建空数据包
+
+        参数:
+        coverages: [(service_id, coverage_id), ...]
+        """
+        px0, py0, px1, py1 = region_pixels(west, south, east, north)
+        height, width = py1 - py0, px1 - px0
+        os.makedirs(directory, exist_ok=True)
+
+        data = np.lib.format.open_memmap(os.path.join(directory, DATA_FILE), mode="w+", dtype=np.int16,
+                                         shape=(len(coverages), height, width))
+        data[:] = NODATA
+        data.flush()
+        del data
+        chunk_shape = (len(coverages), math.ceil(height / CHUNK_PIXELS), math.ceil(width / CHUNK_PIXELS))
+        np.save(os.path.join(directory, CHUNKS_FILE), np.zeros(chunk_shape, dtype=np.uint8))
+
+        write_manifest(directory, {
+            "pixels": [px0, py0, px1, py1],
+            "bounds": list(pixel_bounds(px0, py0, px1, py1)),
+            "pixel_degrees": PIXEL_DEGREES,
+            "chunk_pixels": CHUNK_PIXELS,
+            "coverages": [coverage_id for _, coverage_id in coverages],
+            "services": {coverage_id: service_id for service_id, coverage_id in coverages},
+            "units": {},
+        })
+        return cls(directory, writable=True)
+
+    def contains(self, px, py):
+        return self.px0 <= px < self.px1 and self.py0 <= py < self.py1
+
+    def chunk_window(self, cy, cx):
+        """
+        块在数组中的行列范围及对应的地理范围
+
+        返回:
+        tuple: ((row0, row1, col0, col1), (west, south, east, north))
+        """
+        height, width = self.data.shape[1:]
+        row0, col0 = cy * CHUNK_PIXELS, cx * CHUNK_PIXELS
+        row1, col1 = min(height, row0 + CHUNK_PIXELS), min(width, col0 + CHUNK_PIXELS)
+        bounds = pixel_bounds(self.px0 + col0, self.py1 - row1, self.px0 + col1, self.py1 - row0)
+        return (row0, row1, col0, col1), bounds
+
+    def pending_chunks(self):
+        """未下载完成的块 [(coverage序号, cy, cx), ...]"""
+        return [tuple(index) for index in np.argwhere(self.chunks == 0).tolist()]
+
+    def write_chunk(self, coverage_index, cy, cx, array, unit):
+        """写入一个块并标记为已完成"""
+        (row0, row1, col0, col1), _ = self.chunk_window(cy, cx)
+        self.data[coverage_index, row0:row1, col0:col1] = array
+        self.data.flush()
+        self.chunks[coverage_index, cy, cx] = 1
+        self.chunks.flush()
+
+        coverage_id = self.coverage_ids[coverage_index]
+        if self.manifest["units"].get(coverage_id) != unit:
+            self.manifest["units"][coverage_id] = unit
+            write_manifest(self.directory, self.manifest)
+
+    def read(self, coverage_id, longitude, latitude):
+        """
+        读取像元值
+
+        返回:
+        tuple: (value, unit)；不在范围内、不含该coverage或所在块尚未下载时返回None
+        """
+        index = self.coverage_index.get(coverage_id)
+        if index is None:
+            return None
+        px, py = pixel_index(longitude, latitude)
+        if not self.contains(px, py):
+            return None
+
+        row, col = self.py1 - 1 - py, px - self.px0
+        if not self.chunks[index, row // CHUNK_PIXELS, col // CHUNK_PIXELS]:
+            return None
+        return self.data[index, row, col], self.manifest["units"].get(coverage_id)
+
+
+class TexturePackIndex(object):
+    """
+    目录下全部数据包的空间索引
+
+    各数据包的像元范围保存为数组，查询时向量化筛选包含该像元的数据包
+
+    参数:
+    root: 数据包根目录，每个子目录为一个数据包；目录不存在时索引为空
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.packs = []
+        if os.path.isdir(root):
+            for name in sorted(os.listdir(root)):
+                directory = os.path.join(root, name)
+                if not os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+                    continue
+                try:
+                    self.packs.append(TexturePack(directory))
+                except Exception as e:
+                    print(f"加载质地数据包{directory}失败: {str(e)}")
+        self.bounds = np.array([[pack.px0, pack.py0, pack.px1, pack.py1] for pack in self.packs],
+                               dtype=np.int64).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.packs)
+
+    def find(self, longitude, latitude):
+        """包含该坐标的数据包列表"""
+        if not self.packs:
+            return []
+        px, py = pixel_index(longitude, latitude)
+        mask = ((self.bounds[:, 0] <= px) & (px < self.bounds[:, 2])
+                & (self.bounds[:, 1] <= py) & (py < self.bounds[:, 3]))
+        return [self.packs[index] for index in np.flatnonzero(mask)]
+
+    def read(self, coverage_id, longitude, latitude):
+        """
+        从数据包读取像元值
+
+        返回:
+        tuple: (value, unit)，没有数据包覆盖该像元时返回None
+        """
+        for pack in self.find(longitude, latitude):
+            value = pack.read(coverage_id, longitude, latitude)
+            if value is not None:
+                return value
+        return None
@@ -0,0 +1,290 @@
+"""
+上游请求调度
+
+所有gunicorn工作进程(以及prefetch_region.py)共享一个按上游配额设置的令牌桶，状态保存在文件中并以文件锁
+保护。请求分为interactive(页面和API查询)和bulk(批量任务、离线预取)两个优先级: bulk只在令牌数高于预留
+值时才能取得令牌，进程内有interactive请求等待时bulk让行。上游返回429或5xx时令牌速率减半并暂停发送，
+之后每次成功逐步恢复(加性增、乘性减)。
+
+排队等待令牌期间，同一coverage的相邻瓦片请求合并为一次覆盖全部瓦片的窗口下载(TileBatcher)。
+"""
+import contextvars
+import os
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import metrics
+from raster_store import TILE_PIXELS, tile_bounds
+
+try:
+    import fcntl
+except ImportError:  # Windows下令牌桶只在进程内共享
+    fcntl = None
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# 当前请求所属的优先级，批量任务和离线预取在lane(BULK)中执行
+_current_lane = contextvars.ContextVar("upstream_lane", default=INTERACTIVE)
+
+# 令牌桶状态: 令牌数、更新时间、速率系数、暂停截止时间
+_STATE = struct.Struct("<dddd")
+
+# 被限流后速率系数的下限，以及每次成功请求恢复的系数
+MIN_RATE_FACTOR = 0.05
+RECOVERY_STEP = 0.05
+# 未给出Retry-After时被限流后暂停的基础时长(秒)，速率系数越小暂停越久
+THROTTLE_BACKOFF = 1.0
+# 等待令牌时单次休眠的最长时间(秒)，保证interactive请求到达后bulk能及时让行
+MAX_SLEEP = 0.25
+
+
+class UpstreamThrottled(Exception):
+    """等待上游配额超过上限"""
+
+
+@contextmanager
+def lane(name):
+    """在指定优先级下执行上游请求"""
+    token = _current_lane.set(name)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def current_lane():
+    return _current_lane.get()
+
+
+class UpstreamScheduler(object):
+    """
+    跨进程令牌桶
+
+    参数:
+    state_path: 令牌桶状态文件，各进程共享
+    rate: 每秒令牌数(上游配额)，为0时不限速
+    burst: 令牌桶容量
+    bulk_reserve: 为interactive请求预留的令牌比例，bulk请求不能使用
+    max_wait: 各优先级等待令牌的最长时间(秒)
+    """
+
+    def __init__(self, state_path, rate=10.0, burst=20.0, bulk_reserve=0.5, max_wait=None):
+        self.state_path = state_path
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.bulk_reserve = bulk_reserve
+        self.max_wait = max_wait or {INTERACTIVE: 20.0, BULK: 600.0}
+        self._lock = threading.Lock()
+        self._memory_state = None
+        self._interactive_waiting = 0
+
+    @contextmanager
+    def _state(self):
+        """加锁读取令牌桶状态，退出时写回；yield的列表可原地修改"""
+        with self._lock:
+            if fcntl is None:
+                if self._memory_state is None:
+                    self._memory_state = [self.burst, time.time(), 1.0, 0.0]
+                yield self._memory_state
+                return
+
+            os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+            fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = os.pread(fd, _STATE.size, 0)
+                state = list(_STATE.unpack(data)) if len(data) == _STATE.size else [self.burst, time.time(), 1.0, 0.0]
+                yield state
+                os.pwrite(fd, _STATE.pack(*state), 0)
+            finally:
+                os.close(fd)
+
+    def _try_take(self, lane_name):
+        """
+        尝试取得一个令牌
+
+        返回:
+        float: 0表示已取得，否则为预计还需等待的秒数
+        """
+        with self._state() as state:
+            tokens, updated, factor, paused_until = state
+            now = time.time()
+            rate = self.rate * factor
+            tokens = min(self.burst, tokens + max(0.0, now - updated) * rate)
+            state[0], state[1] = tokens, now
+            if now < paused_until:
+                return paused_until - now
+
+            floor = self.burst * self.bulk_reserve if lane_name == BULK else 0.0
+            if tokens - 1 >= floor:
+                state[0] = tokens - 1
+                return 0.0
+            return (floor + 1 - tokens) / rate
+
+    def acquire(self, lane_name=None, lane_of=None):
+        """
+        取得一个上游请求令牌，必要时阻塞等待
+
+        参数:
+        lane_name: 优先级，默认为当前上下文的优先级
+        lane_of: 返回优先级的函数，等待期间每轮重新读取；用于TileBatcher在interactive请求加入bulk批次后
+                 提升批次的优先级
+
+        异常:
+        UpstreamThrottled: 等待超过初始优先级的max_wait
+        """
+        if not self.rate:
+            return
+        if lane_of is None:
+            fixed_lane = lane_name or current_lane()
+            lane_of = lambda: fixed_lane
+        initial = lane_of()
+        deadline = time.monotonic() + self.max_wait.get(initial, self.max_wait[INTERACTIVE])
+
+        counted = False
+        try:
+            with metrics.stage("upstream_wait"):
+                while True:
+                    lane_name = lane_of()
+                    interactive = lane_name != BULK
+                    if interactive and not counted:
+                        with self._lock:
+                            self._interactive_waiting += 1
+                        counted = True
+                    if interactive or not self._interactive_waiting:
+                        wait = self._try_take(lane_name)
+                        if not wait:
+                            return
+                    else:
+                        wait = MAX_SLEEP
+                    if time.monotonic() + wait > deadline:
+                        metrics.inc("soil_upstream_throttled_total", {"lane": lane_name, "reason": "queue"})
+                        raise UpstreamThrottled(f"等待上游配额超过{self.max_wait.get(initial)}秒")
+                    time.sleep(min(wait, MAX_SLEEP))
+        finally:
+            if counted:
+                with self._lock:
+                    self._interactive_waiting -= 1
+
+    def report(self, status, retry_after=None):
+        """
+        根据上游响应调整速率: 429和5xx时速率减半并暂停，其他响应逐步恢复
+
+        参数:
+        status: HTTP状态码
+        retry_after: 响应的Retry-After(秒)
+        """
+        if not self.rate:
+            return
+        throttled = status == 429 or status >= 500
+        with self._state() as state:
+            if throttled:
+                state[2] = max(MIN_RATE_FACTOR, state[2] / 2)
+                pause = retry_after if retry_after is not None else THROTTLE_BACKOFF / state[2]
+                state[3] = max(state[3], time.time() + pause)
+                state[0] = 0.0
+            elif state[2] < 1.0:
+                state[2] = min(1.0, state[2] + RECOVERY_STEP)
+        if throttled:
+            metrics.inc("soil_upstream_throttled_total", {"lane": current_lane(), "reason": str(status)})
+
+    def rate_factor(self):
+        """当前速率系数(1为满速)"""
+        with self._state() as state:
+            return state[2]
+
+
+class TileBatcher(object):
+    """
+    合并排队中的瓦片下载
+
+    第一个请求成为批次的发起者并等待令牌，等待期间同一coverage、与批次范围合计不超过span x span个瓦片的
+    请求加入该批次；取得令牌后一次下载覆盖批次内全部瓦片的窗口，拆分保存后分别返回。批次按加入者中
+    最高的优先级取令牌: interactive请求加入bulk发起的批次时，批次提升为interactive，不再为其他
+    interactive请求让行
+
+    参数:
+    store: RasterWindowStore
+    scheduler: UpstreamScheduler
+    fetch: 下载函数，签名为 fetch(service_id, coverage_id, west, south, east, north, width, height, acquired=True)
+    span: 单个批次在经纬方向上最多覆盖的瓦片数
+    """
+
+    def __init__(self, store, scheduler, fetch, span=10):
+        self.store = store
+        self.scheduler = scheduler
+        self.fetch = fetch
+        self.span = span
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def _join(self, coverage_id, ix, iy):
+        """加入可容纳该瓦片的批次或新建批次，返回 (批次, Future, 是否为发起者)"""
+        with self._lock:
+            for batch in self._batches.get(coverage_id, []):
+                x0, x1 = min(batch["x0"], ix), max(batch["x1"], ix)
+                y0, y1 = min(batch["y0"], iy), max(batch["y1"], iy)
+                if x1 - x0 < self.span and y1 - y0 < self.span:
+                    batch.update(x0=x0, x1=x1, y0=y0, y1=y1)
+                    if current_lane() != BULK:
+                        batch["lane"] = INTERACTIVE
+                    future = batch["tiles"].setdefault((ix, iy), Future())
+                    return batch, future, False
+
+            future = Future()
+            batch = {"x0": ix, "x1": ix, "y0": iy, "y1": iy, "lane": current_lane(), "tiles": {(ix, iy): future}}
+            self._batches.setdefault(coverage_id, []).append(batch)
+            return batch, future, True
+
+    def _close(self, coverage_id, batch):
+        with self._lock:
+            batches = self._batches.get(coverage_id, [])
+            batches.remove(batch)
+            if not batches:
+                self._batches.pop(coverage_id, None)
+
+    def fetch_tile(self, service_id, coverage_id, ix, iy):
+        """
+        下载并保存一个瓦片，与排队中的同coverage瓦片合并下载
+
+        返回:
+        瓦片像元数组
+        """
+        batch, future, leader = self._join(coverage_id, ix, iy)
+        if not leader:
+            return future.result()
+
+        try:
+            self.scheduler.acquire(lane_of=lambda: batch["lane"])
+        except BaseException as e:
+            self._close(coverage_id, batch)
+            for waiter in batch["tiles"].values():
+                waiter.set_exception(e)
+            raise
+        self._close(coverage_id, batch)
+
+        x0, x1, y0, y1 = batch["x0"], batch["x1"], batch["y0"], batch["y1"]
+        west, south = tile_bounds(x0, y0)[:2]
+        east, north = tile_bounds(x1, y1)[2:]
+        nx, ny = x1 - x0 + 1, y1 - y0 + 1
+        try:
+            # 被限流后的重试也按批次的优先级取令牌
+            with lane(batch["lane"]):
+                array, unit = self.fetch(service_id, coverage_id, west, south, east, north,
+                                         nx * TILE_PIXELS, ny * TILE_PIXELS, acquired=True)
+            self.store.put_window(coverage_id, x0, y0, array, unit)
+        except BaseException as e:
+            for waiter in batch["tiles"].values():
+                waiter.set_exception(e)
+            raise
+
+        if len(batch["tiles"]) > 1:
+            metrics.inc("soil_upstream_batched_tiles_total", {"coverage_id": coverage_id}, len(batch["tiles"]))
+        for (tile_x, tile_y), waiter in batch["tiles"].items():
+            row, col = (y1 - tile_y) * TILE_PIXELS, (tile_x - x0) * TILE_PIXELS
+            waiter.set_result(array[row:row + TILE_PIXELS, col:col + TILE_PIXELS])
+        return future.result()
@@ -0,0 +1,155 @@
+"""
+SoilGrids WCS客户端
+
+每个工作进程复用一个带连接池的HTTP会话(keep-alive)，返回的GeoTIFF直接在内存中解码，
+不经过临时文件。rasterio在首次解码时才导入。
+
+每次请求先从upstream_scheduler的跨进程令牌桶取得令牌；上游返回429或5xx时降低速率并重试。
+"""
+import os
+import tempfile
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from upstream_scheduler import UpstreamScheduler, UpstreamThrottled
+
+# SoilGrids WCS服务地址，{service_id}为属性名(clay、sand等)
+WCS_URL_TEMPLATE = os.environ.get("SOILGRIDS_WCS_URL", "https://maps.isric.org/mapserv?map=/map/{service_id}.map")
+WCS_TIMEOUT = float(os.environ.get("SOILGRIDS_WCS_TIMEOUT", 30))
+POOL_SIZE = int(os.environ.get("SOILGRIDS_WCS_POOL_SIZE", 16))
+
+# 上游配额: 每秒请求数(为0时不限速)、令牌桶容量及为交互查询预留的比例，状态文件在各进程间共享
+scheduler = UpstreamScheduler(
+    os.environ.get("SOILGRIDS_WCS_QUOTA_FILE", os.path.join(tempfile.gettempdir(), "soil_api_upstream_quota")),
+    rate=float(os.environ.get("SOILGRIDS_WCS_RATE", 10)),
+    burst=float(os.environ.get("SOILGRIDS_WCS_BURST", 20)),
+    bulk_reserve=float(os.environ.get("SOILGRIDS_WCS_BULK_RESERVE", 0.5)),
+)
+# 被限流(429、5xx)后的重试次数
+THROTTLE_RETRIES = 2
+
+# SoilGrids发布数据的存储单位(整数化后的单位)
+PROPERTY_UNITS = {
+    "bdod": "cg/cm³",
+    "cec": "mmol(c)/kg",
+    "cfvo": "cm³/dm³",
+    "clay": "g/kg",
+    "nitrogen": "cg/kg",
+    "phh2o": "pH*10",
+    "sand": "g/kg",
+    "silt": "g/kg",
+    "soc": "dg/kg",
+    "ocd": "hg/m³",
+    "ocs": "t/ha",
+}
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    获取当前进程的HTTP会话
+
+    会话在首次使用时创建；gunicorn预加载后fork出的子进程会重新创建，避免共享父进程的连接
+    """
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+            _session_pid = os.getpid()
+    return _session
+
+
+def coverage_url(service_id):
+    """返回属性对应的WCS服务地址"""
+    return WCS_URL_TEMPLATE.format(service_id=service_id)
+
+
+def retry_after_seconds(response):
+    """解析Retry-After响应头(秒数形式)，没有或无法解析时返回None"""
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def is_throttled(error):
+    """查询失败是否因上游限流: 等待配额超时，或重试后上游仍返回429"""
+    if isinstance(error, UpstreamThrottled):
+        return True
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.HTTPError) and response is not None and response.status_code == 429
+
+
+def fetch_coverage(service_id, coverage_id, west, south, east, north, width, height, acquired=False):
+    """
+    通过WCS GetCoverage下载指定范围的栅格并在内存中解码
+
+    参数:
+    acquired: 调用方已从scheduler取得令牌(见TileBatcher)，首次请求不再取令牌
+
+    返回:
+    tuple: (二维数组, 单位)，数组行顺序自北向南
+
+    异常:
+    requests.HTTPError: 上游返回错误状态码(重试后仍被限流时为最后一次的429或5xx)
+    """
+    params = {
+        "SERVICE": "WCS",
+        "VERSION": "1.0.0",
+        "REQUEST": "GetCoverage",
+        "COVERAGE": coverage_id,
+        "CRS": "urn:ogc:def:crs:EPSG::4326",
+        "BBOX": f"{west},{south},{east},{north}",
+        "WIDTH": width,
+        "HEIGHT": height,
+        "FORMAT": "GEOTIFF_INT16",
+    }
+
+    for attempt in range(THROTTLE_RETRIES + 1):
+        if not acquired:
+            scheduler.acquire()
+        acquired = False
+
+        try:
+            with metrics.in_flight("soil_upstream_in_flight"), metrics.stage("wcs_download", coverage_id):
+                response = get_session().get(coverage_url(service_id), params=params, timeout=WCS_TIMEOUT)
+        except requests.RequestException:
+            metrics.inc("soil_upstream_requests_total", {"coverage_id": coverage_id, "status": "error"})
+            raise
+        metrics.inc("soil_upstream_requests_total", {"coverage_id": coverage_id, "status": str(response.status_code)})
+        scheduler.report(response.status_code, retry_after_seconds(response))
+
+        throttled = response.status_code == 429 or response.status_code >= 500
+        if not throttled or attempt == THROTTLE_RETRIES:
+            break
+    response.raise_for_status()
+
+    # WCS出错时返回XML格式的ServiceException
+    content_type = response.headers.get("Content-Type", "")
+    if "xml" in content_type or "text" in content_type:
+        raise ValueError(f"WCS返回错误: {response.text[:200]}")
+
+    from rasterio.io import MemoryFile
+
+    with metrics.stage("raster_decode", coverage_id):
+        with MemoryFile(response.content) as memfile:
+            with memfile.open() as dataset:
+                array = dataset.read(1)
+
+    if array.shape != (height, width):
+        raise ValueError(f"WCS返回的栅格尺寸为{array.shape}，期望为{(height, width)}")
+
+    return array, PROPERTY_UNITS.get(service_id, "未知单位")